@@ -79,6 +79,18 @@ class AipOcr:
         content = get_img_content(in_)
         return client.basicGeneral(content, options)
 
+    @classmethod
+    async def atext(cls, in_, options=None):
+        """ text 的协程版
+
+        baidu-aip的sdk是同步的requests实现，这里放到线程池里执行，不阻塞事件循环，
+        可以配合 Iterate.run(..., backend='asyncio') 和其他协程任务一起并发
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, cls.text, in_, options)
+
     @classmethod
     def accurate_text(cls, in_, options=None):
         """ 调用baidu的高精度文本识别
@@ -300,6 +300,176 @@ class ComputeIou:
         # return the intersection over union value
         return iou
 
+    @classmethod
+    def _ltrb_array(cls, boxes, fmt='ltrb'):
+        """ 把一组框统一转成 n*4 的 ltrb 浮点矩阵
+
+        :param boxes: [[l, t, r, b], ...] 或 [[x, y, w, h], ...]，支持list、np.ndarray
+        :param fmt: 输入框的格式，'ltrb' 或 'xywh'
+        """
+        arr = np.array(boxes, dtype=float).reshape(-1, 4)
+        if fmt == 'xywh':
+            arr[:, 2:] += arr[:, :2]
+        elif fmt != 'ltrb':
+            raise ValueError(f'不支持的框格式 {fmt}')
+        return arr
+
+    @classmethod
+    def area_ltrb(cls, boxes, fmt='ltrb'):
+        """ 一组框各自的面积
+
+        >>> ComputeIou.area_ltrb([[0, 0, 10, 10], [5, 5, 15, 25]])
+        array([100., 200.])
+        """
+        b = cls._ltrb_array(boxes, fmt)
+        return np.abs((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]))
+
+    @classmethod
+    def inter_matrix(cls, boxes1, boxes2, fmt='ltrb'):
+        """ 两组框两两之间的相交面积
+
+        :param boxes1: n个框
+        :param boxes2: m个框
+        :param fmt: 框的格式，'ltrb' 或 'xywh'
+        :return: n*m 的np.ndarray矩阵，第i行第j列是 boxes1[i] 与 boxes2[j] 的相交面积
+
+        >>> ComputeIou.inter_matrix([[0, 0, 10, 10]], [[5, 5, 15, 15], [20, 20, 30, 30]])
+        array([[25.,  0.]])
+        """
+        b1, b2 = cls._ltrb_array(boxes1, fmt), cls._ltrb_array(boxes2, fmt)
+        lt = np.maximum(b1[:, None, :2], b2[None, :, :2])
+        rb = np.minimum(b1[:, None, 2:], b2[None, :, 2:])
+        wh = np.clip(rb - lt, 0, None)
+        return wh[..., 0] * wh[..., 1]
+
+    @classmethod
+    def ltrb_matrix(cls, boxes1, boxes2, fmt='ltrb'):
+        """ 向量化计算两组框两两之间的iou，结果跟逐对调用 ComputeIou.ltrb 一致
+
+        :param boxes1: n个框，n*4的结构
+        :param boxes2: m个框，m*4的结构
+        :param fmt: 框的格式，'ltrb' 或 'xywh'
+        :return: n*m 的iou矩阵
+
+        >>> ComputeIou.ltrb_matrix([[0, 0, 10, 10], [0, 0, 5, 5]], [[5, 5, 15, 15], [0, 0, 10, 10]])
+        array([[0.14285714, 1.        ],
+               [0.        , 0.25      ]])
+        >>> ComputeIou.ltrb_matrix([], [[0, 0, 10, 10]]).shape
+        (0, 1)
+        """
+        b1, b2 = cls._ltrb_array(boxes1, fmt), cls._ltrb_array(boxes2, fmt)
+        inter = cls.inter_matrix(b1, b2)
+        union = cls.area_ltrb(b1)[:, None] + cls.area_ltrb(b2)[None, :] - inter
+        # 没有相交的地方iou记为0，同时也避开了union为0的除零问题
+        iou = np.zeros_like(inter)
+        np.divide(inter, union, out=iou, where=inter > 0)
+        return iou
+
+    @classmethod
+    def xywh_matrix(cls, boxes1, boxes2):
+        """ ltrb_matrix 的 xywh 格式版本
+
+        >>> ComputeIou.xywh_matrix([[0, 0, 10, 10]], [[5, 5, 10, 10]])
+        array([[0.14285714]])
+        """
+        return cls.ltrb_matrix(boxes1, boxes2, fmt='xywh')
+
+    @classmethod
+    def ltrb_sparse(cls, boxes1, boxes2, fmt='ltrb'):
+        """ 只计算有相交的框对的iou，返回稀疏三元组
+
+        boxes2按left排序后，对每个boxes1[i]用二分查找截出left<right的候选框，
+        再用上下边界过滤，不可能相交的框对根本不会参与iou运算。
+        适合框很多、但两两之间大部分都不相交的场景。
+
+        :return: (rows, cols, ious) 三个等长的一维数组，表示 boxes1[rows[k]] 与 boxes2[cols[k]] 的iou是ious[k]
+            只含iou>0的项
+
+        >>> rows, cols, ious = ComputeIou.ltrb_sparse([[0, 0, 10, 10], [0, 0, 5, 5]], [[5, 5, 15, 15], [0, 0, 10, 10]])
+        >>> rows.tolist(), cols.tolist(), ious.round(4).tolist()
+        ([0, 0, 1], [1, 0, 1], [1.0, 0.1429, 0.25])
+        """
+        b1, b2 = cls._ltrb_array(boxes1, fmt), cls._ltrb_array(boxes2, fmt)
+        order = np.argsort(b2[:, 0], kind='stable')
+        lefts = b2[order, 0]
+
+        # 1 扫描线找候选框对
+        rows, cols = [], []
+        for i, (l, t, r, b) in enumerate(b1.tolist()):
+            cand = order[:np.searchsorted(lefts, r, 'left')]
+            c = b2[cand]
+            cand = cand[(c[:, 2] > l) & (c[:, 1] < b) & (c[:, 3] > t)]
+            if len(cand):
+                rows.append(np.full(len(cand), i))
+                cols.append(cand)
+        if not rows:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+        # 2 只对候选框对计算iou
+        p1, p2 = b1[rows], b2[cols]
+        wh = np.clip(np.minimum(p1[:, 2:], p2[:, 2:]) - np.maximum(p1[:, :2], p2[:, :2]), 0, None)
+        inter = wh[:, 0] * wh[:, 1]
+        union = cls.area_ltrb(p1) + cls.area_ltrb(p2) - inter
+        keep = inter > 0
+        return rows[keep], cols[keep], inter[keep] / union[keep]
+
+    @classmethod
+    def ltrb_group_sparse(cls, boxes1, boxes2, groups1, groups2, fmt='ltrb', *, chunksize=1 << 22):
+        """ 分组版的 ltrb_sparse，只有同一组（比如同一张图片）里的框对才计算iou
+
+        所有组的框对是一次性批量生成、计算的，没有逐组的python循环，
+        为了控制内存，每批最多处理chunksize个框对
+
+        :param groups1: boxes1每个框所属的组
+        :param groups2: boxes2每个框所属的组
+        :return: (rows, cols, ious)，rows、cols是在原始boxes1、boxes2中的下标，只含iou>0的项
+
+        >>> rows, cols, ious = ComputeIou.ltrb_group_sparse([[0, 0, 10, 10], [0, 0, 10, 10]], [[5, 5, 15, 15]], [1, 2], [2])
+        >>> rows.tolist(), cols.tolist(), ious.round(4).tolist()
+        ([1], [0], [0.1429])
+        """
+
+        def ranges(starts, counts):
+            """ 拼接多个区间 [start, start+count) 里的所有整数 """
+            total = counts.sum()
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            return offsets + np.arange(total)
+
+        b1, b2 = cls._ltrb_array(boxes1, fmt), cls._ltrb_array(boxes2, fmt)
+        g1, g2 = np.asarray(groups1), np.asarray(groups2)
+
+        # 1 按组排序，每组的框在排序后是连续的一段
+        o1, o2 = np.argsort(g1, kind='stable'), np.argsort(g2, kind='stable')
+        keys1, starts1, counts1 = np.unique(g1[o1], return_index=True, return_counts=True)
+        keys2, starts2, counts2 = np.unique(g2[o2], return_index=True, return_counts=True)
+        _, k1, k2 = np.intersect1d(keys1, keys2, assume_unique=True, return_indices=True)
+        starts1, counts1, starts2, counts2 = starts1[k1], counts1[k1], starts2[k2], counts2[k2]
+
+        # 2 按框对数量分批
+        npairs = np.cumsum(counts1 * counts2)
+        bounds = np.searchsorted(npairs, np.arange(chunksize, npairs[-1] if len(npairs) else 0, chunksize))
+        res_rows, res_cols, res_ious = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)]
+        for sel in np.split(np.arange(len(starts1)), np.unique(bounds)):
+            if not len(sel):
+                continue
+            # 每个框1，跟同组的所有框2组合
+            idx1 = ranges(starts1[sel], counts1[sel])
+            n2 = np.repeat(counts2[sel], counts1[sel])
+            rows = np.repeat(idx1, n2)
+            cols = ranges(np.repeat(starts2[sel], counts1[sel]), n2)
+            rows, cols = o1[rows], o2[cols]
+            # 计算iou
+            p1, p2 = b1[rows], b2[cols]
+            wh = np.clip(np.minimum(p1[:, 2:], p2[:, 2:]) - np.maximum(p1[:, :2], p2[:, :2]), 0, None)
+            inter = wh[:, 0] * wh[:, 1]
+            union = cls.area_ltrb(p1) + cls.area_ltrb(p2) - inter
+            keep = inter > 0
+            res_rows.append(rows[keep])
+            res_cols.append(cols[keep])
+            res_ious.append(inter[keep] / union[keep])
+        return np.concatenate(res_rows), np.concatenate(res_cols), np.concatenate(res_ious)
+
     @classmethod
     def polygon(cls, pts1, pts2):
         inter_area = pts1.intersection(pts2).area
@@ -317,6 +487,27 @@ class ComputeIou:
         polygon1, polygon2 = ShapelyPolygon.gen(pts1), ShapelyPolygon.gen(pts2)
         return cls.polygon(polygon1, polygon2)
 
+    @classmethod
+    def polygon_sparse(cls, polys1, polys2):
+        """ 两组多边形中有相交的对的iou，详见 ShapelyPolygons.iou_sparse
+
+        :return: (rows, cols, ious)
+        """
+        from pyxllib.algo.shapely_ import ShapelyPolygons
+        return ShapelyPolygons(polys1).iou_sparse(polys2)
+
+    @classmethod
+    def polygon_matrix(cls, polys1, polys2):
+        """ 两组多边形两两之间的iou矩阵
+
+        每个多边形只转换一次，用外接矩形排除不可能相交的对后，再做多边形求交
+
+        >>> ComputeIou.polygon_matrix([[[0, 0], [10, 10]]], [[[5, 5], [15, 15]], [[20, 20], [30, 30]]]).round(4)
+        array([[0.1429, 0.    ]])
+        """
+        from pyxllib.algo.shapely_ import ShapelyPolygons
+        return ShapelyPolygons(polys1).iou_matrix(polys2)
+
     @classmethod
     def nms_basic(cls, boxes, func, iou=0.5, *, key=None, index=False):
         """ 假设boxes已经按权重从大到小排过序
@@ -351,21 +542,105 @@ class ComputeIou:
             return [boxes[i] for i in idxs]
 
     @classmethod
-    def nms_ltrb(cls, boxes, iou=0.5, *, key=None, index=False):
-        return cls.nms_basic(boxes, cls.ltrb, iou, key=key, index=index)
+    def nms_array(cls, boxes, iou=0.5, *, scores=None, categories=None, fmt='ltrb'):
+        """ 数组版的nms，每轮只算一行iou，用布尔掩码抑制剩余的框
+
+        :param boxes: n个框，n*4的结构
+        :param iou: iou不小于这个阈值的框会被抑制
+        :param scores: 每个框的置信度，输入后会先按置信度从大到小排序
+            不输入则认为boxes已经按权重从大到小排过序
+        :param categories: 每个框的类别，输入后只有同类别的框才会相互抑制
+        :param fmt: 框的格式，'ltrb' 或 'xywh'
+        :return: 保留下来的框的下标 [i1, i2, i3, ...]
+
+        >>> boxes = [[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 30, 30]]
+        >>> ComputeIou.nms_array(boxes)
+        [0, 2]
+        >>> ComputeIou.nms_array(boxes, scores=[0.5, 0.9, 0.7])
+        [1, 2]
+        >>> ComputeIou.nms_array(boxes, categories=[1, 2, 1])
+        [0, 1, 2]
+        """
+        b = cls._ltrb_array(boxes, fmt)
+        areas = cls.area_ltrb(b)
+        if scores is None:
+            order = np.arange(len(b))
+        else:
+            order = np.argsort(-np.asarray(scores, dtype=float), kind='stable')
+        if categories is not None:
+            categories = np.asarray(categories)
+
+        idxs = []
+        while len(order):
+            # 1 加入权值大的框
+            i, rest = order[0], order[1:]
+            idxs.append(int(i))
+            # 2 抑制其他框
+            wh = np.clip(np.minimum(b[i, 2:], b[rest, 2:]) - np.maximum(b[i, :2], b[rest, :2]), 0, None)
+            inter = wh[:, 0] * wh[:, 1]
+            ious = np.zeros_like(inter)
+            np.divide(inter, areas[i] + areas[rest] - inter, out=ious, where=inter > 0)
+            suppress = ious >= iou
+            if categories is not None:
+                suppress &= categories[rest] == categories[i]
+            order = rest[~suppress]
+        return idxs
 
     @classmethod
-    def nms_xywh(cls, boxes, iou=0.5, *, key=None, index=False):
-        if callable(key):
-            func = lambda x: xywh2ltrb(key(x))
+    def _nms_rect(cls, boxes, iou, fmt, *, key=None, index=False, scores=None, categories=None):
+        items = [key(b) for b in boxes] if callable(key) else boxes
+        idxs = cls.nms_array(items, iou, scores=scores, categories=categories, fmt=fmt)
+        if index:
+            return idxs
         else:
-            func = xywh2ltrb
-        return cls.nms_ltrb(boxes, iou, key=func, index=index)
+            return [boxes[i] for i in idxs]
+
+    @classmethod
+    def nms_ltrb(cls, boxes, iou=0.5, *, key=None, index=False, scores=None, categories=None):
+        """ 结果跟 nms_basic(boxes, ComputeIou.ltrb, ...) 一致，但底层用的是 nms_array
+
+        :param scores: 每个框的置信度，不输入时认为boxes已经按权重从大到小排过序
+        :param categories: 每个框的类别，输入后按类别分批nms
+        """
+        return cls._nms_rect(boxes, iou, 'ltrb', key=key, index=index, scores=scores, categories=categories)
+
+    @classmethod
+    def nms_xywh(cls, boxes, iou=0.5, *, key=None, index=False, scores=None, categories=None):
+        return cls._nms_rect(boxes, iou, 'xywh', key=key, index=index, scores=scores, categories=categories)
 
     @classmethod
     def nms_polygon(cls, boxes, iou=0.5, *, key=None, index=False):
-        # ShapelyPolygon.gen
-        return cls.nms_basic(boxes, cls.polygon, iou, key=key, index=index)
+        """ 多边形的nms，结果跟 nms_basic(boxes, ComputeIou.polygon, ...) 一致
+
+        每个多边形只转换一次，并用空间索引预先找出有相交的对，只对这些对求交
+
+        :param boxes: 支持 ShapelyPolygon.gen 能处理的各种格式，需要已按权重从大到小排过序
+        """
+        from pyxllib.algo.shapely_ import ShapelyPolygons
+
+        polygons = ShapelyPolygons([key(b) for b in boxes] if callable(key) else boxes)
+        n = len(polygons)
+        if iou <= 0:  # 这种阈值下，不相交的框也会被抑制
+            idxs = list(range(min(n, 1)))
+        else:
+            # 1 一次算出所有需要抑制的对
+            rows, cols, ious = polygons.iou_sparse(polygons)
+            sel = (rows < cols) & (ious >= iou)
+            neighbors = [[] for _ in range(n)]
+            for i, j in zip(rows[sel].tolist(), cols[sel].tolist()):
+                neighbors[i].append(j)
+            # 2 按权重顺序抑制
+            idxs, suppressed = [], [False] * n
+            for i in range(n):
+                if not suppressed[i]:
+                    idxs.append(i)
+                    for j in neighbors[i]:
+                        suppressed[j] = True
+
+        if index:
+            return idxs
+        else:
+            return [boxes[i] for i in idxs]
 
 
 ____other = """
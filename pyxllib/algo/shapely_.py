@@ -21,6 +21,9 @@ except ModuleNotFoundError:
 
 from shapely.geometry import Polygon
 
+# shapely2开始支持对几何对象数组的向量化运算
+_SHAPELY2 = int(shapely.__version__.split('.')[0]) >= 2
+
 from pyxllib.algo.geo import rect2polygon
 
 
@@ -65,3 +68,107 @@ class ShapelyPolygon:
     @classmethod
     def to_ndarray(cls, p, dtype=None):
         return np.array(p.exterior.coords, dtype=dtype)
+
+
+class ShapelyPolygons:
+    """ 一组多边形，批量计算iou用
+
+    每个多边形只在初始化时转换一次，并缓存面积、外接矩形，
+    计算iou时先用外接矩形（STRtree空间索引）找出候选对，不相交的对不会做任何多边形求交运算
+    """
+
+    def __init__(self, polygons):
+        """
+        :param polygons: 一组多边形，每个元素支持 ShapelyPolygon.gen 能处理的各种格式
+        """
+        self.polygons = [ShapelyPolygon.gen(x) for x in polygons]
+        self.areas = np.array([p.area for p in self.polygons], dtype=float)
+        self.bounds = np.array([p.bounds for p in self.polygons], dtype=float).reshape(-1, 4)
+        self._tree = None
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def __getitem__(self, idx):
+        return self.polygons[idx]
+
+    @property
+    def tree(self):
+        """ shapely2才有批量查询接口，只在shapely2下使用 """
+        if self._tree is None:
+            from shapely.strtree import STRtree
+            self._tree = STRtree(self.polygons)
+        return self._tree
+
+    def candidates(self, other):
+        """ 外接矩形相交的候选对
+
+        :param ShapelyPolygons other: 另一组多边形
+        :return: (rows, cols)，self[rows[k]] 与 other[cols[k]] 的外接矩形相交
+        """
+        if not len(self) or not len(other):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        if _SHAPELY2:
+            rows, cols = other.tree.query(np.array(self.polygons, dtype=object))
+        else:
+            from pyxllib.algo.geo import ComputeIou
+            rows, cols, _ = ComputeIou.ltrb_sparse(self.bounds, other.bounds)
+        return rows, cols
+
+    def inter_sparse(self, other):
+        """ 只计算有相交的多边形对的相交面积
+
+        :return: (rows, cols, inters)，只含相交面积>0的项
+
+        >>> a = ShapelyPolygons([[[0, 0], [10, 10]], [[20, 20], [30, 30]]])
+        >>> rows, cols, inters = a.inter_sparse([[[5, 5], [15, 15]], [[0, 0], [10, 0], [10, 10]]])
+        >>> sorted(zip(rows.tolist(), cols.tolist(), inters.tolist()))
+        [(0, 0, 25.0), (0, 1, 50.0)]
+        """
+        if not isinstance(other, ShapelyPolygons):
+            other = ShapelyPolygons(other)
+        rows, cols = self.candidates(other)
+        if _SHAPELY2:
+            g1, g2 = np.array(self.polygons, dtype=object), np.array(other.polygons, dtype=object)
+            inter = shapely.area(shapely.intersection(g1[rows], g2[cols]))
+        else:
+            inter = np.array([self.polygons[i].intersection(other.polygons[j]).area
+                              for i, j in zip(rows.tolist(), cols.tolist())], dtype=float)
+        inter = np.asarray(inter, dtype=float).reshape(-1)
+        keep = inter > 0
+        return rows[keep], cols[keep], inter[keep]
+
+    def iou_sparse(self, other):
+        """ 只计算有相交的多边形对的iou
+
+        :return: (rows, cols, ious)，只含iou>0的项
+
+        >>> a = ShapelyPolygons([[[0, 0], [10, 10]], [[20, 20], [30, 30]]])
+        >>> b = ShapelyPolygons([[[5, 5], [15, 15]], [[0, 0], [10, 0], [10, 10]]])
+        >>> rows, cols, ious = a.iou_sparse(b)
+        >>> sorted(zip(rows.tolist(), cols.tolist(), ious.round(4).tolist()))
+        [(0, 0, 0.1429), (0, 1, 0.5)]
+        """
+        if not isinstance(other, ShapelyPolygons):
+            other = ShapelyPolygons(other)
+        rows, cols, inter = self.inter_sparse(other)
+        union = self.areas[rows] + other.areas[cols] - inter
+        keep = union > 0
+        return rows[keep], cols[keep], inter[keep] / union[keep]
+
+    def iou_matrix(self, other):
+        """ 两组多边形两两之间的iou
+
+        :return: n*m 的iou矩阵
+
+        >>> a = ShapelyPolygons([[[0, 0], [10, 10]], [[20, 20], [30, 30]]])
+        >>> a.iou_matrix([[[5, 5], [15, 15]], [[0, 0], [10, 0], [10, 10]]]).round(4)
+        array([[0.1429, 0.5   ],
+               [0.    , 0.    ]])
+        """
+        if not isinstance(other, ShapelyPolygons):
+            other = ShapelyPolygons(other)
+        mat = np.zeros((len(self), len(other)))
+        rows, cols, ious = self.iou_sparse(other)
+        mat[rows, cols] = ious
+        return mat
@@ -6,6 +6,7 @@
 
 import copy
 import itertools
+import sys
 
 import numpy as np
 import pandas as pd
@@ -150,6 +151,189 @@ class MatchPairs:
         """
         return [self.match(x) for x in xs]
 
+    def assign(self, xs, least_score=sys.float_info.epsilon):
+        """ 对xs做一对一的最优指派，使所有匹配对的总分最大
+
+        跟 matches 不同，这里ys中每个元素最多只会被匹配一次，低于least_score的对也不会匹配
+
+        :return: [(idx0, score0), (idx1, score1), ...]  长度 = len(xs)
+            没有分配到的x，记为 (-1, 0)
+
+        >>> m = MatchPairs([1, 5, 8, 9, 2], lambda x,y: 1-abs(x-y)/max(x,y))
+        >>> m.assign([4, 6, 10])
+        [(1, 0.8), (2, 0.75), (3, 0.9)]
+        >>> m.assign([4, 6, 10], 0.8)  # 4、6都只能匹配5，总分最大的方案是把5分给6
+        [(-1, 0), (1, 0.8333333333333334), (3, 0.9)]
+        """
+        scores = np.array([[self.cmp_func(x, y) for y in self.ys] for x in xs], dtype=float)
+        scores = scores.reshape(len(xs), len(self.ys))
+        rows, cols = np.nonzero(scores >= least_score)
+        res = [(-1, 0)] * len(xs)
+        for i, j, score in optimal_matchpairs(rows, cols, scores[rows, cols], least_score):
+            res[i] = (j, score)
+        return res
+
+
+def greedy_matchpairs(rows, cols, scores, least_score=sys.float_info.epsilon):
+    """ 在稀疏三元组上做贪心匹配，是 matchpairs 第2步"过滤出最终结果"的数组版实现
+
+    :param rows: 候选对在xs中的下标
+    :param cols: 候选对在ys中的下标
+    :param scores: 候选对的分数
+    :param least_score: 允许匹配的最低分
+    :return: [(i, j, score), ...]
+        分数并列时按(i, j)先来后到，跟 matchpairs 的排序规则完全一致
+
+    >>> greedy_matchpairs([0, 0, 1, 1], [0, 1, 0, 1], [0.9, 0.8, 0.9, 0.1])
+    [(0, 0, 0.9), (1, 1, 0.1)]
+    """
+    rows, cols, scores = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int), np.asarray(scores)
+    # 1 用数组掩码剪掉低分对
+    keep = scores >= least_score
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    if not len(scores):
+        return []
+
+    # 2 按 (-score, i, j) 排序
+    order = np.lexsort((cols, rows, -scores))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+
+    # 3 贪心选取
+    # 逐个遍历太慢，这里改成按轮次批量选取：每轮中，在所在行、所在列都排第一的候选对，
+    #   逐个遍历时也一定会被选中，可以一次性全部选出，然后剔除行、列已被占用的候选对，进入下一轮。
+    #   每轮至少会选出剩余候选中排第一的对，而框匹配这类场景一般几轮就能结束。
+    row_used, col_used = np.zeros(rows.max() + 1, dtype=bool), np.zeros(cols.max() + 1, dtype=bool)
+    alive, selected = np.arange(len(rows)), []
+    while len(alive):
+        r, c = rows[alive], cols[alive]
+        first_r, first_c = np.zeros(len(alive), dtype=bool), np.zeros(len(alive), dtype=bool)
+        first_r[np.unique(r, return_index=True)[1]] = True
+        first_c[np.unique(c, return_index=True)[1]] = True
+        sel = alive[first_r & first_c]
+        selected.append(sel)
+        row_used[rows[sel]] = True
+        col_used[cols[sel]] = True
+        alive = alive[~(row_used[r] | col_used[c])]
+    sel = np.sort(np.concatenate(selected))
+    return list(zip(rows[sel].tolist(), cols[sel].tolist(), scores[sel].tolist()))
+
+
+def optimal_matchpairs(rows, cols, scores, least_score=sys.float_info.epsilon, *, chunk=True):
+    """ 在稀疏三元组上求最优一对一匹配（匈牙利算法，linear sum assignment），使匹配对的总分最大
+
+    跟 greedy_matchpairs 的区别：贪心每次只拿当前最高分，可能导致整体次优，
+        比如 [[0.9, 0.8], [0.85, 0.1]]，贪心得到 0.9+0.1，最优解是 0.8+0.85
+
+    :param rows: 候选对在xs中的下标
+    :param cols: 候选对在ys中的下标
+    :param scores: 候选对的分数，非正分数的匹配对总分没有贡献
+    :param least_score: 允许匹配的最低分
+    :param chunk: 按候选对构成的二分图拆分连通块，每块独立求解
+        不同连通块之间不存在候选对，所以结果跟整体求解完全一样，但大矩阵会被拆成很多小矩阵，速度、内存都好很多
+    :return: [(i, j, score), ...]，按 (-score, i, j) 排序
+
+    >>> optimal_matchpairs([0, 0, 1, 1], [0, 1, 0, 1], [0.9, 0.8, 0.85, 0.1])
+    [(1, 0, 0.85), (0, 1, 0.8)]
+    """
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    rows, cols, scores = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int), np.asarray(scores, dtype=float)
+    # 1 用数组掩码剪掉低分对
+    keep = scores >= least_score
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    if not len(scores):
+        return []
+
+    # 2 下标压缩，只保留出现在候选对里的行列
+    xs_id, ri = np.unique(rows, return_inverse=True)
+    ys_id, ci = np.unique(cols, return_inverse=True)
+    n, m = len(xs_id), len(ys_id)
+
+    # 3 拆分连通块
+    if chunk:
+        graph = coo_matrix((np.ones(len(ri)), (ri, n + ci)), shape=(n + m, n + m))
+        _, labels = connected_components(graph, directed=False)
+        labels = labels[ri]
+    else:
+        labels = np.zeros(len(ri), dtype=int)
+    order = np.argsort(labels, kind='stable')
+    splits = np.flatnonzero(np.diff(labels[order])) + 1
+
+    # 4 每个连通块求最优指派
+    res_rows, res_cols, res_scores = [], [], []
+    for sel in np.split(order, splits):
+        r, c, s = ri[sel], ci[sel], scores[sel]
+        ur, rr = np.unique(r, return_inverse=True)
+        uc, cc = np.unique(c, return_inverse=True)
+        mat = np.zeros((len(ur), len(uc)))
+        mat[rr, cc] = np.maximum(s, 0)
+        valid = np.zeros(mat.shape, dtype=bool)
+        valid[rr, cc] = True
+        a, b = linear_sum_assignment(mat, maximize=True)
+        # 非候选对只是为了补全方阵被迫指派的，要去掉
+        a, b = a[valid[a, b]], b[valid[a, b]]
+        score_mat = np.full(mat.shape, -np.inf)
+        score_mat[rr, cc] = s
+        res_rows.append(xs_id[ur[a]])
+        res_cols.append(ys_id[uc[b]])
+        res_scores.append(score_mat[a, b])
+
+    # 5 整理输出格式
+    rows, cols, scores = np.concatenate(res_rows), np.concatenate(res_cols), np.concatenate(res_scores)
+    order = np.lexsort((cols, rows, -scores))
+    return list(zip(rows[order].tolist(), cols[order].tolist(), scores[order].tolist()))
+
+
+def matchpairs_matrix(xs, ys, scores, least_score=sys.float_info.epsilon, *, index=False, mode='greedy'):
+    """ matchpairs 的矩阵版，不再在python层逐对调用cmp_func
+
+    :param xs: 第一组数据
+    :param ys: 第二组数据
+    :param scores: 相似度数据，支持以下几种格式
+        np.ndarray，预先算好的 n*m 分数矩阵
+        tuple，稀疏三元组 (rows, cols, scores)，没列出的对视为不可能匹配
+        callable，向量化的比较函数 scores(xs, ys)，返回值是上述两种格式之一
+            比如 ComputeIou.ltrb_matrix，或者带空间预筛选的 ComputeIou.ltrb_sparse
+    :param least_score: 允许匹配的最低分，默认必须要大于0
+    :param index: 返回的不是原值，而是下标
+    :param mode: 匹配策略
+        greedy，贪心匹配，结果跟 matchpairs 一致
+        optimal，最优指派，使匹配总分最大，详见 optimal_matchpairs
+    :return: 跟 matchpairs 相同，[(x1, y1, score1), (x2, y2, score2), ...]
+
+    >>> xs, ys = [4, 6, 1, 2, 9, 4, 5], [1, 5, 8, 9, 2]
+    >>> scores = lambda a, b: 1 - np.abs(np.subtract.outer(a, b)) / np.maximum.outer(a, b)
+    >>> matchpairs_matrix(xs, ys, scores)
+    [(1, 1, 1.0), (2, 2, 1.0), (9, 9, 1.0), (5, 5, 1.0), (6, 8, 0.75)]
+    >>> matchpairs_matrix(xs, ys, scores, 0.9, index=True)
+    [(2, 0, 1.0), (3, 4, 1.0), (4, 3, 1.0), (6, 1, 1.0)]
+    >>> matchpairs_matrix([[0.9, 0.8], [0.85, 0.1]], [0, 1], lambda a, b: a, index=True)
+    [(0, 0, 0.9), (1, 1, 0.1)]
+    >>> matchpairs_matrix([[0.9, 0.8], [0.85, 0.1]], [0, 1], lambda a, b: a, index=True, mode='optimal')
+    [(1, 0, 0.85), (0, 1, 0.8)]
+    """
+    if callable(scores):
+        scores = scores(xs, ys)
+
+    if isinstance(scores, tuple):
+        rows, cols, vals = scores
+    else:
+        scores = np.asarray(scores, dtype=float).reshape(len(xs), len(ys))
+        rows, cols = np.nonzero(scores >= least_score)
+        vals = scores[rows, cols]
+
+    if mode == 'greedy':
+        pairs = greedy_matchpairs(rows, cols, vals, least_score)
+    elif mode == 'optimal':
+        pairs = optimal_matchpairs(rows, cols, vals, least_score)
+    else:
+        raise ValueError(f'不支持的匹配策略 {mode}')
+    if not index:
+        pairs = [(xs[i], ys[j], score) for i, j, score in pairs]
+    return pairs
+
 
 def get_ndim(coords):
     # 注意 np.array(coords[:1])，只需要取第一个元素就可以判断出ndim
@@ -31,11 +31,192 @@ except ModuleNotFoundError:
 from xlcocotools.coco import COCO
 from xlcocotools.cocoeval import COCOeval
 
+from pyxllib.prog.pupil import parallel_map, auto_chunksize
 from pyxllib.stdlib.zipfile import ZipFile
 from pyxllib.data.labelme import LABEL_COLORMAP7, ToLabelmeJson, LabelmeDataset, LabelmeDict
 from pyxllib.data.icdar import IcdarEval
 
 
+def iter_json_items(file, prefix='item'):
+    """ 流式解析json文件中某个数组的元素
+
+    安装了ijson时，边读文件边解析，每次只构造一个元素；否则整个文件读入后再遍历
+
+    :param prefix: ijson风格的路径，'item'表示顶层就是数组，'annotations.item'表示顶层字典annotations字段的数组
+    """
+    for _, x in iter_json_prefixes(file, [prefix]):
+        yield x
+
+
+def iter_json_prefixes(file, prefixes):
+    """ iter_json_items 的多路径版，依次解析出多个数组的元素
+
+    安装了ijson时，每个路径各扫描一遍文件，只构造匹配路径的元素；
+        （试过把数据块同时分发给多个ijson解析协程，只读一遍文件，但实测比多扫几遍还慢）
+    否则整个文件只读入一次，再依次遍历
+
+    :param prefixes: ijson风格的路径清单，例如 ['images.item', 'annotations.item']
+    :return: generator，(prefix, 元素)
+    """
+    try:
+        import ijson
+    except ModuleNotFoundError:
+        data = File(file).read(mode='.json')
+        for prefix in prefixes:
+            items = data
+            for k in prefix.split('.')[:-1]:
+                items = items[k]
+            for x in items:
+                yield prefix, x
+        return
+
+    for prefix in prefixes:
+        with open(str(file), 'rb') as f:
+            for x in ijson.items(f, prefix, use_float=True):
+                yield prefix, x
+
+
+def write_json_stream(ob, file, *, chunksize=10000):
+    """ 把coco这类 {key: list} 或 list 结构的数据流式写入json文件
+
+    每次只序列化chunksize个元素，不用在内存里拼出整个json字符串
+    用 atomic_open 写入，中途出错不会留下不完整的json文件
+    """
+    def write_list(f, items):
+        f.write('[')
+        for i in range(0, len(items), chunksize):
+            if i:
+                f.write(',')
+            f.write(','.join(ujson.dumps(x, ensure_ascii=False) for x in items[i:i + chunksize]))
+        f.write(']')
+
+    File(file).ensure_parent()
+    with atomic_open(file, 'w', encoding='utf8', buffering=1 << 20) as f:
+        if isinstance(ob, dict):
+            f.write('{')
+            for i, (k, v) in enumerate(ob.items()):
+                f.write((',' if i else '') + ujson.dumps(k) + ':')
+                if isinstance(v, (list, tuple)):
+                    write_list(f, v)
+                else:
+                    f.write(ujson.dumps(v, ensure_ascii=False))
+            f.write('}')
+        else:
+            write_list(f, ob)
+    return file
+
+
+def _file_etag(file):
+    """ 用文件的修改时间、大小作为缓存是否过期的标记 """
+    st = os.stat(str(file))
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _read_npz_cache(cache_file, etag):
+    """ 读取 _write_npz_cache 存的列数据，缓存不存在或已过期时返回None """
+    if not os.path.isfile(cache_file):
+        return
+    with np.load(cache_file) as data:
+        if data['etag'].tolist() == etag:
+            return {k: data[k] for k in data.files if k != 'etag'}
+
+
+def _write_npz_cache(cache_file, etag, columns):
+    """ 用 atomic_open 写入，中途出错不会留下损坏的缓存文件 """
+    with atomic_open(cache_file, 'wb') as f:
+        np.savez(f, etag=np.array(etag), **columns)
+
+
+class _ColumnBuilder:
+    """ 把流式解析出的字典逐批转成numpy列，不保留原始的字典 """
+
+    def __init__(self, columns, batchsize=65536):
+        """
+        :param columns: {列名: (取值函数, dtype, 每个元素的形状)}，dtype为None时由numpy自动推断
+        """
+        self.columns, self.batchsize = columns, batchsize
+        self.batch, self.chunks = [], {k: [] for k in columns}
+
+    def add(self, x):
+        self.batch.append(x)
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            for k, (get, dtype, shape) in self.columns.items():
+                self.chunks[k].append(np.array([get(x) for x in self.batch], dtype=dtype).reshape(-1, *shape))
+            self.batch.clear()
+
+    def result(self):
+        self.flush()
+        return {k: (np.concatenate(v) if v else np.zeros((0, *self.columns[k][2]), dtype=self.columns[k][1] or int))
+                for k, v in self.chunks.items()}
+
+
+class CocoGtIndex:
+    """ gt_dict的列式索引
+
+    把images、annotations里常用的字段抽成numpy数组，并用CSR格式按图片对标注分组，
+    筛选、分组、重编号等操作都可以用数组下标完成，不用每次遍历字典
+
+    annotations按所在图片位置稳定排序后的下标是 ann_order，
+    第p张图片的标注下标是 ann_order[img_offsets[p]:img_offsets[p + 1]]
+    """
+
+    def __init__(self, gt_dict):
+        images, anns, cats = gt_dict['images'], gt_dict['annotations'], gt_dict['categories']
+        # 引用原列表，保证key里的id在索引有效期内不会被其他对象复用
+        self._src = (images, anns, cats)
+        self.key = self.signature(gt_dict)
+
+        # 1 images
+        self.image_ids = np.array([x['id'] for x in images])
+        self.file_names = np.array([x['file_name'] for x in images], dtype=object)
+        # 图片id重复时，跟字典写法一样以最后一个为准
+        self.id2pos = {x: i for i, x in enumerate(self.image_ids.tolist())}
+
+        # 2 annotations
+        self.ann_image_ids = np.array([x['image_id'] for x in anns])
+        # 每个标注所在图片在images中的位置，不存在的图片记为-1
+        self.ann_image_pos = pd.Series(self.ann_image_ids, dtype=object).map(self.id2pos).fillna(-1).to_numpy(int)
+
+        # 3 CSR分组
+        self.ann_order = np.argsort(self.ann_image_pos, kind='stable')
+        self.img_offsets = np.searchsorted(self.ann_image_pos[self.ann_order], np.arange(len(images) + 1))
+
+        self.catid2name = {x['id']: x['name'] for x in cats}
+        self._bboxes = self._areas = None
+
+    @classmethod
+    def signature(cls, gt_dict):
+        """ 判断索引是否过期的依据：gt_dict及其中各列表的对象、长度 """
+        return tuple((id(x), len(x)) for x in (gt_dict, gt_dict['images'], gt_dict['annotations'],
+                                               gt_dict['categories']))
+
+    @property
+    def bboxes(self):
+        """ n*4的xywh数组，用到的时候才构建 """
+        if self._bboxes is None:
+            self._bboxes = np.array([x['bbox'] for x in self._src[1]], dtype=float).reshape(-1, 4)
+        return self._bboxes
+
+    @property
+    def areas(self):
+        if self._areas is None:
+            self._areas = np.array([x['area'] for x in self._src[1]], dtype=float)
+        return self._areas
+
+    def image_anns(self, pos):
+        """ 第pos张图片的标注在annotations中的下标 """
+        return self.ann_order[self.img_offsets[pos]:self.img_offsets[pos + 1]]
+
+    def missing_image_id(self):
+        """ 返回第一个在images里找不到的标注图片id，都能找到则返回None """
+        idx = np.flatnonzero(self.ann_image_pos < 0)
+        return self.ann_image_ids[idx[0]].item() if len(idx) else None
+
+
 class CocoGtData:
     """ 类coco格式的json数据处理
 
@@ -43,8 +224,104 @@ class CocoGtData:
         比如images、annotaions、categories都可以扩展自定义字段
     """
 
-    def __init__(self, gt):
-        self.gt_dict = gt if isinstance(gt, dict) else File(gt).read()
+    def __init__(self, gt, *, cache=False):
+        """
+        :param gt: gt的dict或文件
+        :param cache: gt是文件时，是否使用 read_gt_dict 的缓存
+        """
+        self.gt_dict = gt if isinstance(gt, dict) else self.read_gt_dict(gt, cache=cache)
+        self._gt_index = None
+
+    @classmethod
+    def read_gt_dict(cls, file, *, cache=False):
+        """ 读取gt的json文件
+
+        :param cache: 是否使用缓存，开启后会在同目录生成 file.pkl 的二进制缓存，
+            json文件的修改时间、大小没变时，再次读取直接加载缓存，比解析json快很多
+        """
+        if not cache:
+            return File(file).read()
+
+        cache_file, etag = File(str(file) + '.pkl'), _file_etag(file)
+        if cache_file:
+            data = cache_file.read()
+            if data['etag'] == etag:
+                return data['gt_dict']
+        gt_dict = File(file).read()
+        cache_file.write({'etag': etag, 'gt_dict': gt_dict})
+        return gt_dict
+
+    @classmethod
+    def read_gt_columns(cls, file, *, cache=True):
+        """ 以列存储的格式读取gt的json文件，适合只需要分析框、不需要完整gt_dict的超大标注
+
+        images、annotations流式解析，每攒够一批就转成数组，不会构造整个gt_dict
+
+        :param cache: 是否使用缓存，开启后会在同目录生成 file.npz 的二进制缓存，
+            json文件的修改时间、大小没变时，再次读取直接加载缓存
+        :return: dict
+            images: id、file_name、height、width 各是长度m的数组，缺失的height、width记为0
+            annotations: id、image_id、category_id、area、iscrowd 是长度n的数组，bbox是n*4的数组，
+                缺失的area按bbox的宽高计算，缺失的iscrowd记为0
+            categories: 原始的categories列表
+            其他自定义字段不会保留
+        """
+        # 1 读缓存
+        cache_file, etag = str(file) + '.npz', _file_etag(file)
+        data = _read_npz_cache(cache_file, etag) if cache else None
+        if data is not None:
+            res = {'images': {}, 'annotations': {}, 'categories': json.loads(data.pop('categories').item())}
+            for k, v in data.items():
+                part, name = k.split('.')
+                res[part][name] = v
+            return res
+
+        # 2 流式解析
+        builders = {
+            'images.item': _ColumnBuilder({'id': (lambda x: x['id'], None, ()),
+                                           'file_name': (lambda x: x['file_name'], str, ()),
+                                           'height': (lambda x: x.get('height', 0), int, ()),
+                                           'width': (lambda x: x.get('width', 0), int, ())}),
+            'annotations.item': _ColumnBuilder({'id': (lambda x: x['id'], None, ()),
+                                                'image_id': (lambda x: x['image_id'], None, ()),
+                                                'category_id': (lambda x: x['category_id'], None, ()),
+                                                'bbox': (lambda x: x['bbox'], float, (4,)),
+                                                'area': (lambda x: x.get('area', x['bbox'][2] * x['bbox'][3]),
+                                                         float, ()),
+                                                'iscrowd': (lambda x: x.get('iscrowd', 0), int, ())}),
+        }
+        categories = []
+        for prefix, x in iter_json_prefixes(file, ['images.item', 'annotations.item', 'categories.item']):
+            if prefix == 'categories.item':
+                categories.append(x)
+            else:
+                builders[prefix].add(x)
+        res = {'images': builders['images.item'].result(),
+               'annotations': builders['annotations.item'].result(),
+               'categories': categories}
+
+        # 3 写缓存
+        if cache:
+            columns = {f'{part}.{k}': v for part in ('images', 'annotations') for k, v in res[part].items()}
+            _write_npz_cache(cache_file, etag, {'categories': np.array(json.dumps(categories, ensure_ascii=False)),
+                                                **columns})
+        return res
+
+    @property
+    def gt_index(self):
+        """ gt_dict的列式索引 CocoGtIndex，第一次使用时构建
+
+        gt_dict或其中的images、annotations、categories列表被替换、增删元素后，会自动重建；
+        但如果是在外部原地修改了已有元素的id等字段，需要调用 invalidate_index 强制重建
+        """
+        index = getattr(self, '_gt_index', None)
+        if index is None or index.key != CocoGtIndex.signature(self.gt_dict):
+            index = self._gt_index = CocoGtIndex(self.gt_dict)
+        return index
+
+    def invalidate_index(self):
+        """ 标记 gt_index 过期，下次使用时重建 """
+        self._gt_index = None
 
     @classmethod
     def gen_image(cls, image_id, file_name, height, width, **kwargs):
@@ -76,7 +353,7 @@ class CocoGtData:
         """
         # 1 两个点要转4个点
         if len(pts) == 2:
-            pts = rect2polygon(pts).tolist()
+            pts = rect2polygon(pts)
         else:
             pts = list(pts)
 
@@ -108,7 +385,7 @@ class CocoGtData:
             pts = []
             for seg in a['segmentation']:
                 pts += seg
-            a['bbox'] = ltrb2xywh(rect_bounds1d(pts))
+            a['bbox'] = ltrb2xywh(rect_bounds(pts))
         if 'area' not in a:  # 自动计算面积
             a['area'] = int(a['bbox'][2] * a['bbox'][3])
         for k in ['id', 'image_id']:
@@ -141,7 +418,7 @@ class CocoGtData:
             # print(vals)
             seg = [int(v) for v in vals[:8]]
             attrs['segmentation'] = [seg]
-            attrs['bbox'] = ltrb2xywh(rect_bounds1d(seg))
+            attrs['bbox'] = ltrb2xywh(rect_bounds(seg))
             if kwargs:
                 attrs.update(kwargs)
             annotations.append(cls.gen_annotation(**attrs))
@@ -159,10 +436,17 @@ class CocoGtData:
         # TODO 扩展支持其他构造方法
 
     @classmethod
-    def gen_gt_dict(cls, images, annotations, categories, outfile=None):
+    def gen_gt_dict(cls, images, annotations, categories, outfile=None, *, writer=None):
+        """
+        :param writer: BackgroundWriter，传入时outfile在后台线程写入，不阻塞后续计算，
+            写完之前不要再修改images等数据
+        """
         data = {'images': images, 'annotations': annotations, 'categories': categories}
         if outfile is not None:
-            File(outfile).write(data)
+            if writer is None:
+                write_json_stream(data, outfile)
+            else:
+                writer.submit(write_json_stream, data, outfile)
         return data
 
     @classmethod
@@ -181,7 +465,7 @@ class CocoGtData:
         return gt_dict
 
     def get_catname_func(self):
-        id2name = {x['id']: x['name'] for x in self.gt_dict['categories']}
+        id2name = self.gt_index.catid2name
 
         def warpper(cat_id, default=...):
             """
@@ -212,15 +496,24 @@ class CocoGtData:
     def group_gt(self, *, reserve_empty=False):
         """ 遍历gt的每一张图片的标注
 
-        这个是用字典的方式来实现分组，没用 df.groupby 的功能
+        用 gt_index 的CSR分组实现，不用再逐个标注构建字典
 
         :param reserve_empty: 是否保留空im对应的结果
 
         :return: [(im, annos), ...] 每一组是im标注和对应的一组annos标注
+            reserve_empty=False时，图片按在annotations中第一次出现的顺序返回
         """
-        group_anns = defaultdict(list)
-        [group_anns[an['image_id']].append(an) for an in self.gt_dict['annotations']]
-        return self._group_base(group_anns, reserve_empty)
+        index, images, anns = self.gt_index, self.gt_dict['images'], self.gt_dict['annotations']
+        if reserve_empty:
+            for im in images:
+                yield im, [anns[i] for i in index.image_anns(index.id2pos[im['id']]).tolist()]
+        elif len(anns):
+            _, first = np.unique(index.ann_image_ids, return_index=True)
+            for i in np.sort(first).tolist():
+                pos = index.ann_image_pos[i]
+                if pos < 0:
+                    raise KeyError(index.ann_image_ids[i].item())
+                yield images[pos], [anns[j] for j in index.image_anns(pos).tolist()]
 
     def select_gt(self, ids, *, inplace=False):
         """ 删除一些images标注（会删除对应的annotations），挑选数据，或者减小json大小
@@ -229,23 +522,27 @@ class CocoGtData:
             [341427, 'PMC4055390_00006.jpg', ...]
         :return: 筛选出的新字典
         """
-        gt_dict = self.gt_dict
+        gt_dict, index = self.gt_dict, self.gt_index
         # 1 ids 统一为int类型的id值
         if not isinstance(ids, (list, tuple, set)):
             ids = [ids]
-        map_name2id = {item['file_name']: item['id'] for item in gt_dict['images']}
-        ids = set([(map_name2id[x] if isinstance(x, str) else x) for x in ids])
+        names = [x for x in ids if isinstance(x, str)]
+        if names:
+            map_name2id = dict(zip(index.file_names.tolist(), index.image_ids.tolist()))
+            ids = [(map_name2id[x] if isinstance(x, str) else x) for x in ids]
+        ids = np.array(list(set(ids)))
 
         # 2 简化images和annotations
-        dst = {'images': [x for x in gt_dict['images'] if (x['id'] in ids)],
-               'annotations': [x for x in gt_dict['annotations'] if (x['image_id'] in ids)],
+        images, anns = gt_dict['images'], gt_dict['annotations']
+        dst = {'images': [images[i] for i in np.flatnonzero(np.isin(index.image_ids, ids)).tolist()],
+               'annotations': [anns[i] for i in np.flatnonzero(np.isin(index.ann_image_ids, ids)).tolist()],
                'categories': gt_dict['categories']}
         if inplace: self.gt_dict = dst
         return dst
 
     def random_select_gt(self, number=20, *, inplace=False):
         """ 从gt中随机抽出number个数据 """
-        ids = [x['id'] for x in self.gt_dict['images']]
+        ids = self.gt_index.image_ids.tolist()
         random.shuffle(ids)
         gt_dict = self.select_gt(ids[:number])
         if inplace: self.gt_dict = gt_dict
@@ -254,30 +551,40 @@ class CocoGtData:
     def select_gt_by_imdir(self, imdir, *, inplace=False):
         """ 基于imdir目录下的图片来过滤src_json """
         # 1 对比下差异
-        json_images = set([x['file_name'] for x in self.gt_dict['images']])
+        json_images = set(self.gt_index.file_names.tolist())
         dir_images = set(os.listdir(str(imdir)))
 
-        # df = SetCmper({'json_images': json_images, 'dir_images': dir_images}).intersection()
-        # print('json_images intersection dir_images:')
-        # print(df)
-
         # 2 精简json
         gt_dict = self.select_gt(json_images & dir_images)
         if inplace: self.gt_dict = gt_dict
         return gt_dict
 
     def reset_image_id(self, start=1, *, inplace=False):
-        """ 按images顺序对图片重编号 """
-        gt_dict = self.gt_dict if inplace else copy.deepcopy(self.gt_dict)
-        # 1 重置 images 的 id
-        old2new = {}
-        for i, im in enumerate(gt_dict['images'], start=start):
-            old2new[im['id']] = i
-            im['id'] = i
+        """ 按images顺序对图片重编号
 
-        # 2 重置 annotations 的 id
-        for anno in gt_dict['annotations']:
-            anno['image_id'] = old2new[anno['image_id']]
+        inplace=False时不再深拷贝整个gt_dict，只有被修改的image、annotation字典会浅拷贝一份，
+            segmentation等其他数据跟原字典共用
+        """
+        # 1 计算新的图片id，以及每个标注对应的新图片id
+        index = self.gt_index
+        if index.missing_image_id() is not None:
+            raise KeyError(index.missing_image_id())
+        new_ids = np.arange(start, start + len(index.image_ids))
+        ann_new_ids = new_ids[index.ann_image_pos].tolist()
+        new_ids = new_ids.tolist()
+
+        # 2 写入
+        if inplace:
+            gt_dict = self.gt_dict
+            for im, i in zip(gt_dict['images'], new_ids):
+                im['id'] = i
+            for anno, i in zip(gt_dict['annotations'], ann_new_ids):
+                anno['image_id'] = i
+            self.invalidate_index()
+        else:
+            gt_dict = dict(self.gt_dict)
+            gt_dict['images'] = [dict(im, id=i) for im, i in zip(gt_dict['images'], new_ids)]
+            gt_dict['annotations'] = [dict(anno, image_id=i) for anno, i in zip(gt_dict['annotations'], ann_new_ids)]
 
         return gt_dict
 
@@ -288,6 +595,8 @@ class CocoGtData:
 
         for i, anno in enumerate(anns, start=start):
             anno['id'] = i
+        if inplace:
+            self.invalidate_index()
         return anns
 
     def to_labelme(self, root, *, seg=False, prt=False):
@@ -318,7 +627,7 @@ class CocoGtData:
                 imfile = imfiles[0]
 
             # 2.2 数据内容转换
-            lmdict = LabelmeDataset.gen_data(imfile)
+            lmdict = LabelmeDict.gen_data(imfile)
             img = DictTool.or_(img, {'xltype': 'image'})
             lmdict['shapes'].append(LabelmeDict.gen_shape(json.dumps(img, ensure_ascii=False), [[-10, 0], [-5, 0]]))
             for ann in anns:
@@ -347,15 +656,19 @@ class CocoGtData:
 class CocoData(CocoGtData):
     """ 这个类可以封装一些需要gt和dt衔接的功能 """
 
-    def __init__(self, gt, dt=None, *, min_score=0):
+    DT_KEYS = ('image_id', 'category_id', 'bbox', 'score')
+
+    def __init__(self, gt, dt=None, *, min_score=0, cache=False):
         """
         :param gt: gt的dict或文件
             gt是必须传入的，可以只传入gt
             有些任务理论上可以只有dt，但把配套的gt传入，能做更多事
         :param dt: dt的list或文件
         :param min_score: CocoMatch这个系列的类，初始化增加min_score参数，支持直接滤除dt低置信度的框
+        :param cache: gt、dt是文件时，是否使用 read_gt_dict、read_dt_list 的缓存，
+            适合同一份大文件反复分析的场景
         """
-        super().__init__(gt)
+        super().__init__(gt, cache=cache)
 
         def get_dt_list(dt, min_score=0):
             # dt
@@ -369,16 +682,75 @@ class CocoData(CocoGtData):
 
             if not dt:
                 dt_list = default_dt
-            else:
-                dt_list = dt if isinstance(dt, (list, tuple)) else File(dt).read()
+            elif isinstance(dt, (list, tuple)):
+                dt_list = dt
                 if min_score:
                     dt_list = [b for b in dt_list if (b['score'] >= min_score)]
+            else:
+                dt_list = self.read_dt_list(dt, min_score=min_score, cache=cache)
                 if not dt_list:
                     dt_list = default_dt
             return dt_list
 
         self.dt_list = get_dt_list(dt, min_score)
 
+    @classmethod
+    def read_dt_columns(cls, file, *, cache=True):
+        """ 以列存储的格式读取dt的json文件
+
+        :param cache: 是否使用缓存，开启后会在同目录生成 file.npz 的二进制缓存，
+            json文件的修改时间、大小没变时，再次读取直接加载缓存
+        :return: dict，image_id、category_id、score是长度n的数组，bbox是n*4的数组
+            只保留这4个字段，其他自定义字段会被忽略；有框缺少这4个字段之一时，无法存成列格式，返回None
+        """
+        # 1 读缓存
+        cache_file, etag = str(file) + '.npz', _file_etag(file)
+        columns = _read_npz_cache(cache_file, etag) if cache else None
+        if columns is not None:
+            return columns
+
+        # 2 流式解析json，每攒够一批就转成数组，不保留原始的字典
+        keys = set(cls.DT_KEYS)
+        builder = _ColumnBuilder({'image_id': (lambda x: x['image_id'], None, ()),
+                                  'category_id': (lambda x: x['category_id'], None, ()),
+                                  'bbox': (lambda x: x['bbox'], float, (4,)),
+                                  'score': (lambda x: x['score'], float, ())})
+        for x in iter_json_items(file):
+            if not keys <= x.keys():
+                return
+            builder.add(x)
+        columns = builder.result()
+
+        # 3 写缓存
+        if cache:
+            _write_npz_cache(cache_file, etag, columns)
+        return columns
+
+    @classmethod
+    def read_dt_list(cls, file, *, min_score=0, cache=False):
+        """ 读取dt的json文件
+
+        :param cache: 开启后使用 read_dt_columns 的列存储缓存，低于min_score的框在数组层面就直接过滤掉，
+            不会构造对应的字典。注意缓存里bbox统一存成了浮点数，且只保留image_id、category_id、bbox、score字段。
+        """
+        columns = cls.read_dt_columns(file) if cache else None
+        if columns is None:
+            dt_list = File(file).read()
+            if min_score:
+                dt_list = [b for b in dt_list if (b['score'] >= min_score)]
+            return dt_list
+
+        if min_score:
+            keep = columns['score'] >= min_score
+            columns = {k: v[keep] for k, v in columns.items()}
+        return [{'image_id': a, 'category_id': b, 'bbox': c, 'score': d} for a, b, c, d in
+                zip(*[columns[k].tolist() for k in cls.DT_KEYS])]
+
+    @classmethod
+    def write_dt_list(cls, dt_list, outfile):
+        """ 流式写入dt的json文件 """
+        return write_json_stream(dt_list, outfile)
+
     @classmethod
     def is_dt_list(cls, dt_list):
         if not isinstance(dt_list, (tuple, list)):
@@ -492,7 +864,8 @@ class Coco2Labelme(ToLabelmeJson):
 
         # 如果跟labelme的标准字段重名了，需要区分下：比如 label
         std_lm_keys = set('label points group_id shape_type flags'.split())  # labelme的标准字段
-        ks = set(row.index) - std_an_keys
+        # 按列的顺序遍历，保证每次生成的json内容一致
+        ks = [k for k in row.index if k not in std_an_keys]
         for k in ks:
             if k in std_lm_keys:
                 r['_' + k] = row[k]
@@ -640,18 +1013,48 @@ class Coco2Labelme(ToLabelmeJson):
                 self.add_gt_shape(r, get_attrs(attrs))
 
 
+def _to_labelme_task(task):
+    """ 生成一张图片的labelme标注文件
+
+    放在模块层级，是为了能被进程池pickle
+
+    :param task: (imdir, dst_dir, file_name, size, header, anns_func_name, df, kwargs)
+        size是coco images里记录的 (height, width)，为None时才打开图片读取尺寸
+        header是第一个辅助shape的属性，其中的size字段会填上图片尺寸
+    """
+    imdir, dst_dir, file_name, size, header, anns_func_name, df, kwargs = task
+
+    # 1 获得图片文件
+    imfile = File(file_name, imdir)
+    if not imfile:
+        return  # 如果没有图片不处理
+    if dst_dir:
+        imfile = imfile.copy(dst_dir, if_exists='skip')
+
+    # 2 生成这张图片对应的json标注
+    lm = Coco2Labelme(imfile, size=size)
+    height, width = lm.data['imageHeight'], lm.data['imageWidth']
+    header['size'] = f'{height}x{width}'
+    lm.add_shape('', [0, 0, 10, 0], shape_type='line', shape_color=[0, 0, 0], **header)
+    getattr(lm, anns_func_name)(df, **kwargs)
+    lm.write(skip_unchanged=True)  # 保存json文件到img对应目录下，内容没变的文件不重复写入
+
+
 class CocoEval(CocoData):
-    def __init__(self, gt, dt, iou_type='bbox', *, min_score=0, printf=False):
+    def __init__(self, gt, dt, iou_type='bbox', *, min_score=0, printf=False, cache=False):
         """
         TODO coco_gt、coco_dt本来已存储了很多标注信息，有些冗余了，是否可以跟gt_dict、dt_list等整合，去掉些没必要的组件？
+
+        :param cache: 详见 CocoData
         """
-        super().__init__(gt, dt, min_score=min_score)
+        super().__init__(gt, dt, min_score=min_score, cache=cache)
 
         # type
         self.iou_type = iou_type
 
         # evaluater
-        self.coco_gt = COCO(gt, printf=printf)  # 这不需要按图片、类型分类处理
+        # 直接用已读入的gt_dict，gt是文件时不用再解析一遍
+        self.coco_gt = COCO(self.gt_dict, printf=printf)  # 这不需要按图片、类型分类处理
         self.coco_dt, self.evaluater = None, None
         if self.dt_list:
             self.coco_dt = self.coco_gt.loadRes(self.dt_list)  # 这个返回也是coco对象
@@ -687,54 +1090,228 @@ class CocoEval(CocoData):
     def eval(self, img_ids=None, *, printf=False):
         return self.evaluater_eval(self.evaluater, img_ids=img_ids, printf=printf)
 
-    def eval_dt_score(self, step=0.1):
-        """ 计算按一定阈值滤除框后，对coco指标产生的影响 """
-        dt_list = copy.copy(self.dt_list)
+    @classmethod
+    def evaluater_eval_images(cls, et, img_ids=None):
+        """ 只做一次evaluate，拆出每张图片各自的评测中间结果
 
-        i = 0
-        records = []
-        columns = ['≥dt_score', 'n_dt_box', 'coco_score']
+        逐张图片调用 evaluater_eval([image_id]) 的话，每张图都要完整跑一遍 evaluate、accumulate，非常慢。
+        而evaluate算出的evalImgs本来就是按(类别, 面积范围, 图片)划分的，可以直接按图片拆开，
+        再用 eval_imgs_score 算出每张图片的分数。
+
+        :return: {image_id: [evalImg, ...]}，只保留了面积范围为all的结果
+        """
+        if not img_ids:
+            img_ids = et.cocoGt.imgIds.values()
+        et.params.imgIds = list(img_ids)
+        et.evaluate()
+
+        area_all = list(et.params.areaRng[0])
+        res = defaultdict(list)
+        for e in et.evalImgs:
+            if e is not None and list(e['aRng']) == area_all:
+                res[e['image_id']].append(e)
+        return res
+
+    @classmethod
+    def _sorted_matches(cls, eval_imgs, max_det=100):
+        """ COCOeval.accumulate中单个类别的前半部分计算
+
+        :param eval_imgs: 同一类别、面积范围为all的若干张图片的evalImg
+        :return: (dt_scores, tp_sum, fp_sum, npig)
+            dt_scores是从大到小排好序的置信度，tp_sum、fp_sum是对应顺序下的累计数量，形状为 (iou阈值数, 框数)
+            因为已按置信度排序，dt按某个阈值过滤后的结果，就是这些数组的一段前缀
+        """
+        dt_scores = np.concatenate([e['dtScores'][:max_det] for e in eval_imgs])
+        inds = np.argsort(-dt_scores, kind='mergesort')
+        dtm = np.concatenate([e['dtMatches'][:, :max_det] for e in eval_imgs], axis=1)[:, inds]
+        dt_ig = np.concatenate([e['dtIgnore'][:, :max_det] for e in eval_imgs], axis=1)[:, inds]
+        gt_ig = np.concatenate([e['gtIgnore'] for e in eval_imgs])
+        tps = np.logical_and(dtm, np.logical_not(dt_ig))
+        fps = np.logical_and(np.logical_not(dtm), np.logical_not(dt_ig))
+        tp_sum = np.cumsum(tps, axis=1).astype(float)
+        fp_sum = np.cumsum(fps, axis=1).astype(float)
+        return dt_scores[inds], tp_sum, fp_sum, np.count_nonzero(gt_ig == 0)
+
+    @classmethod
+    def _interp_precision(cls, tp_sum, fp_sum, npig, rec_thrs):
+        """ COCOeval.accumulate中单个类别的后半部分计算，插值出各召回率阈值下的精度
+
+        :return: (iou阈值数, 召回率阈值数) 的精度矩阵
+        """
+        rc = tp_sum / npig
+        pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+        pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]  # 精度取右侧的最大值
+        q = np.zeros((len(tp_sum), len(rec_thrs)))
+        for t in range(len(tp_sum)):
+            idxs = np.searchsorted(rc[t], rec_thrs, side='left')
+            valid = idxs < len(rc[t])
+            q[t, valid] = pr[t, idxs[valid]]
+        return q
+
+    @classmethod
+    def eval_imgs_score(cls, eval_imgs, rec_thrs, max_det=100):
+        """ 用一张图片的evalImgs，算出跟 evaluater_eval([image_id]) 相同的分数
+
+        计算过程就是 COCOeval.accumulate 在单张图片上的简化版，结果取 AP@[.5:.95] 的平均精度
+
+        :param eval_imgs: evaluater_eval_images 拆出的某张图片的结果
+        :param rec_thrs: 召回率阈值，即 et.params.recThrs
+        :param max_det: 每张图最多使用的检测框数
+        :return: 没有可以评测的类别时返回-1
+        """
+        precisions = []
+        for e in eval_imgs:
+            _, tp_sum, fp_sum, npig = cls._sorted_matches([e], max_det)
+            if npig:
+                precisions.append(cls._interp_precision(tp_sum, fp_sum, npig, rec_thrs))
+
+        if precisions:
+            # 按 (iou阈值, 召回率阈值, 类别) 的顺序求均值，跟accumulate后的precision数组一致
+            return round(float(np.mean(np.stack(precisions, axis=-1))), 4)
+        else:
+            return -1
+
+    @classmethod
+    def evaluater_eval_scores(cls, et, thresholds):
+        """ dt按不同score阈值过滤后，各自的coco分数
+
+        COCOeval里每个dt的匹配结果，只跟置信度比它高的dt有关，所以evaluate只要在全部dt上做一次，
+        每个阈值的结果，就是按置信度排序后累计数组的一段前缀，不需要每个阈值重新loadRes、evaluate
+
+        :param thresholds: 若干个阈值，保留 score >= 阈值 的框
+        :return: list，每个阈值对应的分数，跟 evaluater_eval 用过滤后的dt算出来的一样
+        """
+        # 1 在全部dt上evaluate一次，按类别汇总各图片的结果
+        et.params.imgIds = list(et.cocoGt.imgIds.values())
+        et.evaluate()
+        p = et.params
+        area_all = list(p.areaRng[0])
+        groups = defaultdict(list)
+        for e in et.evalImgs:
+            if e is not None and list(e['aRng']) == area_all:
+                groups[e['category_id']].append(e)
+        curves = [cls._sorted_matches(v, p.maxDets[-1]) for v in groups.values()]
+        curves = [x for x in curves if x[3]]
+
+        # 2 每个阈值截取前缀计算
+        res = []
+        for t in thresholds:
+            precisions = []
+            for dt_scores, tp_sum, fp_sum, npig in curves:
+                n = np.count_nonzero(dt_scores >= t)
+                precisions.append(cls._interp_precision(tp_sum[:, :n], fp_sum[:, :n], npig, p.recThrs))
+            res.append(round(float(np.mean(np.stack(precisions, axis=-1))), 4) if precisions else -1)
+        return res
+
+    def _dt_score_thresholds(self, step=0.1):
+        """ 从0开始，每次增加step，直到1或者没有框剩下 """
+        scores = np.array([x['score'] for x in self.dt_list], dtype=float)
+        i, res = 0, []
         while i < 1:
-            dt_list = [x for x in dt_list if x['score'] >= i]
-            if not dt_list: break
-            coco_dt = self.coco_gt.loadRes(dt_list)
-            evaluater = COCOeval(self.coco_gt, coco_dt, self.iou_type)
-            records.append([i, len(dt_list), self.evaluater_eval(evaluater)])
+            if not np.count_nonzero(scores >= i): break
+            res.append(i)
             i += step
+        return res
+
+    def eval_dt_score(self, step=0.1):
+        """ 计算按一定阈值滤除框后，对coco指标产生的影响
+
+        :param step: 阈值的步长，coco的evaluate只做一次，可以设得很细，比如0.01
+        """
+        thresholds = self._dt_score_thresholds(step)
+        scores = np.array([x['score'] for x in self.dt_list], dtype=float)
+        columns = ['≥dt_score', 'n_dt_box', 'coco_score']
+        coco_scores = self.evaluater_eval_scores(self.evaluater, thresholds) if thresholds else []
+        records = [[t, np.count_nonzero(scores >= t), v] for t, v in zip(thresholds, coco_scores)]
         df = pd.DataFrame.from_records(records, columns=columns)
         return df
 
     def parse_dt_score(self, step=0.1, *, printf=False):
         """ dt按不同score过滤后效果
 
-        注意如果数据集很大，这个功能运算特别慢，目前测试仅20张图都要10秒
-        可以把printf=True打开观察中间结果
+        框的iou、coco的evaluate、icdar的面积矩阵都只在全部dt上算一次；
+        coco分数是在按置信度排好序的累计数组上截取前缀计算；
+        框匹配、icdar测评则是增量更新，相邻两个阈值之间，只有存在dt分数落在两者之间的图片需要重新计算，
+        所以step可以设得很细，比如0.01，也能处理上千张图片的数据
 
-        注意这个方法，需要调用后面的 CocoMatch
+        注意这个方法，需要用到后面的 CocoParser
         """
-        gt_dict, dt_list = self.gt_dict, self.dt_list
+        from sklearn.metrics import f1_score
+        from pyxllib.data.icdar.icdar2013 import default_evaluation_params
+        from pyxllib.data.icdar.wolf import evaluate_score_sweep
 
-        i = 0
-        records = []
         columns = ['≥dt_score', 'n_dt_box', 'n_match_box', 'n_matchcat_box',
                    'coco_score',
                    'icdar2013', 'ic13_precision', 'ic13_recall',
                    'f1_score']
+        thresholds = self._dt_score_thresholds(step)
+        if not thresholds:
+            return pd.DataFrame(columns=columns)
+        cp = self if isinstance(self, CocoParser) else CocoParser(self.gt_dict, self.dt_list)
+
+        # 1 框匹配的候选对，同CocoMatch的匹配规则
+        gt_idx, dt_idx, rows, cols, ious = cp._get_iou_pairs()
+        scores = np.array([x['score'] for x in cp.dt_list], dtype=float)
+        dt_scores = scores[dt_idx]
+        # 每个候选对的类别、dt分数、所在图片，以及保留4位小数后的iou
+        pair_gt_cats = cp.gt_anns['gt_category_id'].to_numpy()[gt_idx][rows]
+        pair_dt_cats = cp.dt_anns['dt_category_id'].to_numpy()[dt_idx][cols]
+        pair_scores = dt_scores[cols]
+        pair_images = cp.images.index.get_indexer(cp.dt_anns['image_id'].iloc[dt_idx])[cols]
+        pair_ious = np.array([round(v, 4) for v in ious.tolist()])
+        pair_keys = rows.astype(np.int64) * (len(dt_idx) + 1) + cols
+        key_order = np.argsort(pair_keys)
+
+        # 2 coco分数
+        coco_scores = self.evaluater_eval_scores(cp.evaluater, thresholds)
+
+        # 3 icdar2013分数，同 to_icdareval_data 的分组方式
+        gt, dt, dt_score = defaultdict(list), defaultdict(list), defaultdict(list)
+        for x in cp.gt_dict['annotations']:
+            gt[f"{x['image_id']},{x['category_id']}"].append(cp.bbox2ltrb(x['bbox']))
+        for x in cp.dt_list:
+            k = f"{x['image_id']},{x['category_id']}"
+            dt[k].append(cp.bbox2ltrb(x['bbox']))
+            dt_score[k].append(x['score'])
+        ic13s = evaluate_score_sweep(gt, dt, dt_score, thresholds, default_evaluation_params())
+
+        # 4 汇总每个阈值的结果
+        # 贪心匹配只有同一张图片的候选对之间会相互影响，所以只需要重新匹配保留的dt有变化的图片
+        selected = np.zeros(len(rows), dtype=bool)  # 当前阈值下，每个候选对是否被选为匹配结果
+        records, prev = [], None
         if printf: print(columns)
-        while i < 1:
-            dt_list = [x for x in dt_list if x['score'] >= i]
-            if not dt_list: break
-            cm = CocoMatch(gt_dict, dt_list, eval_im=False)
-
-            ie = IcdarEval(*cm.to_icdareval_data())
-            ic13 = ie.icdar2013()
-
-            row = [i, cm.n_dt_box(), cm.n_match_box(), cm.n_matchcat_box(),
-                   cm.eval(), ic13['hmean'], ic13['precision'], ic13['recall'], cm.f1_score()]
+        for t, coco_score, ic13 in zip(thresholds, coco_scores, ic13s):
+            # 4.1 更新匹配结果
+            if prev is None:
+                redo = np.ones(len(rows), dtype=bool)
+            else:
+                lo, hi = min(prev, t), max(prev, t)
+                redo = np.isin(pair_images, pair_images[(pair_scores >= lo) & (pair_scores < hi)])
+            prev = t
+            selected[redo] = False
+            keep = redo & (pair_scores >= t)
+            pairs = np.array(greedy_matchpairs(rows[keep], cols[keep], ious[keep]), dtype=int).reshape(-1, 3)
+            if len(pairs):
+                keys = pairs[:, 0].astype(np.int64) * (len(dt_idx) + 1) + pairs[:, 1]
+                selected[key_order[np.searchsorted(pair_keys, keys, sorter=key_order)]] = True
+
+            # 4.2 统计
+            match = selected & (pair_ious >= 0.5)
+            sel = selected & (pair_ious >= sys.float_info.epsilon)
+            if sel.any():
+                # 相同的(gt类别, dt类别)合并成一条带权重的样本，结果跟逐个传入一样
+                labels, counts = np.unique(np.stack([pair_gt_cats[sel], pair_dt_cats[sel]], axis=1), axis=0,
+                                           return_counts=True)
+                f1 = round(f1_score(labels[:, 0].tolist(), labels[:, 1].tolist(), average='weighted',
+                                    sample_weight=counts), 4)
+            else:
+                f1 = -1
 
+            row = [t, np.count_nonzero(dt_scores >= t), np.count_nonzero(match),
+                   np.count_nonzero(match & (pair_gt_cats == pair_dt_cats)),
+                   coco_score, round(ic13['hmean'], 4), round(ic13['precision'], 4), round(ic13['recall'], 4), f1]
             if printf: print(row)
             records.append(row)
-            i += step
         df = pd.DataFrame.from_records(records, columns=columns)
 
         if printf:
@@ -746,11 +1323,11 @@ class CocoEval(CocoData):
 
 
 class CocoParser(CocoEval):
-    def __init__(self, gt, dt=None, iou_type='bbox', *, min_score=0, printf=False):
+    def __init__(self, gt, dt=None, iou_type='bbox', *, min_score=0, printf=False, cache=False):
         """ coco格式相关分析工具，dt不输入也行，当做没有任何识别结果处理~~
             相比CocoMatch比较轻量级，不会初始化太久，但提供了一些常用的基础功能
         """
-        super().__init__(gt, dt, iou_type, min_score=min_score, printf=printf)
+        super().__init__(gt, dt, iou_type, min_score=min_score, printf=printf, cache=cache)
         # gt里的images、categories数据，已转成df表格格式
         self.images, self.categories = self._get_images_df(), self._get_categories_df()
         # gt、dt的统计表
@@ -786,8 +1363,12 @@ class CocoParser(CocoEval):
         df = pd.DataFrame.from_dict(self.gt_dict['annotations'])
 
         # 2 构建完整表格信息
-        df['gt_ltrb'] = [self.bbox2ltrb(b) for b in df['bbox']]
-        df['area'] = [int(round(v, 0)) for v in df['area']]
+        # 跟 bbox2ltrb 一样四舍六入取整，直接用 gt_index 里的数组计算
+        index = self.gt_index
+        ltrb = index.bboxes.copy()
+        ltrb[:, 2:] += ltrb[:, :2]
+        df['gt_ltrb'] = np.round(ltrb).astype(int).tolist()
+        df['area'] = np.round(index.areas).astype(int).tolist()
         df.rename(columns={'id': 'gt_box_id', 'category_id': 'gt_category_id',
                            'area': 'gt_area', 'segmentation': 'gt_segmentation'}, inplace=True)
 
@@ -812,6 +1393,24 @@ class CocoParser(CocoEval):
         else:
             return pd.DataFrame(columns=columns)
 
+    def _get_iou_pairs(self):
+        """ 同一张图片里gt、dt框两两之间的iou，只保留iou>0的对
+
+        框所在图片不在images中的不处理
+
+        :return: gt_idx, dt_idx, rows, cols, ious
+            gt_idx、dt_idx是参与计算的框在gt_anns、dt_anns中的下标
+            rows、cols是iou>0的框对，分别在gt_idx、dt_idx中的下标
+        """
+        image_ids = self.images.index
+        gt_pos = image_ids.get_indexer(self.gt_anns['image_id'])
+        dt_pos = image_ids.get_indexer(self.dt_anns['image_id'])
+        gt_idx, dt_idx = np.flatnonzero(gt_pos >= 0), np.flatnonzero(dt_pos >= 0)
+        rows, cols, ious = ComputeIou.ltrb_group_sparse(self.gt_anns['gt_ltrb'].iloc[gt_idx].to_list(),
+                                                        self.dt_anns['dt_ltrb'].iloc[dt_idx].to_list(),
+                                                        gt_pos[gt_idx], dt_pos[dt_idx])
+        return gt_idx, dt_idx, rows, cols, ious
+
     def to_icdareval_data(self, *, min_score=0.):
         """ 转成可供IcdarEval测评的数据格式
 
@@ -858,40 +1457,55 @@ class CocoParser(CocoEval):
             gt_anns.to_excel(writer, sheet_name='gt_anns', freeze_panes=(1, 0))
             self.dt_anns.to_excel(writer, sheet_name='dt_anns', freeze_panes=(1, 0))
 
-    def to_labelme_gt(self, imdir, dst_dir=None, *, segmentation=False, max_workers=4):
-        """ 在图片目录里生成图片的可视化json配置文件
+    def _add_labelme_columns(self, df, parts=('gt',)):
+        """ 为了方便labelme操作，扩展文件名、类别名等几列内容
 
-        :param segmentation: 是否显示分割效果
+        都是用数组整体查表，不逐行loc
         """
+        df['file_name'] = self.images['file_name'].loc[df['image_id']].to_numpy()
+        for part in parts:
+            df[f'{part}_category_name'] = self.categories['name'].loc[df[f'{part}_category_id']].to_numpy()
+        df['gt_supercategory'] = self.categories['supercategory'].loc[df['gt_category_id']].to_numpy()
+        return df
 
-        def func(g):
-            # 1 获得图片id和文件
-            image_id, df = g
-            imfile = File(df.iloc[0]['file_name'], imdir)
-            if not imfile:
-                return  # 如果没有图片不处理
-
-            # 2 生成这张图片对应的json标注
-            if dst_dir:
-                imfile = imfile.copy(dst_dir, if_exists='skip')
-            lm = Coco2Labelme(imfile)
-            height, width = lm.img.size()  # 也可以用image['height'], image['width']获取
-            # 注意df取出来的image_id默认是int64类型，要转成int，否则json会保存不了int64类型
-            lm.add_shape('', [0, 0, 10, 0], shape_type='line', shape_color=[0, 0, 0],
-                         n_gt_box=len(df), image_id=int(image_id),
-                         size=f'{height}x{width}')
-            lm.anns_gt(df, segmentation=segmentation)
-            lm.write()  # 保存json文件到img对应目录下
+    def _image_sizes(self):
+        """ images表里记录的图片尺寸 {image_id: (height, width)}，没有记录的图片不在字典里 """
+        if not {'height', 'width'} <= set(self.images.columns):
+            return {}
+        df = self.images[['height', 'width']].dropna()
+        return dict(zip(df.index.tolist(), zip(df['height'].astype(int).tolist(), df['width'].astype(int).tolist())))
 
+    @classmethod
+    def _run_labelme_tasks(cls, tasks, desc, max_workers, backend='thread'):
+        """ 并行生成labelme文件，max_workers=1时直接在当前线程运行 """
+        results = parallel_map(_to_labelme_task, tasks, max_workers, backend=backend,
+                               chunksize=auto_chunksize(len(tasks), max_workers))
+        for _ in tqdm(results, desc, total=len(tasks)):
+            pass
+
+    def to_labelme_gt(self, imdir, dst_dir=None, *, segmentation=False, max_workers=4, backend='thread'):
+        """ 在图片目录里生成图片的可视化json配置文件
+
+        图片尺寸优先使用images里记录的height、width，不用打开图片；
+        内容没有变化的json文件不会重复写入
+
+        :param segmentation: 是否显示分割效果
+        :param max_workers: 并发数
+        :param backend: 默认用线程池；图片多、要打开图片读尺寸时，可以用'process'开进程池
+        """
         if dst_dir:
             dst_dir = Dir(dst_dir)
             dst_dir.ensure_dir()
-        gt_anns = self.gt_anns.copy()
-        # 为了方便labelme操作，需要扩展几列内容
-        gt_anns['file_name'] = [self.images.loc[x, 'file_name'] for x in gt_anns['image_id']]
-        gt_anns['gt_category_name'] = [self.categories.loc[x, 'name'] for x in gt_anns['gt_category_id']]
-        gt_anns['gt_supercategory'] = [self.categories.loc[x, 'supercategory'] for x in gt_anns['gt_category_id']]
-        mtqdm(func, list(gt_anns.groupby('image_id').__iter__()), 'create labelme gt jsons', max_workers=max_workers)
+        gt_anns = self._add_labelme_columns(self.gt_anns.copy())
+        sizes = self._image_sizes()
+
+        tasks = []
+        for image_id, df in gt_anns.groupby('image_id'):
+            # 注意df取出来的image_id默认是int64类型，要转成int，否则json会保存不了int64类型
+            header = {'n_gt_box': len(df), 'image_id': int(image_id), 'size': None}
+            tasks.append((imdir, dst_dir, df['file_name'].iloc[0], sizes.get(image_id), header, 'anns_gt', df,
+                          {'segmentation': segmentation}))
+        self._run_labelme_tasks(tasks, 'create labelme gt jsons', max_workers, backend)
 
 
 class CocoMatchBase:
@@ -966,38 +1580,57 @@ class CocoMatchBase:
         return df
 
 
+def _eval_image_scores(task):
+    """ 计算单张图片的coco分数和ic13分数
+
+    放在模块层级，是为了能被进程池pickle
+
+    :param task: (eval_imgs, rec_thrs, max_det, gt, dt)
+        eval_imgs为None时，不计算coco分数
+    :return: (coco_score, ic13_score)
+    """
+    eval_imgs, rec_thrs, max_det, gt, dt = task
+    coco_score = -1 if eval_imgs is None else CocoEval.eval_imgs_score(eval_imgs, rec_thrs, max_det)
+    return coco_score, IcdarEval(gt, dt).icdar2013()['hmean']
+
+
 class CocoMatch(CocoParser, CocoMatchBase):
-    def __init__(self, gt, dt=None, *, min_score=0, eval_im=True, printf=False):
+    def __init__(self, gt, dt=None, *, min_score=0, eval_im=True, printf=False, max_workers=1, cache=False):
         """ coco格式相关分析工具，dt不输入也行，当做没有任何识别结果处理~~
 
         :param min_score: 滤除dt中score小余min_score的框
         :param eval_im: 是否对每张图片计算coco分数
+        :param max_workers: eval_im时，逐图片计算分数使用的进程数，1表示不开进程池，直接在当前进程计算
+        :param cache: gt、dt是文件时，是否使用读取缓存，详见 CocoData
         """
         # 因为这里 CocoEval、_CocoMatchBase 都没有父级，不会出现初始化顺序混乱问题
         #   所以我直接指定类初始化顺序了，没用super
-        CocoParser.__init__(self, gt, dt, min_score=min_score)
+        CocoParser.__init__(self, gt, dt, min_score=min_score, cache=cache)
         match_anns = self._get_match_anns_df(printf=printf)
         CocoMatchBase.__init__(self, match_anns)
-        self.images = self._get_match_images_df(eval_im=eval_im, printf=printf)
+        self.images = self._get_match_images_df(eval_im=eval_im, printf=printf, max_workers=max_workers)
         self.categories = self._get_match_categories_df()
 
     def _get_match_anns_df(self, *, printf=False):
         """ 将结果的dt框跟gt的框做匹配，注意iou非常低的情况也会匹配上
 
+        这里没有逐图片、逐框地遍历df，而是按列处理：
+            所有图片的gt、dt框对的iou一次批量算出（ComputeIou.ltrb_group_sparse），
+            再在整个数据集的候选对上做一次贪心匹配，最后用下标数组一次性拼出整个匹配表。
+        结果跟逐图片调用 matchpairs(..., ComputeIou.ltrb) 是一样的。
+
         TODO 有些框虽然没匹配到，但并不是没有iou，只是被其他iou更高的框抢掉了而已，可以考虑新增一个实际最大iou值列
         TODO 这里有个隐患，我找不到的框是用-1的类id来标记。但如果coco数据里恰好有个-1标记的类，就暴雷了~~
         TODO 210512周三11:27，目前新增扩展了label，这个是采用白名单机制加的，后续是可以考虑用黑名单机制来设定
         """
-        from tqdm import tqdm
-
         # 1 读取数据
-        gt_df, dt_df = self.gt_anns.groupby('image_id'), self.dt_anns.groupby('image_id')
+        gt_anns, dt_anns = self.gt_anns, self.dt_anns
+        image_ids = self.images.index
 
         # 2 初始化
-        records = []
         gt_columns = ['gt_box_id', 'gt_category_id', 'gt_ltrb', 'gt_area']
         gt_default = [-1, -1, '', 0]  # 没有配对项时填充的默认值
-        if 'label' in self.gt_anns.columns:
+        if 'label' in gt_anns.columns:
             gt_columns.append('label')
             gt_default.append('')
 
@@ -1006,102 +1639,100 @@ class CocoMatch(CocoParser, CocoMatchBase):
 
         columns = ['image_id'] + gt_columns + ['iou'] + dt_columns
 
-        def gt_msg(x=None):
-            if x is None:
-                return [image_id] + gt_default
-            else:
-                return [image_id] + [x[k] for k in gt_columns]
-
-        def dt_msg(y=None, iou_score=0):
-            if y is None:
-                return [0] + dt_default
-            else:
-                return [round(iou_score, 4)] + [y[k] for k in dt_columns]
-
-        # 3 遍历匹配
-        for image_id, image in tqdm(self.images.iterrows(),
-                                    f'_get_match_anns_df, groups={len(self.images)}', disable=not printf):
-            # 3.1 计算匹配项
-            # gt和dt关于某张图都有可能没有框
-            # 比如合同检测，有的图可能什么类别对象都没有，gt中这张图本来就没有box；dt检测也是，某张图不一定有结果
-            gt_group_df = gt_df.get_group(image_id) if image_id in gt_df.groups else []
-            dt_group_df = dt_df.get_group(image_id) if image_id in dt_df.groups else []
-            n, m = len(gt_group_df), len(dt_group_df)
-
-            pairs = []
-            if n and m:
-                # 任意多边形相交面积算法速度太慢
-                # gt_bboxes = [ShapelyPolygon.gen(b) for b in gt_group_df['gt_ltrb']]  # noqa 已经用if做了判断过滤
-                # dt_bboxes = [ShapelyPolygon.gen(b) for b in dt_group_df['dt_ltrb']]  # noqa
-                # pairs = matchpairs(gt_bboxes, dt_bboxes, ComputeIou.polygon2, index=True)
-
-                # 改成ltrb的相交面积算法会快一点
-                # gt_bboxes = [ShapelyPolygon.gen(b) for b in gt_group_df['gt_ltrb']]  # noqa 已经用if做了判断过滤
-                # dt_bboxes = [ShapelyPolygon.gen(b) for b in dt_group_df['dt_ltrb']]  # noqa
-                pairs = matchpairs(gt_group_df['gt_ltrb'].to_list(), dt_group_df['dt_ltrb'].to_list(),
-                                   ComputeIou.ltrb, index=True)
-
-            # 3.2 按gt顺序存入每条信息
-            dt_ids = set(range(m))
-            match_ids = {p[0]: (p[1], p[2]) for p in pairs}
-            for i in range(n):
-                x = gt_group_df.iloc[i]
-                if i in match_ids:
-                    # 3.2.1 gt与dt匹配的box
-                    j, iou_score = match_ids[i]
-                    dt_ids.remove(j)
-                    records.append(gt_msg(x) + dt_msg(dt_group_df.iloc[j], iou_score))
-                else:
-                    # 3.2.2 有gt没有对应dt的box
-                    records.append(gt_msg(x) + dt_msg())
-
-            # 3.2.3 还有剩余未匹配到的dt也要记录
-            for j in dt_ids:
-                records.append(gt_msg() + dt_msg(dt_group_df.iloc[j]))
-
-        # 4 保存结果
-        return pd.DataFrame.from_records(records, columns=columns)
-
-    def _get_match_images_df(self, *, eval_im=True, printf=False):
-        """ 在原有images基础上，扩展一些图像级别的识别结果情况数据 """
+        # 3 批量匹配
+        gt_pos = image_ids.get_indexer(gt_anns['image_id'])
+        dt_pos = image_ids.get_indexer(dt_anns['image_id'])
+        gt_idx, dt_idx, rows, cols, ious = self._get_iou_pairs()
+        pairs = np.array(greedy_matchpairs(rows, cols, ious), dtype=float).reshape(-1, 3)
+        rows, cols = gt_idx[pairs[:, 0].astype(int)], dt_idx[pairs[:, 1].astype(int)]
+        gt_match = np.full(len(gt_anns), -1)
+        gt_match[rows] = cols
+        gt_iou = np.zeros(len(gt_anns))
+        gt_iou[rows] = [round(v, 4) for v in pairs[:, 2].tolist()]  # 跟python的round保持一致，np.round偶尔会差一位
+        dt_matched = np.zeros(len(dt_anns), dtype=bool)
+        dt_matched[cols] = True
+
+        # 4 确定输出顺序：每张图片先按gt顺序存入每条信息，然后是剩余未匹配到的dt
+        dt_idx = dt_idx[~dt_matched[dt_idx]]
+        pos = np.concatenate([gt_pos[gt_idx], dt_pos[dt_idx]])
+        is_dt = np.concatenate([np.zeros(len(gt_idx), dtype=bool), np.ones(len(dt_idx), dtype=bool)])
+        order = np.lexsort((is_dt, pos))  # lexsort是稳定排序，同一部分内会保持原始顺序
+        pos, is_dt = pos[order], is_dt[order]
+        out_gt = np.concatenate([gt_idx, np.full(len(dt_idx), -1)])[order]
+        out_dt = np.concatenate([gt_match[gt_idx], dt_idx])[order]
+        out_iou = np.concatenate([gt_iou[gt_idx], np.zeros(len(dt_idx))])[order]
+
+        # 5 用下标数组拼出结果表
+        def take(df, col, idx, default):
+            values = df[col].to_numpy()
+            res = values[np.maximum(idx, 0)] if len(values) else np.empty(len(idx), dtype=object)
+            return pd.Series(res).where(idx >= 0, default).to_numpy()
+
+        data = {'image_id': image_ids.to_numpy()[pos]}
+        for k, v in zip(gt_columns, gt_default):
+            data[k] = take(gt_anns, k, out_gt, v)
+        data['iou'] = out_iou
+        for k, v in zip(dt_columns, dt_default):
+            data[k] = take(dt_anns, k, out_dt, v)
+        return pd.DataFrame(data, columns=columns)
+
+    def _get_match_images_df(self, *, eval_im=True, printf=False, max_workers=1):
+        """ 在原有images基础上，扩展一些图像级别的识别结果情况数据
+
+        各项统计值都是先存到预分配好的数组里，最后整列写入images，没有逐行的 .loc 写入
+
+        :param max_workers: 计算coco、ic13分数的进程数
+        """
         # 1 初始化，新增字段
-        images, match_anns = self.images.copy(), self.match_anns.groupby('image_id')
+        images, match_anns = self.images.copy(), self.match_anns
         columns = ['coco_score', 'n_gt_box', 'n_dt_box', 'n_match0.5_box', 'n_matchcat0.5_box', 'f1_micro0.5',
                    'ic13_score']
+        values = {c: np.full(len(images), -1.0) for c in columns}
+
+        # 2 框匹配数量，按图片分组一次性统计
+        gt_cat, dt_cat = match_anns['gt_category_id'], match_anns['dt_category_id']
+        match = match_anns['iou'] >= 0.5
+        df = pd.DataFrame({'n_gt_box': gt_cat != -1, 'n_dt_box': dt_cat != -1,
+                           'n_match0.5_box': match, 'n_matchcat0.5_box': match & gt_cat.eq(dt_cat)})
+        df = df.groupby(match_anns['image_id']).sum()
+        pos = images.index.get_indexer(df.index)
+        df, pos = df[pos >= 0], pos[pos >= 0]
+        for c in df.columns:
+            values[c][pos] = df[c]
+        # 单标签多分类的f1_micro，等价于匹配框里的类别正确率
+        values['f1_micro0.5'][pos] = [(round(b / a, 4) if a else -1)
+                                      for a, b in zip(df['n_match0.5_box'], df['n_matchcat0.5_box'])]
+
+        # 3 每张图片的coco分数、ic13分数
+        if eval_im:
+            # 3.1 coco的evaluate只做一次，再按图片拆分
+            if self.evaluater is not None:
+                et = self.evaluater
+                eval_imgs = self.evaluater_eval_images(et, images.index.to_list())
+                rec_thrs, max_det = et.params.recThrs, et.params.maxDets[-1]
+            else:
+                eval_imgs, rec_thrs, max_det = None, None, None
+
+            # 3.2 ic13需要的数据，按图片、类别分组，多个ltrb值存成list
+            gts, dts = defaultdict(dict), defaultdict(dict)
+            for (image_id, cat_id), ltrbs in match_anns[gt_cat != -1].groupby(['image_id', 'gt_category_id'])['gt_ltrb']:
+                gts[image_id][cat_id] = list(ltrbs)
+            for (image_id, cat_id), ltrbs in match_anns[dt_cat != -1].groupby(['image_id', 'dt_category_id'])['dt_ltrb']:
+                dts[image_id][cat_id] = list(ltrbs)
+
+            # 3.3 逐图片计算，可以开进程池
+            image_ids = images.index[pos].to_list()
+            tasks = [(None if eval_imgs is None else eval_imgs.get(x, []), rec_thrs, max_det, gts[x], dts[x])
+                     for x in image_ids]
+            results = parallel_map(_eval_image_scores, tasks, max_workers, backend='process',
+                                   chunksize=auto_chunksize(len(tasks), max_workers))
+            results = list(tqdm(results, '_get_match_images_df', total=len(tasks), disable=not printf))
+            if results:
+                values['coco_score'][pos], values['ic13_score'][pos] = zip(*results)
+
+        # 4 整列写入
         for c in columns:
-            images[c] = -1.0
-
-        # 2 填写扩展字段的值
-        for image_id in tqdm(images.index, '_get_match_images_df', disable=not printf):
-            # 2.1 跳过不存在的图
-            if image_id not in match_anns.groups:
-                continue
-            df = match_anns.get_group(image_id)
-
-            # 2.2 增加每张图片的coco分数
-            if eval_im:
-                images.loc[image_id, 'coco_score'] = self.eval([image_id])
-
-            # 2.3 增加每张图片的多分类分数
-            m = CocoMatchBase(df)
-            images.loc[image_id, 'n_gt_box'] = m.n_gt_box()
-            images.loc[image_id, 'n_dt_box'] = m.n_dt_box()
-            images.loc[image_id, 'n_match0.5_box'] = m.n_match_box(0.5)
-            images.loc[image_id, 'n_matchcat0.5_box'] = m.n_matchcat_box(0.5)
-            images.loc[image_id, 'f1_micro0.5'] = m.f1_score('micro', 0.5)
-
-            # 2.4 增加每张图片的ic13分数
-            # df要先按category_id分组，多个ltrb值存成list
-            if eval_im:
-                gt, dt = dict(), dict()
-                for key, items in df.groupby('gt_category_id'):
-                    if key != -1:
-                        gt[key] = list(items['gt_ltrb'])
-                for key, items in df.groupby('dt_category_id'):
-                    if key != -1:
-                        dt[key] = list(items['dt_ltrb'])
-                images.loc[image_id, 'ic13_score'] = IcdarEval(gt, dt).icdar2013()['hmean']
-
+            images[c] = values[c]
         return images
 
     def _get_match_categories_df(self):
@@ -1177,49 +1808,35 @@ class CocoMatch(CocoParser, CocoMatchBase):
                              'match_anns': self.match_anns})
 
     def _to_labelme_match(self, match_func_name, imdir, dst_dir=None, *, segmentation=False, hide_match_dt=False,
-                          **kwargs):
+                          max_workers=8, backend='thread', **kwargs):
         """ 可视化目标检测效果
 
         :param imdir: 默认会把结果存储到imdir
         :param dst_dir: 但如果写了dst_dir参数，则会有选择地从imdir筛选出图片到dst_dir
+        :param max_workers: 并发数
+        :param backend: 详见 to_labelme_gt
         """
-
-        def func(g):
-            # 1 获得图片id和文件
-            image_id, df = g
-            imfile = File(df.iloc[0]['file_name'], imdir)
-            if not imfile:
-                return  # 如果没有图片不处理
-            image = self.images.loc[image_id]
-            image = image.drop(['file_name', 'height', 'width'])
-
-            # 2 生成这张图片对应的json标注
-            if dst_dir:
-                imfile = imfile.copy(dst_dir, if_exists='skip')
-            lm = Coco2Labelme(imfile)
-
-            height, width = lm.data['imageHeight'], lm.data['imageWidth']
-            # 注意df取出来的image_id默认是int64类型，要转成int，否则json会保存不了int64类型
-            lm.add_shape('', [0, 0, 10, 0], shape_type='line', shape_color=[0, 0, 0],
-                         size=f'{height}x{width}', **(image.to_dict()))
-            getattr(lm, match_func_name)(df, segmentation=segmentation, hide_match_dt=hide_match_dt, **kwargs)
-            lm.write()  # 保存json文件到img对应目录下
-
         if dst_dir is not None:
             dst_dir = Dir(dst_dir)
             dst_dir.ensure_dir()
-        match_anns = self.match_anns.copy()
-        # 为了方便labelme操作，需要扩展几列内容
-        match_anns['file_name'] = [self.images.loc[x, 'file_name'] for x in match_anns['image_id']]
-        match_anns['gt_category_name'] = [self.categories.loc[x, 'name'] for x in match_anns['gt_category_id']]
-        match_anns['dt_category_name'] = [self.categories.loc[x, 'name'] for x in match_anns['dt_category_id']]
-        match_anns['gt_supercategory'] = [self.categories.loc[x, 'supercategory'] for x in match_anns['gt_category_id']]
-        mtqdm(func, list(iter(match_anns.groupby('image_id'))), max_workers=8, desc='make labelme json:')
-
-    def to_labelme_match(self, imdir, dst_dir=None, *, segmentation=False, hide_match_dt=False):
-        self._to_labelme_match('anns_match', imdir, dst_dir, segmentation=segmentation, hide_match_dt=hide_match_dt)
+        match_anns = self._add_labelme_columns(self.match_anns.copy(), ('gt', 'dt'))
+        sizes = self._image_sizes()
+        images = self.images.drop(['file_name', 'height', 'width'], axis=1, errors='ignore')
+        kwargs.update(segmentation=segmentation, hide_match_dt=hide_match_dt)
+
+        tasks = []
+        for image_id, df in match_anns.groupby('image_id'):
+            header = {'size': None, **images.loc[image_id].to_dict()}
+            tasks.append((imdir, dst_dir, df['file_name'].iloc[0], sizes.get(image_id), header, match_func_name, df,
+                          kwargs))
+        self._run_labelme_tasks(tasks, 'make labelme json:', max_workers, backend)
+
+    def to_labelme_match(self, imdir, dst_dir=None, *, segmentation=False, hide_match_dt=False, max_workers=8,
+                         backend='thread'):
+        self._to_labelme_match('anns_match', imdir, dst_dir, segmentation=segmentation, hide_match_dt=hide_match_dt,
+                               max_workers=max_workers, backend=backend)
 
     def to_labelme_match2(self, imdir, dst_dir=None, *, segmentation=False, hide_match_dt=False,
-                          colormap=LABEL_COLORMAP7):
+                          colormap=LABEL_COLORMAP7, max_workers=8, backend='thread'):
         self._to_labelme_match('anns_match2', imdir, dst_dir, segmentation=segmentation, hide_match_dt=hide_match_dt,
-                               colormap=colormap)
+                               colormap=colormap, max_workers=max_workers, backend=backend)
@@ -9,6 +9,7 @@
 官方原版处理两个 zip 文件，这里扩展支持目录、内存对象
 """
 
+import functools
 import re
 
 from pyxllib.xl import File, Dir, shorten
@@ -74,23 +75,44 @@ class IcdarEval:
         else:
             raise TypeError(shorten(label))
 
-    def _eval(self, evaluate_method, default_evaluation_params, update_params):
+    def _eval(self, evaluate_method, default_evaluation_params, update_params, per_sample=False):
         eval_params = default_evaluation_params()
         if update_params:
             eval_params.update(update_params)
         eval_data = evaluate_method(self.gt, self.dt, eval_params)
         # eval_data字典还存有'per_sample'的每张图片详细数据
         res = {k: round(v, 4) for k, v in eval_data['method'].items()}  # 只保留4位小数，看起来比较舒服
+        if per_sample:
+            res['per_sample'] = eval_data['per_sample']
         return res
 
-    def icdar2013(self, params=None):
-        from pyxllib.data.icdar.icdar2013 import evaluate_method, default_evaluation_params
-        return self._eval(evaluate_method, default_evaluation_params, params)
+    def icdar2013(self, params=None, *, max_workers=1, per_sample=False):
+        """ icdar2013测评，使用的是数组化的实现 wolf.evaluate_method，结果跟官方原版 icdar2013.py 相同
 
-    def deteval(self, params=None):
-        from pyxllib.data.icdar.deteval import evaluate_method, default_evaluation_params
-        return self._eval(evaluate_method, default_evaluation_params, params)
+        :param max_workers: 逐图测评使用的进程数
+        :param per_sample: 是否在结果中附带每张图片的详细数据
+        """
+        from pyxllib.data.icdar.icdar2013 import default_evaluation_params
+        from pyxllib.data.icdar.wolf import evaluate_method
+        return self._eval(functools.partial(evaluate_method, max_workers=max_workers),
+                          default_evaluation_params, params, per_sample)
+
+    def deteval(self, params=None, *, max_workers=1, per_sample=False):
+        """ deteval测评，参数同icdar2013 """
+        from pyxllib.data.icdar.deteval import default_evaluation_params
+        from pyxllib.data.icdar.wolf import evaluate_method
+        return self._eval(functools.partial(evaluate_method, deteval=True, max_workers=max_workers),
+                          default_evaluation_params, params, per_sample)
+
+    def iou(self, params=None, *, max_workers=1, per_sample=False):
+        """ iou测评，使用的是数组化的实现 iou_array.evaluate_method，结果跟官方原版 iou.py 相同
 
-    def iou(self, params=None):
-        from pyxllib.data.icdar.iou import evaluate_method, default_evaluation_params
-        return self._eval(evaluate_method, default_evaluation_params, params)
+        开启 CONFIDENCES 参数时，内存格式的dt每个框最后要多加一个置信度值，会额外计算AP
+
+        :param max_workers: 逐图测评使用的进程数
+        :param per_sample: 是否在结果中附带每张图片的详细数据
+        """
+        from pyxllib.data.icdar.iou import default_evaluation_params
+        from pyxllib.data.icdar.iou_array import evaluate_method
+        return self._eval(functools.partial(evaluate_method, max_workers=max_workers),
+                          default_evaluation_params, params, per_sample)
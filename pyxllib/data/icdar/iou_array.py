@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Author : 陈坤泽
+# @Email  : 877362867@qq.com
+# @Date   : 2026/10/17 14:36
+
+""" icdar iou测评的数组化实现
+
+官方原版 iou.py 对每个框都构造一个 Polygon 对象，再用二重for循环逐对求iou，
+ap也是逐个置信度遍历计算的。这里每张图只计算一次iou矩阵：
+    矩形框（LTRB=True）直接用 ComputeIou 的矩阵运算
+    多边形框（LTRB=False）用 ShapelyPolygons，多边形只转换一次，并用外接矩形索引跳过不相交的对
+ap则是对整个数据集的置信度排序后，用累计和一次算出。
+"""
+
+
+import numpy as np
+
+from pyxllib.algo.geo import ComputeIou
+from pyxllib.prog.pupil import parallel_map, auto_chunksize
+import pyxllib.data.icdar.rrc_evaluation_funcs_1_1 as rrc_evaluation_funcs
+
+
+def load_boxes(content, params, with_transcription=False):
+    """ 解析一张图片的标注数据
+
+    :param content: 官方的bytes、str文本格式，或者内存中的列表格式
+        列表格式的每个元素是 LTRB 的4个值或多边形的8个值，开启CONFIDENCES时，dt后面还要多一个置信度值
+    :param with_transcription: 是否是带标签的gt数据
+    :return: (points, boxes, confidences, dontcare)
+        points，原始的坐标列表
+        boxes，n*4或n*8的数组，跟原版一样取整
+        confidences，置信度数组，没有开启CONFIDENCES时都是0
+        dontcare，n个bool值
+    """
+    n_pts = 4 if params['LTRB'] else 8
+    with_confidence = params['CONFIDENCES'] and not with_transcription
+    if isinstance(content, bytes):
+        content = rrc_evaluation_funcs.decode_utf8(content)
+    if isinstance(content, str):
+        points, confidences, transcriptions = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(
+            content, params['CRLF'], params['LTRB'], with_transcription, with_confidence)
+    else:
+        points = [list(x) for x in content]
+        confidences = [x[n_pts] for x in points] if with_confidence else [0] * len(points)
+        points = [x[:n_pts] for x in points]
+        transcriptions = [''] * len(points)
+        if with_confidence and points:
+            # 跟文本格式一样，按置信度从大到小排序
+            order = np.argsort(-np.array(confidences)).tolist()
+            points, confidences = [points[i] for i in order], [confidences[i] for i in order]
+
+    boxes = np.trunc(np.array(points, dtype=float).reshape(-1, n_pts))
+    confidences = np.array(confidences, dtype=float)
+    dontcare = np.array([x == '###' for x in transcriptions], dtype=bool)
+    return points, boxes, confidences, dontcare
+
+
+def inter_area_matrices(gt_boxes, det_boxes, ltrb=True):
+    """ 计算相交面积矩阵
+
+    :return: inter, gt_areas, det_areas
+    """
+    if ltrb:
+        # 矩形框的四个点可能没按大小顺序写，统一成左上、右下
+        g = np.concatenate([np.minimum(gt_boxes[:, :2], gt_boxes[:, 2:]), np.maximum(gt_boxes[:, :2], gt_boxes[:, 2:])], 1)
+        d = np.concatenate([np.minimum(det_boxes[:, :2], det_boxes[:, 2:]), np.maximum(det_boxes[:, :2], det_boxes[:, 2:])], 1)
+        return ComputeIou.inter_matrix(g, d), ComputeIou.area_ltrb(g), ComputeIou.area_ltrb(d)
+    else:
+        from pyxllib.algo.shapely_ import ShapelyPolygons
+        gs, ds = ShapelyPolygons(gt_boxes), ShapelyPolygons(det_boxes)
+        inter = np.zeros((len(gs), len(ds)))
+        rows, cols, inters = gs.inter_sparse(ds)
+        inter[rows, cols] = inters
+        return inter, gs.areas, ds.areas
+
+
+def compute_ap(confidences, matches, num_gt_care):
+    """ 按置信度从大到小排序后，每个匹配上的位置取当前的精确率，求和后除以gt数
+
+    >>> compute_ap([0.9, 0.8, 0.7], [True, False, True], 3)
+    0.5555555555555555
+    """
+    if not len(confidences):
+        return 0
+    confidences, matches = np.asarray(confidences), np.asarray(matches, dtype=bool)
+    matches = matches[np.argsort(-confidences)]
+    precisions = np.cumsum(matches) / np.arange(1, len(matches) + 1)
+    ap = sum(precisions[matches].tolist())
+    if num_gt_care > 0:
+        ap /= num_gt_care
+    return ap
+
+
+def evaluate_sample(gt_boxes, gt_dontcare, det_boxes, params, confidences=None):
+    """ 测评一张图片
+
+    :param det_boxes: 没有这张图片的检测结果时，传入None
+    :param confidences: det的置信度，开启CONFIDENCES时才需要
+    :return: dict，除了原版的单图结果，还有汇总要用的 detMatched、numGtCare、numDetCare，
+        以及计算全局ap要用的 detCareConfidences、detCareMatches（不是don't care的det的置信度、是否匹配上）
+    """
+    # 1 初始化，计算相交面积、iou矩阵
+    n_gt = len(gt_boxes)
+    n_det = 0 if det_boxes is None else len(det_boxes)
+    if det_boxes is None:
+        det_boxes = np.zeros((0, gt_boxes.shape[1]))
+    inter, gt_areas, det_areas = inter_area_matrices(gt_boxes, det_boxes, params['LTRB'])
+    union = (det_areas[None, :] + gt_areas[:, None]) - inter
+    iou_mat = np.zeros_like(inter)
+    np.divide(inter, union, out=iou_mat, where=union != 0)
+
+    # 跟don't care的gt重叠过多的det，也标记为don't care
+    det_precision = np.zeros_like(inter)
+    np.divide(inter, np.broadcast_to(det_areas, inter.shape), out=det_precision,
+              where=np.broadcast_to(det_areas != 0, inter.shape))
+    det_dontcare = (det_precision[gt_dontcare] > params['AREA_PRECISION_CONSTRAINT']).any(axis=0)
+
+    # 2 匹配，每个gt依次取第一个还没匹配、iou超过阈值的det
+    pairs = []
+    det_matched = np.zeros(n_det, dtype=bool)
+    cand = (iou_mat > params['IOU_CONSTRAINT']) & ~gt_dontcare[:, None] & ~det_dontcare[None, :]
+    for g in np.flatnonzero(cand.any(axis=1)).tolist():
+        ds = np.flatnonzero(cand[g] & ~det_matched)
+        if len(ds):
+            det_matched[ds[0]] = True
+            pairs.append({'gt': g, 'det': int(ds[0])})
+    det_num_matched = len(pairs)
+
+    # 3 单图指标
+    det_care_matches = det_matched[~det_dontcare]
+    det_care_confidences = np.zeros(0) if confidences is None else np.asarray(confidences)[~det_dontcare]
+    num_gt_care = n_gt - int(gt_dontcare.sum())
+    num_det_care = n_det - int(det_dontcare.sum())
+    sample_ap = 0
+    if num_gt_care == 0:
+        recall = float(1)
+        precision = float(0) if num_det_care > 0 else float(1)
+        sample_ap = precision
+    else:
+        recall = float(det_num_matched) / num_gt_care
+        precision = 0 if num_det_care == 0 else float(det_num_matched) / num_det_care
+        if params['CONFIDENCES'] and params['PER_SAMPLE_RESULTS']:
+            sample_ap = compute_ap(det_care_confidences, det_care_matches, num_gt_care)
+    hmean = 0 if (precision + recall) == 0 else 2.0 * precision * recall / (precision + recall)
+
+    return {'precision': precision,
+            'recall': recall,
+            'hmean': hmean,
+            'pairs': pairs,
+            'AP': sample_ap,
+            'iouMat': iou_mat.tolist() if 0 < n_det <= 100 and n_gt else [],
+            'gtDontCare': np.flatnonzero(gt_dontcare).tolist(),
+            'detDontCare': np.flatnonzero(det_dontcare).tolist(),
+            'detMatched': det_num_matched,
+            'numGtCare': num_gt_care,
+            'numDetCare': num_det_care,
+            'detCareConfidences': det_care_confidences,
+            'detCareMatches': det_care_matches}
+
+
+def _evaluate_sample_task(task):
+    """ 进程池使用的单图测评接口，从解析数据开始做 """
+    gt, det, params = task
+    gt_points, gt_boxes, _, gt_dontcare = load_boxes(gt, params, True)
+    if det is None:
+        det_points, det_boxes, confidences = [], None, np.zeros(0)
+    else:
+        det_points, det_boxes, confidences, _ = load_boxes(det, params, False)
+    res = evaluate_sample(gt_boxes, gt_dontcare, det_boxes, params, confidences)
+    res['gtPolPoints'], res['detPolPoints'] = gt_points, det_points
+    res['evaluationParams'] = params
+    return res
+
+
+def evaluate_method(gtFilePath, submFilePath, evaluationParams, *, max_workers=1):
+    r""" 接口同官方原版 iou.py 的 evaluate_method，可以直接替换使用
+
+    :param gtFilePath: 官方的zip文件，或者 {key: 标注数据} 的字典
+    :param max_workers: 逐图测评使用的进程数，1表示不开进程池，直接在当前进程计算
+    :return: 跟原版相同结构的dict，'per_sample'里的单图结果不含evaluationLog
+
+    跟原版的结果对比，含###不关心的框、置信度、以及四边形格式
+    >>> import copy
+    >>> from pyxllib.data.icdar import iou
+    >>> gt = {1: b'0,0,10,10,a\n20,0,40,10,b\n50,0,60,10,###', 2: b'0,0,30,10,a\n40,0,50,10,b'}
+    >>> dt = {1: b'0,0,10,11,0.9\n20,0,35,10,0.8\n50,0,60,10,0.7\n90,0,95,5,0.95', 2: b'1,0,30,10,0.6\n40,0,48,10,0.5'}
+    >>> params = iou.default_evaluation_params()
+    >>> params['CONFIDENCES'] = True
+    >>> a = iou.evaluate_method(copy.deepcopy(gt), copy.deepcopy(dt), dict(params))
+    >>> b = evaluate_method(gt, dt, dict(params))
+    >>> a['method'] == b['method'], b['method']['AP'] < b['method']['precision']
+    (True, True)
+    >>> all(a['per_sample'][k][x] == b['per_sample'][k][x] for k in gt for x in ('recall', 'pairs', 'AP'))
+    True
+
+    >>> def quad(s):  # ltrb转成顺时针的四边形
+    ...     rows = [x.split(',') for x in s.decode().splitlines()]
+    ...     return '\n'.join(','.join([l, t, r, t, r, b, l, b] + rest) for l, t, r, b, *rest in rows).encode()
+    >>> gt, dt = {k: quad(v) for k, v in gt.items()}, {k: quad(v) for k, v in dt.items()}
+    >>> params['LTRB'] = False
+    >>> a = iou.evaluate_method(copy.deepcopy(gt), copy.deepcopy(dt), dict(params))
+    >>> b = evaluate_method(gt, dt, dict(params))
+    >>> all(abs(a['method'][k] - b['method'][k]) < 1e-9 for k in a['method'])
+    True
+    """
+    # 1 读取数据
+    if isinstance(gtFilePath, dict):
+        gt = gtFilePath
+    else:
+        gt = rrc_evaluation_funcs.load_zip_file(str(gtFilePath), evaluationParams['GT_SAMPLE_NAME_2_ID'])
+    if isinstance(submFilePath, dict):
+        subm = submFilePath
+    else:
+        subm = rrc_evaluation_funcs.load_zip_file(str(submFilePath), evaluationParams['DET_SAMPLE_NAME_2_ID'], True)
+
+    # 2 逐图测评
+    tasks = [(gt[k], subm.get(k), evaluationParams) for k in gt]
+    results = list(parallel_map(_evaluate_sample_task, tasks, max_workers, backend='process',
+                                chunksize=auto_chunksize(len(tasks), max_workers)))
+
+    # 3 汇总整体指标
+    matched_sum, num_global_care_gt, num_global_care_det = 0, 0, 0
+    per_sample_metrics = {}
+    for k, res in zip(gt, results):
+        matched_sum += res.pop('detMatched')
+        num_global_care_gt += res.pop('numGtCare')
+        num_global_care_det += res.pop('numDetCare')
+        if evaluationParams['PER_SAMPLE_RESULTS']:
+            per_sample_metrics[k] = {x: v for x, v in res.items() if x not in ('detCareMatches', 'detCareConfidences')}
+
+    # 全数据集的ap，所有图片的置信度拼接后一次排序算出
+    ap = 0
+    if evaluationParams['CONFIDENCES']:
+        ap = compute_ap(np.concatenate([res['detCareConfidences'] for res in results] or [np.zeros(0)]),
+                        np.concatenate([res['detCareMatches'] for res in results] or [np.zeros(0, dtype=bool)]),
+                        num_global_care_gt)
+
+    method_recall = 0 if num_global_care_gt == 0 else float(matched_sum) / num_global_care_gt
+    method_precision = 0 if num_global_care_det == 0 else float(matched_sum) / num_global_care_det
+    method_hmean = 0 if method_recall + method_precision == 0 else \
+        2 * method_recall * method_precision / (method_recall + method_precision)
+    method_metrics = {'precision': method_precision, 'recall': method_recall, 'hmean': method_hmean, 'AP': ap}
+
+    return {'calculated': True, 'Message': '', 'method': method_metrics, 'per_sample': per_sample_metrics}
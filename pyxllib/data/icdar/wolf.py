@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Author : 陈坤泽
+# @Email  : 877362867@qq.com
+# @Date   : 2026/10/17 10:12
+
+""" icdar2013、deteval测评的数组化实现
+
+两者都是 Wolf 等人提出的基于面积的框匹配算法 [1]，只在一对一、一对多、多对一的判定细节上有区别。
+官方原版 icdar2013.py、deteval.py 要把框序列化成文本再用正则解析，并且用多重for循环填充召回率、精确率矩阵，
+这里直接使用内存中的 ltrb 数据，矩阵计算、匹配前提的判定都用 numpy 完成，
+只有存在先后依赖的一对多、多对一匹配，才按原版顺序逐个处理，保证结果和原版完全一致。
+
+1. C. Wolf and J.M. Jolion, "Object Count / Area Graphs for the Evaluation of Object Detection and Segmentation Algorithms",
+    International Journal of Document Analysis, vol. 8, no. 4, pp. 280-296, 2006.
+"""
+
+
+import numpy as np
+
+from pyxllib.prog.pupil import parallel_map, auto_chunksize
+import pyxllib.data.icdar.rrc_evaluation_funcs_1_1 as rrc_evaluation_funcs
+
+
+def load_rects(content, crlf=False, with_transcription=False):
+    """ 解析一张图片的标注数据
+
+    :param content: 官方的bytes、str文本格式，或者 [[xmin, ymin, xmax, ymax], ...] 的内存格式
+    :param with_transcription: 文本格式是否带有标签值，gt的标签为"###"时表示don't care
+    :return: (points, rects, dontcare)
+        points，原始的坐标列表
+        rects，n*4的ltrb数组
+        dontcare，n个bool值
+    """
+    if isinstance(content, bytes):
+        content = rrc_evaluation_funcs.decode_utf8(content)
+    points, _, transcriptions = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(
+        content, crlf, True, with_transcription, False)
+    rects = np.array(points, dtype=float).reshape(-1, 4)
+    dontcare = np.array([x == '###' for x in transcriptions], dtype=bool)
+    return points, rects, dontcare
+
+
+def area_matrices(gt_rects, det_rects):
+    """ 计算召回率、精确率矩阵
+
+    沿用原版的像素计数方式，坐标是闭区间，宽高都要+1
+
+    :return: recall_mat, precision_mat，都是 len(gt)*len(det) 的矩阵
+        recall_mat[i, j] = 交集面积 / gt[i]面积
+        precision_mat[i, j] = 交集面积 / det[j]面积
+    """
+    g, d = gt_rects[:, None, :], det_rects[None, :, :]
+    dx = np.minimum(g[..., 2], d[..., 2]) - np.maximum(g[..., 0], d[..., 0]) + 1
+    dy = np.minimum(g[..., 3], d[..., 3]) - np.maximum(g[..., 1], d[..., 1]) + 1
+    inter = np.where((dx >= 0) & (dy >= 0), dx * dy, 0.)
+
+    def ratio(areas):
+        return np.divide(inter, areas, out=np.zeros_like(inter), where=np.broadcast_to(areas != 0, inter.shape))
+
+    gt_areas = (gt_rects[:, 2] - gt_rects[:, 0] + 1) * (gt_rects[:, 3] - gt_rects[:, 1] + 1)
+    det_areas = (det_rects[:, 2] - det_rects[:, 0] + 1) * (det_rects[:, 3] - det_rects[:, 1] + 1)
+    return ratio(gt_areas[:, None]), ratio(det_areas[None, :])
+
+
+def norm_center_distances(gt_rects, det_rects):
+    """ 一一对应的若干对gt、det框，中心点距离相对两者对角线均值的比例 """
+
+    def center_diag(r):
+        w, h = r[:, 2] - r[:, 0] + 1, r[:, 3] - r[:, 1] + 1
+        return r[:, 0] + w / 2., r[:, 1] + h / 2., np.sqrt(h * h + w * w)
+
+    gx, gy, g_diag = center_diag(gt_rects)
+    dx, dy, d_diag = center_diag(det_rects)
+    distx, disty = np.abs(gx - dx), np.abs(gy - dy)
+    return np.sqrt(distx * distx + disty * disty) / (g_diag + d_diag) * 2.0
+
+
+def evaluate_sample(gt_rects, gt_dontcare, det_rects, params, *, deteval=False, mats=None):
+    """ 测评一张图片
+
+    :param det_rects: 没有这张图片的检测结果时，传入None
+    :param deteval: 默认是icdar2013的规则，设为True时使用deteval的规则
+    :param mats: 已经算好的 (recall_mat, precision_mat)，不输入则用 area_matrices 计算
+    :return: dict，除了precision、recall、hmean、pairs等原版的单图结果，
+        还有汇总整体指标要用的 recallAccum、precisionAccum、numGtCare、numDetCare
+    """
+    # 1 初始化
+    rc, pc = params['AREA_RECALL_CONSTRAINT'], params['AREA_PRECISION_CONSTRAINT']
+    oo, om_o, om_m = params['MTYPE_OO_O'], params['MTYPE_OM_O'], params['MTYPE_OM_M']
+    n_gt = len(gt_rects)
+    n_det = 0 if det_rects is None else len(det_rects)
+    recall, precision, hmean = 0, 0, 0
+    recall_accum, precision_accum = 0., 0.
+    pairs = []
+
+    if mats is None:
+        mats = area_matrices(gt_rects, np.zeros((0, 4)) if det_rects is None else det_rects)
+    recall_mat, precision_mat = mats
+    # 跟don't care的gt重叠过多的det，也标记为don't care
+    det_dontcare = (precision_mat[gt_dontcare] > pc).any(axis=0)
+
+    # 2 匹配
+    if det_rects is not None:
+        if n_gt == 0:
+            recall = 1
+            precision = 0 if n_det > 0 else 1
+
+        if n_det > 0:
+            gt_matched = np.zeros(n_gt, dtype=bool)
+            det_matched = np.zeros(n_det, dtype=bool)
+            gt_care, det_care = ~gt_dontcare, ~det_dontcare
+            if deteval:
+                overlap = recall_mat > 0
+                n_overlaps_gt = (overlap & det_care[None, :]).sum(axis=1)
+                n_overlaps_det = (overlap & gt_care[:, None]).sum(axis=0)
+
+            # 2.1 一对一，判定条件都是静态的，候选对本身就构成一一对应关系，可以整体计算
+            qualified = (recall_mat >= rc) & (precision_mat >= pc)
+            cand = qualified & (qualified.sum(axis=1) == 1)[:, None] & (qualified.sum(axis=0) == 1)[None, :]
+            cand &= gt_care[:, None] & det_care[None, :]
+            if deteval:
+                cand &= (n_overlaps_gt == 1)[:, None] & (n_overlaps_det == 1)[None, :]
+            gs, ds = np.nonzero(cand)
+            keep = norm_center_distances(gt_rects[gs], det_rects[ds]) < params['EV_PARAM_IND_CENTER_DIFF_THR']
+            for g, d in zip(gs[keep].tolist(), ds[keep].tolist()):
+                gt_matched[g], det_matched[d] = True, True
+                recall_accum += oo
+                precision_accum += oo
+                pairs.append({'gt': g, 'det': d, 'type': 'OO'})
+
+            # 2.2 一对多，前面的匹配会影响后面可用的det，要按顺序处理
+            # 累加和必须达到阈值，没有任何候选det的gt可以直接跳过
+            cand = (precision_mat >= pc) & det_care[None, :]
+            gs = np.flatnonzero(gt_care & (cand.any(axis=1) if rc > 0 else True))
+            for g in gs.tolist():
+                ds = np.flatnonzero(cand[g] & ~det_matched) if not gt_matched[g] else np.zeros(0, dtype=int)
+                many_sum = sum(recall_mat[g, ds].tolist())
+                if (round(many_sum, 4) if deteval else many_sum) < rc:
+                    continue
+                if deteval and n_overlaps_gt[g] < 2:
+                    continue
+                gt_matched[g] = True
+                det_matched[ds] = True
+                if deteval and len(ds) == 1:
+                    recall_accum += oo
+                    precision_accum += oo
+                    pairs.append({'gt': g, 'det': ds.tolist(), 'type': 'OO'})
+                else:
+                    recall_accum += om_o
+                    precision_accum += om_o * len(ds)
+                    pairs.append({'gt': g, 'det': ds.tolist(), 'type': 'OM'})
+
+            # 2.3 多对一
+            cand = (recall_mat >= rc) & gt_care[:, None]
+            ds = np.flatnonzero(det_care & (cand.any(axis=0) if pc > 0 else True))
+            for d in ds.tolist():
+                gs = np.flatnonzero(cand[:, d] & ~gt_matched) if not det_matched[d] else np.zeros(0, dtype=int)
+                many_sum = sum(precision_mat[gs, d].tolist())
+                if (round(many_sum, 4) if deteval else many_sum) < pc:
+                    continue
+                if deteval and n_overlaps_det[d] < 2:
+                    continue
+                det_matched[d] = True
+                gt_matched[gs] = True
+                if deteval and len(gs) == 1:
+                    recall_accum += oo
+                    precision_accum += oo
+                    pairs.append({'gt': gs.tolist(), 'det': d, 'type': 'OO'})
+                else:
+                    recall_accum += om_m * len(gs)
+                    precision_accum += om_m
+                    pairs.append({'gt': gs.tolist(), 'det': d, 'type': 'MO'})
+
+            # 2.4 单图指标
+            n_gt_care, n_det_care = int(gt_care.sum()), int(det_care.sum())
+            if n_gt_care == 0:
+                recall = float(1)
+                precision = float(0) if n_det > 0 else float(1)
+            else:
+                recall = float(recall_accum) / n_gt_care
+                precision = float(0) if n_det_care == 0 else float(precision_accum) / n_det_care
+            hmean = 0 if (precision + recall) == 0 else 2.0 * precision * recall / (precision + recall)
+
+    # 3 结果
+    return {'precision': precision,
+            'recall': recall,
+            'hmean': hmean,
+            'pairs': pairs,
+            'recallMat': recall_mat.tolist() if 0 < n_det <= 100 else [],
+            'precisionMat': precision_mat.tolist() if 0 < n_det <= 100 else [],
+            'gtDontCare': np.flatnonzero(gt_dontcare).tolist(),
+            'detDontCare': np.flatnonzero(det_dontcare).tolist(),
+            'recallAccum': recall_accum,
+            'precisionAccum': precision_accum,
+            'numGtCare': n_gt - int(gt_dontcare.sum()),
+            'numDetCare': n_det - int(det_dontcare.sum())}
+
+
+def _evaluate_sample_task(task):
+    """ 进程池使用的单图测评接口，从解析数据开始做 """
+    gt, det, params, deteval = task
+    gt_points, gt_rects, gt_dontcare = load_rects(gt, params['CRLF'], True)
+    if det is None:
+        det_points, det_rects = [], None
+    else:
+        det_points, det_rects, _ = load_rects(det, params['CRLF'], False)
+    res = evaluate_sample(gt_rects, gt_dontcare, det_rects, params, deteval=deteval)
+    res['gtPolPoints'], res['detPolPoints'] = gt_points, det_points
+    res['evaluationParams'] = params
+    return res
+
+
+def evaluate_method(gtFilePath, submFilePath, evaluationParams, *, deteval=False, max_workers=1):
+    r""" 接口同官方原版的 evaluate_method，可以直接替换使用
+
+    :param gtFilePath: 官方的zip文件，或者 {key: 标注数据} 的字典
+        标注数据可以是官方的bytes文本，也可以是 [[xmin, ymin, xmax, ymax], ...] 的列表
+    :param deteval: 默认使用icdar2013的规则，设为True时使用deteval的规则
+    :param max_workers: 逐图测评使用的进程数，1表示不开进程池，直接在当前进程计算
+    :return: 跟原版相同结构的dict，'per_sample'里的单图结果不含evaluationLog
+
+    跟原版的结果对比，样例里有一对一、一对多、多对一、###不关心的框
+    >>> import copy
+    >>> from pyxllib.data.icdar import icdar2013, deteval
+    >>> gt = {1: b'0,0,10,10,a\n20,0,40,10,b\n50,0,60,10,###\n70,0,80,10,c',
+    ...       2: [[0, 0, 30, 10], [40, 0, 50, 10], [52, 0, 62, 10]]}
+    >>> dt = {1: b'0,0,10,10\n20,0,29,10\n30,0,40,10\n50,0,60,10\n90,0,95,5',
+    ...       2: [[0, 0, 14, 10], [15, 0, 30, 10], [40, 0, 62, 10]]}
+    >>> params = icdar2013.default_evaluation_params()
+    >>> for old, de in ((icdar2013, False), (deteval, True)):
+    ...     a = old.evaluate_method(copy.deepcopy(gt), copy.deepcopy(dt), dict(params))
+    ...     b = evaluate_method(gt, dt, dict(params), deteval=de)
+    ...     print(a['method'] == b['method'], all(a['per_sample'][k][x] == b['per_sample'][k][x]
+    ...                                           for k in gt for x in ('precision', 'recall', 'hmean', 'pairs')))
+    True True
+    True True
+    >>> [x['type'] for x in b['per_sample'][2]['pairs']]
+    ['OM', 'MO']
+    """
+    # 1 读取数据
+    if isinstance(gtFilePath, dict):
+        gt = gtFilePath
+    else:
+        gt = rrc_evaluation_funcs.load_zip_file(str(gtFilePath), evaluationParams['GT_SAMPLE_NAME_2_ID'])
+    if isinstance(submFilePath, dict):
+        subm = submFilePath
+    else:
+        subm = rrc_evaluation_funcs.load_zip_file(str(submFilePath), evaluationParams['DET_SAMPLE_NAME_2_ID'], True)
+
+    # 2 逐图测评
+    tasks = [(gt[k], subm.get(k), evaluationParams, deteval) for k in gt]
+    results = list(parallel_map(_evaluate_sample_task, tasks, max_workers, backend='process',
+                                chunksize=auto_chunksize(len(tasks), max_workers)))
+
+    # 3 汇总整体指标
+    method_recall_sum, method_precision_sum = 0, 0
+    num_gt, num_det = 0, 0
+    per_sample_metrics = {}
+    for k, res in zip(gt, results):
+        method_recall_sum += res.pop('recallAccum')
+        method_precision_sum += res.pop('precisionAccum')
+        num_gt += res.pop('numGtCare')
+        num_det += res.pop('numDetCare')
+        per_sample_metrics[k] = res
+
+    method_recall = 0 if num_gt == 0 else method_recall_sum / num_gt
+    method_precision = 0 if num_det == 0 else method_precision_sum / num_det
+    method_hmean = 0 if method_recall + method_precision == 0 else \
+        2 * method_recall * method_precision / (method_recall + method_precision)
+    method_metrics = {'precision': method_precision, 'recall': method_recall, 'hmean': method_hmean}
+
+    return {'calculated': True, 'Message': '', 'method': method_metrics, 'per_sample': per_sample_metrics}
+
+
+def _sequential_sum(values):
+    """ 按顺序累加，跟原版逐个 += 的浮点误差完全一致 """
+    return np.add.accumulate(values)[-1] if len(values) else 0
+
+
+def evaluate_score_sweep(gt, dt, scores, thresholds, params, *, deteval=False):
+    """ dt按不同置信度阈值过滤后的整体指标
+
+    每张图片的召回率、精确率矩阵只计算一次；
+    相邻两个阈值之间，只有存在det分数落在两者之间的图片，保留的框才会变化，
+    只有这些图片需要重新测评，其他图片沿用上一个阈值的结果。
+    所以总的测评次数跟dt的框数同量级，不会随阈值数量成倍增长。
+
+    :param gt: {key: [[xmin, ymin, xmax, ymax], ...]}
+    :param dt: 同gt，没有检测结果的key可以不写
+    :param scores: {key: [score, ...]}，跟dt的框一一对应
+    :param thresholds: 若干个阈值，保留 score >= 阈值 的框
+    :return: list，每个阈值对应一个 {'precision': ..., 'recall': ..., 'hmean': ...}
+    """
+    # 1 每张图片先算好矩阵
+    samples = []
+    for k in gt:
+        gt_rects = np.array(gt[k], dtype=float).reshape(-1, 4)
+        det_rects = np.array(dt.get(k, []), dtype=float).reshape(-1, 4)
+        samples.append((gt_rects, det_rects, np.asarray(scores.get(k, []), dtype=float),
+                        area_matrices(gt_rects, det_rects)))
+    # 所有det的分数，及其所在图片的编号
+    all_scores = np.concatenate([x[2] for x in samples] + [np.zeros(0)])
+    all_samples = np.repeat(np.arange(len(samples)), [len(x[2]) for x in samples])
+
+    # 2 每个阈值只重新测评保留的框有变化的图片
+    # 每张图片的 recallAccum、precisionAccum、numGtCare、numDetCare
+    accums = np.zeros((len(samples), 4))
+    res, prev = [], None
+    for t in thresholds:
+        if prev is None:
+            changed = range(len(samples))
+        else:
+            lo, hi = min(prev, t), max(prev, t)
+            changed = np.unique(all_samples[(all_scores >= lo) & (all_scores < hi)]).tolist()
+        prev = t
+
+        for i in changed:
+            gt_rects, det_rects, det_scores, (recall_mat, precision_mat) = samples[i]
+            keep = det_scores >= t
+            if keep.any():
+                r = evaluate_sample(gt_rects, np.zeros(len(gt_rects), dtype=bool), det_rects[keep], params,
+                                    deteval=deteval, mats=(recall_mat[:, keep], precision_mat[:, keep]))
+            else:
+                # 跟原版一样，没有任何框时当做没有这张图片的检测结果
+                r = evaluate_sample(gt_rects, np.zeros(len(gt_rects), dtype=bool), None, params, deteval=deteval)
+            accums[i] = r['recallAccum'], r['precisionAccum'], r['numGtCare'], r['numDetCare']
+
+        method_recall_sum, method_precision_sum = _sequential_sum(accums[:, 0]), _sequential_sum(accums[:, 1])
+        num_gt, num_det = int(accums[:, 2].sum()), int(accums[:, 3].sum())
+        method_recall = 0 if num_gt == 0 else method_recall_sum / num_gt
+        method_precision = 0 if num_det == 0 else method_precision_sum / num_det
+        method_hmean = 0 if method_recall + method_precision == 0 else \
+            2 * method_recall * method_precision / (method_recall + method_precision)
+        res.append({'precision': float(method_precision), 'recall': float(method_recall),
+                    'hmean': float(method_hmean)})
+    return res
@@ -8,15 +8,19 @@
 from tqdm import tqdm
 import json
 import ujson
+import collections
+import concurrent.futures
 import copy
+import os
 
 from pyxllib.prog.deprecatedlib import deprecated
 import pandas as pd
 import numpy as np
 
-from pyxllib.prog.pupil import DictTool
+from pyxllib.prog.pupil import DictTool, parallel_map, auto_chunksize
+from pyxllib.algo.pupil import natural_sort
 from pyxllib.debug.specialist import get_xllog, Iterate, dprint
-from pyxllib.file.specialist import File, Dir, PathGroups, get_encoding
+from pyxllib.file.specialist import File, Dir, PathGroups, get_encoding, get_file_encoding
 from pyxllib.prog.specialist import mtqdm
 from pyxllib.cv.expert import PilImg
 from pyxllib.algo.geo import ltrb2xywh, rect_bounds, warp_points, resort_quad_points, rect2polygon, get_warp_mat
@@ -26,10 +30,90 @@ __0_basic = """
 """
 
 
+def scan_files(root, exclude=()):
+    """ 用os.scandir递归获取目录下所有文件
+
+    :param exclude: 要排除的相对路径
+    :return: {relpath: (mtime_ns, size)}，relpath用斜杠分隔
+    """
+    res = {}
+
+    def scan(path, prefix):
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    scan(entry.path, prefix + entry.name + '/')
+                elif entry.is_file():
+                    relpath = prefix + entry.name
+                    if relpath not in exclude:
+                        st = entry.stat()
+                        res[relpath] = (st.st_mtime_ns, st.st_size)
+
+    scan(str(root), '')
+    return res
+
+
+class LazyDataDict(collections.abc.MutableMapping):
+    """ 按需读取的 {relpath: data} 字典
+
+    第一次取值时才读取文件，读到的数据放在容量为maxsize的LRU缓存中；
+    通过赋值写入的数据会一直保留，不会被淘汰。
+    注意取出的数据如果做了原地修改，要重新赋值回来，否则被淘汰后修改会丢失。
+    """
+
+    def __init__(self, keys, read_func, maxsize=1024):
+        """
+        :param keys: 所有的relpath
+        :param read_func: read_func(relpath)，读取数据的函数
+        """
+        self._keys = dict.fromkeys(keys)
+        self.read_func, self.maxsize = read_func, maxsize
+        self._cache = collections.OrderedDict()
+        self._assigned = {}
+
+    def __getitem__(self, k):
+        if k in self._assigned:
+            return self._assigned[k]
+        if k not in self._keys:
+            raise KeyError(k)
+        if k in self._cache:
+            self._cache.move_to_end(k)
+            return self._cache[k]
+        v = self.read_func(k)
+        self.cache(k, v)
+        return v
+
+    def cache(self, k, v):
+        """ 把已经读到的数据放入缓存 """
+        self._cache[k] = v
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def __setitem__(self, k, v):
+        self._keys[k] = None
+        self._assigned[k] = v
+        self._cache.pop(k, None)
+
+    def __delitem__(self, k):
+        del self._keys[k]
+        self._assigned.pop(k, None)
+        self._cache.pop(k, None)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
 class BasicLabelDataset:
     """ 一张图一份标注文件的一些基本操作功能 """
 
-    def __init__(self, root, relpath2data=None, *, reads=True, prt=False, fltr=None, slt=None, extdata=None):
+    # 持久化索引的文件名，存在数据根目录下
+    INDEX_FILE = '.xllabel_index.csv'
+
+    def __init__(self, root, relpath2data=None, *, reads=True, prt=False, fltr=None, slt=None, extdata=None,
+                 max_workers=1, lazy=False, index=False):
         """
         :param root: 数据所在根目录
         :param dict[str, readed_data] relpath2data: {relpath: data1, 'a/1.txt': data2, ...}
@@ -46,6 +130,12 @@ class BasicLabelDataset:
             judge(k, v)，自定义函数规则
         :param slt: select的缩写，要选中的标注文件后缀格式
             如果传入slt参数，该 Basic 基础类只会预设好 file 参数，数据部分会置 None，需要后续主动读取
+        :param max_workers: 读取标注文件的线程数
+        :param lazy: 是否延迟读取，开启后 rp2data 是 LazyDataDict，用到某个文件时才读取
+        :param index: 是否使用持久化索引，开启后会存储每个标注文件的 relpath、mtime、size、n_items，
+            再次打开时，修改时间、大小没变的文件直接使用索引里的统计信息，配合lazy只需要重新解析有变动的文件
+            True表示存在 root/INDEX_FILE，也可以传入其他的索引文件路径
+            索引信息存在 self.index 中
 
         >> BasicLabelData('textGroup/aabb', {'a.json': ..., 'a/1.json': ...})
         >> BasicLabelData('textGroup/aabb', slt='json')
@@ -61,8 +151,11 @@ class BasicLabelDataset:
             return
 
         # 2 如果没有默认data数据，以及传入slt参数，则需要使用默认文件关联方式读取标注
-        relpath2data = {}
-        gs = PathGroups.groupby(Dir(root).select_files('**/*'))
+        # 只扫描一遍目录，同时拿到文件的修改时间、大小
+        self.file_stats = scan_files(root, exclude={self.INDEX_FILE})
+        prefix = os.path.join(str(root), '')
+        gs = PathGroups.groupby(natural_sort(self.file_stats), key=lambda x: prefix + os.path.splitext(x)[0],
+                                ykey=lambda y: os.path.splitext(y)[1][1:])
         if isinstance(fltr, str):
             gs = gs.select_group_which_hassuffix(fltr)
         elif callable(fltr):
@@ -70,15 +163,67 @@ class BasicLabelDataset:
         self.pathgs = gs
 
         # 3 读取数据
-        for stem, suffixs in tqdm(gs.data.items(), f'{self.__class__.__name__}读取数据', disable=not prt):
-            f = File(stem, suffix=slt)
-            if reads and f:
-                # dprint(f)  # 空json会报错：json.decoder.JSONDecodeError: Expecting value: line 1 column 1 (char 0)
-                relpath2data[f.relpath(self.root)] = f.read()
+        relpaths = [stem[len(prefix):] + '.' + slt.lstrip('.') for stem in gs.data.keys()]
+        # dprint(f)  # 空json会报错：json.decoder.JSONDecodeError: Expecting value: line 1 column 1 (char 0)
+        exists = [x for x in relpaths if x in self.file_stats] if reads else []
+        index_file = (os.path.join(str(root), self.INDEX_FILE) if index is True else str(index)) if index else None
+        index = self._load_index(index_file) if index_file else None
+        if lazy:
+            self.rp2data = LazyDataDict(relpaths, self._read_data)
+            for x in set(relpaths) - set(exists):
+                self.rp2data[x] = None
+            # 没有索引时一个文件都不用解析；有索引时，只解析变动过的文件来更新索引，其他的等用到时再读
+            if index is None:
+                exists = []
             else:
-                relpath2data[f.relpath(self.root)] = None
+                exists = [x for x in exists if index.get(x, (None,))[:2] != self.file_stats[x]]
+            datas = self._read_datas(exists, max_workers, prt)
+            for x, data in zip(exists, datas):
+                self.rp2data.cache(x, data)
+        else:
+            datas = self._read_datas(exists, max_workers, prt)
+            self.rp2data = dict.fromkeys(relpaths)
+            self.rp2data.update(zip(exists, datas))
+
+        # 4 更新索引
+        if index is not None:
+            counts = {x: self.count_items(data) for x, data in zip(exists, datas)}
+            records = []
+            for x in relpaths:
+                if x in counts:
+                    records.append((x, *self.file_stats[x], counts[x]))
+                elif x in index:
+                    records.append((x, *index[x]))
+            self.index = pd.DataFrame.from_records(records, columns=['relpath', 'mtime', 'size', 'n_items'])
+            self.index.to_csv(index_file, index=False)
+
+    def _read_data(self, relpath):
+        return File(relpath, self.root).read()
+
+    def _read_datas(self, relpaths, max_workers=1, prt=False):
+        """ 读取多份标注数据，max_workers>1时用线程池并行读取 """
+        desc = f'{self.__class__.__name__}读取数据'
+        if max_workers == 1:
+            return [self._read_data(x) for x in tqdm(relpaths, desc, disable=not prt)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            return list(tqdm(executor.map(self._read_data, relpaths), desc, total=len(relpaths), disable=not prt))
 
-        self.rp2data = relpath2data
+    @classmethod
+    def _load_index(cls, file):
+        """ 读取持久化索引，没有索引文件时返回空字典
+
+        :return: {relpath: (mtime, size, n_items)}
+        """
+        if not os.path.isfile(file):
+            return {}
+        df = pd.read_csv(file, keep_default_na=False, dtype={'relpath': str})
+        return {x: (a, b, c) for x, a, b, c in zip(df['relpath'], df['mtime'].tolist(), df['size'].tolist(),
+                                                   df['n_items'].tolist())}
+
+    @classmethod
+    def count_items(cls, data):
+        """ 索引里记录的标注条目数，默认是数据的长度 """
+        return len(data) if hasattr(data, '__len__') else -1
 
     def __len__(self):
         return len(self.rp2data)
@@ -101,21 +246,26 @@ class BasicLabelDataset:
         data = self.rp2data[relpath]
         file = File(relpath, self.root)
         if file:  # 如果文件存在，要遵循原有的编码规则
-            with open(str(file), 'rb') as f:
-                bstr = f.read()
-            encoding = get_encoding(bstr)
+            encoding = get_file_encoding(file)
             kwargs['encoding'] = encoding
-            kwargs['if_exists'] = 'delete'
+            kwargs['if_exists'] = 'replace'
             file.write(data, **kwargs)
         else:  # 否则直接写入
             file.write(data, **kwargs)
 
-    def writes(self, *, max_workers=8, prt=False, **kwargs):
+    def writes(self, *, max_workers=8, prt=False, writer=None, **kwargs):
         """ 重新写入每份标注文件
 
         可能是内存里修改了数据，需要重新覆盖
         也可能是从coco等其他格式初始化，转换而来的内存数据，需要生成对应的新标注文件
+
+        :param writer: BackgroundWriter，传入时只提交写入任务就返回，可以继续做其他计算，
+            writer.close()时才等待写完，在此之前不要再修改rp2data里的数据
         """
+        if writer is not None:
+            for relpath in self.rp2data.keys():
+                writer.submit(self.write, relpath, **kwargs)
+            return
         mtqdm(lambda x: self.write(x, **kwargs), self.rp2data.keys(), desc=f'{self.__class__.__name__}写入标注数据',
               max_workers=max_workers, disable=not prt)
 
@@ -164,13 +314,16 @@ class ToLabelmeJson:
 
     # 可能有其他人会用我库的高级接口，不应该莫名其妙报警告。除非我先实现自己库内该功能的剥离
     # @deprecated(reason='建议使用LabelmeData实现')
-    def __init__(self, imgpath):
+    def __init__(self, imgpath, *, size=None):
         """
         :param imgpath: 可选参数图片路径，强烈建议要输入，否则建立的label json会少掉图片宽高信息
+        :param size: 已知的图片尺寸 (height, width)，比如coco的images里记录的尺寸
+            有传入时不再打开图片，self.img为None
         """
         self.imgpath = File(imgpath)
+        self.size = size
         # 读取图片数据，在一些转换规则比较复杂，有可能要用到原图数据
-        if self.imgpath:
+        if self.imgpath and size is None:
             # 一般都只需要获得尺寸，用pil读取即可，速度更快，不需要读取图片rgb数据
             self.img = PilImg(self.imgpath)
         else:
@@ -192,7 +345,7 @@ class ToLabelmeJson:
         # 1 默认属性，和图片名、尺寸
         if self.imgpath:
             name = self.imgpath.name
-            height, width = self.img.size()
+            height, width = self.img.size() if self.size is None else self.size
         # 2 构建结构框架
         data = {'version': '4.5.6',
                 'flags': {},
@@ -249,13 +402,19 @@ class ToLabelmeJson:
     def add_shape2(self, **kwargs):
         self.data['shapes'].append(self.get_shape2(**kwargs))
 
-    def write(self, dst=None, if_exists='replace'):
+    def write(self, dst=None, if_exists='replace', *, skip_unchanged=False):
         """
         :param dst: 往dst目标路径存入json文件，默认名称在self.imgpath同目录的同名json文件
+        :param skip_unchanged: 已有的文件内容跟要写入的完全相同时，不重复写入
         :return: 写入后的文件路径
         """
         if dst is None and self.imgpath:
             dst = self.imgpath.with_suffix('.json')
+        if skip_unchanged:
+            content = ujson.dumps(self.data, ensure_ascii=False, indent=0).encode('utf8')
+            f = File(dst)
+            if f and os.path.getsize(str(f)) == len(content) and f.read(mode='b') == content:
+                return f
         # 官方json支持indent=None的写法，但是ujson必须要显式写indent=0
         return File(dst).write(self.data, if_exists=if_exists, indent=0)
 
@@ -452,8 +611,52 @@ class LabelmeDict:
         return lmdict
 
 
+def _labelme_shape_attrs(lmdict):
+    """ 解析一份labelme标注，LabelmeDataset.to_coco_gt_dict 的第一步
+
+    放在模块层级，是为了能被进程池pickle
+
+    每个shape的属性字典跟 LabelmeDict.update_labelattr(points=True) 后的label一致，但不修改lmdict，
+        points也不写入属性字典，而是单独返回，方便批量计算
+
+    :return: image, attrs, points
+        image，图片标注，优先用xltype='image'的图像级shape的属性字典（去掉xltype），
+            这样coco转labelme再转回coco时，能保留原来的图片id、自定义字段；没有图像级shape时才新生成，id为-1
+        attrs，普通标注框的属性字典
+        points，对应的shape点集
+    """
+    stdkeys = {'label', 'points', 'group_id', 'shape_type', 'flags'}
+    image, attrs, points = None, [], []
+    for shape in lmdict['shapes']:
+        labelattr = DictTool.json_loads(shape['label'], 'label')
+        for k in shape.keys():
+            if k not in stdkeys:
+                labelattr[k] = shape[k]
+
+        if 'xltype' not in labelattr:  # 普通的标注框
+            attrs.append(labelattr)
+            points.append(shape['points'])
+        elif labelattr['xltype'] == 'image':
+            # 图像级标注数据，有多个的以第一个为准
+            if image is None:
+                del labelattr['xltype']
+                image = labelattr
+        elif labelattr['xltype'] == 'seg':
+            # seg是衍生的分割标注框，在转回coco时可以丢弃
+            pass
+        else:
+            raise ValueError
+
+    if image is None:
+        # TODO file_name 加上相对路径？
+        image = {'id': -1, 'file_name': lmdict['imagePath'],
+                 'height': int(lmdict['imageHeight']), 'width': int(lmdict['imageWidth'])}
+    return image, attrs, points
+
+
 class LabelmeDataset(BasicLabelDataset):
-    def __init__(self, root, relpath2data=None, *, reads=True, prt=False, fltr='json', slt='json', extdata=None):
+    def __init__(self, root, relpath2data=None, *, reads=True, prt=False, fltr='json', slt='json', extdata=None,
+                 max_workers=1, lazy=False, index=False):
         """
         :param root: 文件根目录
         :param relpath2data: {jsonfile: lmdict, ...}，其中 lmdict 为一个labelme文件格式的标准内容
@@ -461,14 +664,24 @@ class LabelmeDataset(BasicLabelDataset):
 
             210602周三16:26，为了工程等一些考虑，删除了 is_labelme_json_data 的检查
                 尽量通过 fltr、slt 的机制选出正确的 json 文件
+        :param max_workers, lazy, index: 读取方式，详见 BasicLabelDataset
         """
-        super().__init__(root, relpath2data, reads=reads, prt=prt, fltr=fltr, slt=slt, extdata=extdata)
+        super().__init__(root, relpath2data, reads=reads, prt=prt, fltr=fltr, slt=slt, extdata=extdata,
+                         max_workers=max_workers, lazy=lazy, index=index)
+        if relpath2data is not None or slt is None:
+            return
 
         # 已有的数据已经读取了，这里要补充空labelme标注
+        prefix = os.path.join(str(self.root), '')
         for stem, suffixs in tqdm(self.pathgs.data.items(), f'{self.__class__.__name__}优化数据', disable=not prt):
-            f = File(stem, suffix=slt)
-            if reads and not f:
-                self.rp2data[f.relpath(self.root)] = LabelmeDict.gen_data(File(stem, suffix=suffixs[0]))
+            relpath = stem[len(prefix):] + '.' + slt.lstrip('.')
+            if reads and relpath not in self.file_stats:
+                self.rp2data[relpath] = LabelmeDict.gen_data(File(stem, suffix=suffixs[0]))
+
+    @classmethod
+    def count_items(cls, data):
+        """ 索引里记录每份labelme标注的shape数量 """
+        return len(data['shapes'])
 
     def reduces(self):
         """ 移除imageData字段值 """
@@ -498,7 +711,7 @@ class LabelmeDataset(BasicLabelDataset):
         """ 将标注画成静态图 """
         raise NotImplementedError
 
-    def to_coco_gt_dict(self, categories=None):
+    def to_coco_gt_dict(self, categories=None, *, max_workers=1):
         """ 将labelme转成 coco gt 标注的格式
 
         分两种大情况
@@ -509,12 +722,33 @@ class LabelmeDataset(BasicLabelDataset):
             这种在coco转labelme时，会做一些特殊标记，方便后续转回coco
         3、 1, 2两种情况是可以连在一起，然后形成 labelme 和 coco 之间的多次互转的
 
+        每个label只解析一次，不会修改self.rp2data里的数据；
+        所有shape的外接矩形、分割点集统一用numpy批量计算，编号也是用数组运算分配
+
         :param categories: 类别
             默认只设一个类别 {'id': 0, 'name': 'text', 'supercategory'}
             支持自定义，所有annotations的category_id
+        :param max_workers: 解析label的进程数，1表示在当前进程解析
+            lmdict要在进程间传输，只有label比较复杂、文件很多时才值得开进程池
         :return: gt_dict
             注意，如果对文件顺序、ann顺序有需求的，请先自行操作self.data数据后，再调用该to_coco函数
             对image_id、annotation_id有需求的，需要使用CocoData进一步操作
+
+        coco转来的labelme，会保留图像级shape里原来的图片id、自定义字段，没有图像级shape的图片接着编号
+        >>> def lmdict(name, shapes):
+        ...     return {'imagePath': name, 'imageHeight': 20, 'imageWidth': 30, 'shapes': shapes}
+        >>> img = {'id': 17, 'file_name': 'a.jpg', 'height': 20, 'width': 30, 'extra': 'x', 'xltype': 'image'}
+        >>> a_shapes = [LabelmeDict.gen_shape(json.dumps(img), [[-10, 0], [-5, 0]]),
+        ...             LabelmeDict.gen_shape('{"id": 3}', [[1, 2], [4, 6]])]
+        >>> ds = LabelmeDataset('.', {'a.json': lmdict('a.jpg', a_shapes),
+        ...                           'b.json': lmdict('b.jpg', [LabelmeDict.gen_shape('{}', [[1, 2], [4, 6]])])})
+        >>> gt = ds.to_coco_gt_dict()
+        >>> gt['images'][0]
+        {'id': 17, 'file_name': 'a.jpg', 'height': 20, 'width': 30, 'extra': 'x'}
+        >>> gt['images'][1]
+        {'id': 18, 'file_name': 'b.jpg', 'height': 20, 'width': 30}
+        >>> [(x['id'], x['image_id']) for x in gt['annotations']]
+        [(3, 17), (4, 18)]
         """
         from pyxllib.data.coco import CocoGtData
 
@@ -525,74 +759,77 @@ class LabelmeDataset(BasicLabelDataset):
             else:
                 categories = [{'id': 0, 'name': 'text', 'supercategory': ''}]
 
-        # 1 第一轮遍历：结构处理 jsonfile, lmdict --> data（image, shapes）
-        img_id, ann_id, data = 0, 0, []
-        for jsonfile, lmdict in self.rp2data.items():
-            # 1.0 升级为字典类型
-            lmdict = LabelmeDict.update_labelattr(lmdict, points=True)
-
-            for sp in lmdict['shapes']:  # label转成字典
-                sp['label'] = json.loads(sp['label'])
-
-            # 1.1 找shapes里的image
-            image = None
-            # 1.1.1 xltype='image'
-            for sp in filter(lambda x: x.get('xltype', None) == 'image', lmdict['shapes']):
-                image = DictTool.json_loads(sp['label'])
-                if not image:
-                    raise ValueError(sp['label'])
-                # TODO 删除 coco_eval 等字段？
-                del image['xltype']
-                break
-            # 1.1.2 shapes里没有图像级标注则生成一个
-            if image is None:
-                # TODO file_name 加上相对路径？
-                image = CocoGtData.gen_image(-1, lmdict['imagePath'],
-                                             lmdict['imageHeight'], lmdict['imageWidth'])
-            img_id = max(img_id, image.get('id', -1))
-
-            # 1.2 遍历shapes
-            shapes = []
-            for sp in lmdict['shapes']:
-                label = sp['label']
-                if 'xltype' not in label:
-                    # 普通的标注框
-                    d = sp['label'].copy()
-                    # DictTool.isub_(d, '')
-                    ann_id = max(ann_id, d.get('id', -1))
-                    shapes.append(d)
-                elif label['xltype'] == 'image':
-                    # image，图像级标注数据；之前已经处理了，这里可以跳过
-                    pass
-                elif label['xltype'] == 'seg':
-                    # seg，衍生的分割标注框，在转回coco时可以丢弃
-                    pass
-                else:
-                    raise ValueError
-            data.append([image, shapes])
-
-        # 2 第二轮遍历：处理id等问题
-        images, annotations = [], []
-        for image, shapes in data:
-            # 2.1 image
-            if image.get('id', -1) == -1:
-                img_id += 1
-                image['id'] = img_id
-            images.append(image)
-
-            # 2.2 annotations
-            for sp in shapes:
-                sp['image_id'] = img_id
-                if sp.get('id', -1) == -1:
-                    ann_id += 1
-                    sp['id'] = ann_id
-                # 如果没有框类别，会默认设置一个。 （强烈建议外部业务功能代码自行设置好category_id）
-                if 'category_id' not in sp:
-                    sp['category_id'] = categories[0]['id']
-                DictTool.isub(sp, ['category_name'])
-                ann = CocoGtData.gen_annotation(**sp)
-                annotations.append(ann)
-
-        # 3 result
+        # 1 逐文件解析出 image、普通标注框的属性字典、points
+        lmdicts = list(self.rp2data.values())
+        results = list(parallel_map(_labelme_shape_attrs, lmdicts, max_workers, backend='process',
+                                    chunksize=auto_chunksize(len(lmdicts), max_workers)))
+        images = [x[0] for x in results]
+        attrs = [a for x in results for a in x[1]]
+        points = [p for x in results for p in x[2]]
+
+        # 2 编号，没有id的按顺序接在已有的最大id后面
+        def assign_ids(ids):
+            ids = np.array(ids, dtype=int).reshape(-1)
+            missing = ids == -1
+            ids[missing] = max(ids.max(initial=0), 0) + np.arange(1, missing.sum() + 1)
+            return ids.tolist()
+
+        img_ids = assign_ids([im.get('id', -1) for im in images])
+        ann_ids = assign_ids([a.get('id', -1) for a in attrs])
+        ann_img_ids = np.repeat(img_ids, [len(x[1]) for x in results]).tolist()
+
+        # 3 批量计算几何信息
+        # 每个shape点集的外接矩形，以及取整后的外接矩形（等于取整后分割点集的外接矩形）
+        n_pts = np.array([len(p) for p in points], dtype=int)
+        offsets = np.concatenate([[0], np.cumsum(n_pts)])
+        pts = np.array([xy for p in points for xy in p], dtype=float).reshape(-1, 2)
+        if len(points):
+            starts = offsets[:-1]
+            ltrb = np.stack([np.minimum.reduceat(pts[:, 0], starts), np.minimum.reduceat(pts[:, 1], starts),
+                             np.maximum.reduceat(pts[:, 0], starts), np.maximum.reduceat(pts[:, 1], starts)], 1)
+        else:
+            ltrb = np.zeros((0, 4))
+        xywh = ltrb.copy()
+        xywh[:, 2:] -= xywh[:, :2]
+        int_ltrb = np.round(ltrb).astype(int)
+        int_xywh = int_ltrb.copy()
+        int_xywh[:, 2:] -= int_xywh[:, :2]
+        int_pts = np.round(pts).astype(int).reshape(-1).tolist()
+        xywh, int_ltrb, int_xywh = xywh.tolist(), int_ltrb.tolist(), int_xywh.tolist()
+
+        def segmentation(i):
+            """ 同 CocoGtData.points2segmentation：两个点的是矩形，转成4个点；点集末尾要加上第0个点封闭 """
+            if n_pts[i] == 2:
+                l, t, r, b = int_ltrb[i]
+                return [l, t, r, t, r, b, l, b, l, t]
+            k = 2 * offsets[i]
+            return int_pts[k:2 * offsets[i + 1]] + int_pts[k:k + 2]
+
+        # 4 生成annotations，逻辑同 CocoGtData.gen_annotation
+        annotations = []
+        for i, a in enumerate(attrs):
+            a['image_id'] = ann_img_ids[i]
+            a['id'] = ann_ids[i]
+            # 如果没有框类别，会默认设置一个。 （强烈建议外部业务功能代码自行设置好category_id）
+            if 'category_id' not in a:
+                a['category_id'] = categories[0]['id']
+            a.pop('category_name', None)
+
+            if 'bbox' in a:  # label里原本有bbox的，按points更新外接矩形
+                a['bbox'] = xywh[i]
+            elif 'segmentation' not in a:
+                # 只有points的，points就是shape的点集，可以直接用批量算好的结果
+                a['segmentation'] = [segmentation(i)]
+                a['bbox'] = int_xywh[i]
+            if 'points' in a or 'bbox' not in a:  # 其他少见的情况，直接用原版的函数处理
+                a = CocoGtData.gen_annotation(**a)
+            elif 'area' not in a:
+                a['area'] = int(a['bbox'][2] * a['bbox'][3])
+            annotations.append(a)
+
+        for im, i in zip(images, img_ids):
+            im['id'] = i
+
+        # 5 result
         gt_dict = CocoGtData.gen_gt_dict(images, annotations, categories)
         return gt_dict
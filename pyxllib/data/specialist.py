@@ -4,11 +4,77 @@
 # @Email  : 877362867@qq.com
 # @Date   : 2021/06/06 11:16
 
+import concurrent.futures
+import mmap
+import os
+import struct
 
 import numpy as np
 
-from pyxllib.file.pupil import struct_unpack
-from pyxllib.file.specialist import XlBytesIO
+from pyxllib.file.specialist import Dir
+
+
+def _open_buffer(dgrl):
+    """ 文件用mmap映射，不会一次性读入内存；bytes等二进制数据则直接使用
+
+    mmap不需要显式关闭，在所有引用它的数组都释放后会自动关闭
+    """
+    if isinstance(dgrl, (bytes, bytearray, memoryview)):
+        return dgrl
+    with open(str(dgrl), 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:  # 空文件不能mmap
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _line_bitmap(buf, h, w, offset):
+    """ buf中offset位置开始的h*w图片，返回只读视图 """
+    if h * w:
+        return np.frombuffer(buf, dtype=np.uint8, count=h * w, offset=offset).reshape(h, w)
+    return np.zeros((h, w), dtype=np.uint8)
+
+
+def _dgrl_lines(buf):
+    """ 解析dgrl的结构信息，不读取图片数据
+
+    :param buf: dgrl的二进制数据，支持切片操作的bytes、mmap等
+    :return: generator，每行文本返回 (label, y, x, h, w, offset)，offset是该行图片数据在buf中的起始位置
+    """
+    # 表头尺寸，表头最后4个字节中的前2个字节是 code_length
+    header_size, = struct.unpack_from('<I', buf, 0)
+    code_length, = struct.unpack_from('<H', buf, header_size - 4)  # 每个字符存储的字节数，一般都是用gbk编码，2个字节
+    # 读取图像尺寸信息，文本行数量
+    height, width, line_num = struct.unpack_from('<3I', buf, header_size)
+
+    pos = header_size + 12
+    for k in range(line_num):
+        # 读取该行的字符数量、文本
+        char_num, = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        label = bytes(buf[pos:pos + code_length * char_num]).decode('gbk', 'ignore')
+        label = label.replace('\x00', '')  # 去掉不可见字符 \x00，这一步不加的话后面保存的内容会出现看不见的问题
+        pos += code_length * char_num
+
+        # 读取该行的位置和尺寸
+        y, x, h, w = struct.unpack_from('<4I', buf, pos)
+        pos += 16
+
+        yield label, y, x, h, w, pos
+        pos += h * w
+
+
+def iter_dgrl(dgrl):
+    """ 逐行解析中科院的DGRL格式数据
+
+    文件是用mmap映射的，每行图片都是 np.frombuffer 直接引用原数据的只读视图，不会复制像素数据，
+    需要修改图片时要先 .copy()；在这些图片释放前，文件会一直处于映射状态（windows下不能移动、删除）
+
+    :param dgrl: dgrl 格式的文件，或者对应的二进制数据
+    :return: generator，每次返回一行的 (img, label)，img是h*w的uint8矩阵
+    """
+    buf = _open_buffer(dgrl)
+    for label, y, x, h, w, offset in _dgrl_lines(buf):
+        yield _line_bitmap(buf, h, w, offset), label
 
 
 def read_from_dgrl(dgrl):
@@ -26,32 +92,89 @@ def read_from_dgrl(dgrl):
 
     :param dgrl: dgrl 格式的文件，或者对应的二进制数据流
     :return: [(img0, label0), (img1, label1), ...]
+        img是可以直接修改的int矩阵，跟原数据无关，返回时文件已经关闭
+        数据量大时建议用 iter_dgrl 迭代处理，不会复制像素数据
     """
-    # 输入参数可以是bytes，也可以是文件
-    f = XlBytesIO(dgrl)
-    # 表头尺寸
-    header_size = f.unpack('I')
-    # 表头剩下内容，提取 code_length
-    header = f.read(header_size - 4)
-    code_length = struct_unpack(header[-4:-2], 'H')  # 每个字符存储的字节数，一般都是用gbk编码，2个字节
-    # 读取图像尺寸信息，文本行数量
-    height, width, line_num = f.unpack('I' * 3)
+    buf = _open_buffer(dgrl)
+    try:
+        return [(_line_bitmap(buf, h, w, offset).astype(int), label) for label, y, x, h, w, offset in _dgrl_lines(buf)]
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
 
-    # 读取每一行的信息
-    res = []
-    for k in range(line_num):
-        # 读取该行的字符数量
-        char_num = f.unpack('I')
-        label = f.readtext(char_num, code_length=code_length)
-        label = label.replace('\x00', '')  # 去掉不可见字符 \x00，这一步不加的话后面保存的内容会出现看不见的问题
 
-        # 读取该行的位置和尺寸
-        y, x, h, w = f.unpack('I' * 4)
+def _convert_dgrl_file(task):
+    """ 把一个dgrl文件的所有行图片数据拼接存储到dst，返回每行的索引信息 """
+    src, dst = task
+    buf = _open_buffer(src)
+    records = []
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(dst, 'wb') as f:
+        for label, y, x, h, w, offset in _dgrl_lines(buf):
+            records.append((f.tell(), h, w, y, x, label))
+            f.write(buf[offset:offset + h * w])
+    return records
+
+
+def convert_dgrl_dir(src, dst, *, max_workers=None, printf=False):
+    """ 把目录下所有dgrl文件批量转换成带索引的存储格式
+
+    每个 a/b.dgrl 文件转成 dst/a/b.bin，里面只有所有行图片的像素数据，按顺序拼接
+    所有行的位置、尺寸、标签等信息汇总在 dst/index.csv，之后可以用 DgrlLines 按下标读取
+
+    :param src: 含有dgrl文件的目录，会递归检索子目录
+    :param dst: 转换结果存储的目录
+    :param max_workers: 进程数，默认按cpu数量开进程池，每个进程处理一个dgrl文件
+    :return: DgrlLines(dst)
+    """
+    import pandas as pd
+    from tqdm import tqdm
+
+    # 1 要转换的文件清单
+    relpaths = [os.path.relpath(str(f), str(src)) for f in Dir(src).select_files('**/*.dgrl')]
+    bin_files = [os.path.splitext(x)[0].replace('\\', '/') + '.bin' for x in relpaths]
+    tasks = [(os.path.join(str(src), x), os.path.join(str(dst), y)) for x, y in zip(relpaths, bin_files)]
+
+    # 2 并行转换
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        results = list(tqdm(executor.map(_convert_dgrl_file, tasks), 'convert_dgrl_dir',
+                            total=len(tasks), disable=not printf))
+
+    # 3 汇总索引
+    columns = ['offset', 'height', 'width', 'y', 'x', 'label']
+    dfs = [pd.DataFrame.from_records(records, columns=columns).assign(file=f) for f, records in zip(bin_files, results)]
+    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=columns + ['file'])
+    df[['file'] + columns].to_csv(os.path.join(str(dst), 'index.csv'), index=False)
+    return DgrlLines(dst)
+
+
+class DgrlLines:
+    """ convert_dgrl_dir 转换出的数据，可以按下标随机读取任意一行
+
+    像素文件用mmap映射，读取到的图片是只读视图，不会把整个数据集载入内存
+    """
+
+    def __init__(self, root):
+        import pandas as pd
+
+        self.root = str(root)
+        # label可能是"NA"等特殊文本，不能解析成空值
+        self.index = pd.read_csv(os.path.join(self.root, 'index.csv'), keep_default_na=False,
+                                 dtype={'file': str, 'label': str})
+        self._buffers = {}
 
-        # 读取该行的图片
-        bitmap = f.unpack('B' * (h * w))
-        bitmap = np.array(bitmap).reshape(h, w)
+    def __len__(self):
+        return len(self.index)
 
-        res.append((bitmap, label))
+    def __getitem__(self, idx):
+        """
+        :return: (img, label)
+        """
+        file, offset, h, w, label = self.index.iloc[idx][['file', 'offset', 'height', 'width', 'label']]
+        if file not in self._buffers:
+            self._buffers[file] = _open_buffer(os.path.join(self.root, file))
+        return _line_bitmap(self._buffers[file], h, w, offset), label
 
-    return res
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -198,7 +198,7 @@ class DPrint:
 
 
 def format_exception(e):
-    return ''.join(traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__))
+    return ''.join(traceback.format_exception(type(e), e, e.__traceback__))
 
 
 def prettifystr(s):
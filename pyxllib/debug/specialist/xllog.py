@@ -4,14 +4,15 @@
 # @Email  : 877362867@qq.com
 # @Date   : 2020/09/18 22:16
 
+import functools
 import os
-import concurrent.futures
 import math
+import pickle
 import time
 import sys
 
 from pyxllib.text.pupil import shorten
-from pyxllib.prog.pupil import EmptyPoolExecutor
+from pyxllib.prog.pupil import parallel_map
 from pyxllib.debug.pupil import format_exception
 
 XLLOG_CONF_FILE = 'xllog.yaml'
@@ -60,6 +61,92 @@ def get_xllog(*, log_file=None):
     return logging.getLogger('pyxllib.xllog')
 
 
+def _iterate_error(e):
+    """ 把异常转成能跨进程传递的 (异常, 报错信息文本) """
+    msg = format_exception(e)
+    try:
+        pickle.loads(pickle.dumps(e))
+    except Exception:
+        e = RuntimeError(repr(e))
+    return e, msg
+
+
+def _iterate_prefetch(prefetch, task):
+    """ Iterate.run的预读步骤，在线程池中执行 """
+    i, item = task
+    try:
+        return i, prefetch(item), None
+    except Exception as e:
+        return i, None, _iterate_error(e)
+
+
+def _iterate_call(func, task):
+    """ Iterate.run对每个条目的处理，异常也作为返回值传回，由主进程输出日志
+
+    :param task: (i, item) 或者预读后的 (i, data, error)
+    """
+    i, item, error = task if len(task) == 3 else (*task, None)
+    if error is None:
+        try:
+            func(item)
+        except Exception as e:
+            error = _iterate_error(e)
+    return i, error
+
+
+async def _iterate_acall(func, task):
+    """ _iterate_call 的协程版，backend='asyncio'时使用 """
+    i, item = task
+    try:
+        await func(item)
+    except Exception as e:
+        return i, _iterate_error(e)
+    return i, None
+
+
+class IterateCheckpoint:
+    """ Iterate.run 的断点记录，用位图记下已经成功处理的条目编号
+
+    文件格式：8字节的MAGIC，8字节的条目总数，之后每个条目占1个bit
+    每隔interval秒才写一次磁盘，写入是先写临时文件再替换，中途崩溃也不会损坏记录
+    """
+    MAGIC = b'XLITER01'
+
+    def __init__(self, file, n_items, interval=10):
+        self.file = str(file)
+        self.n_items = n_items
+        self.interval = interval
+        self.bitmap = bytearray((n_items + 7) // 8)
+        if os.path.isfile(self.file):
+            with open(self.file, 'rb') as f:
+                head = f.read(16)
+                if head[:8] != self.MAGIC or int.from_bytes(head[8:], 'little') != n_items:
+                    raise ValueError(f'断点文件 {self.file} 跟当前数据的条目数不匹配，无法续跑')
+                f.readinto(self.bitmap)
+        self.last_save = time.time()
+
+    def __contains__(self, i):
+        return bool(self.bitmap[i >> 3] & (1 << (i & 7)))
+
+    def __len__(self):
+        """ 已完成的条目数 """
+        return bin(int.from_bytes(self.bitmap, 'little')).count('1')
+
+    def add(self, i):
+        self.bitmap[i >> 3] |= 1 << (i & 7)
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        from pyxllib.file.specialist import atomic_open
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.file)), exist_ok=True)
+        with atomic_open(self.file, 'wb') as f:
+            f.write(self.MAGIC + self.n_items.to_bytes(8, 'little'))
+            f.write(self.bitmap)
+        self.last_save = time.time()
+
+
 class Iterate:
     """ 迭代器类，用来封装一些特定模式的for循环操作
 
@@ -102,30 +189,45 @@ class Iterate:
             end = len(self.items)
         return start, end
 
-    def _step3_executor(self, pinterval, max_workers):
-        if max_workers == 1:
-            # workers=1，实际上并不用多线程，用一个假的多线程类代替，能大大提速
-            executor = EmptyPoolExecutor()
-            # executor = concurrent.futures.ThreadPoolExecutor(max_workers)
-        else:
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
-            if pinterval:
-                self.xllog.info(f'多线程执行，当前迭代所用线程数：{executor._max_workers}')
-        return executor
-
-    def _step4_iter(self, i, pinterval, executor):
-        # 队列中没有新任务时，才放入新任务，这样能确保pinterval的输出能反应实时情况，而不是一下全部进入队列，把for循环跑完了
-        while executor._work_queue.qsize(): pass
-        if pinterval and (i or pinterval == 1) and i % pinterval == 0:
-            message = f' {self.items[i]}' if pinterval == 1 else ''
-            self.xllog.info(f'{i:{self.format_width}d}/{self.n_items}={i / self.n_items:6.2%}{message}')
-
-    def _step5_finish(self, pinterval, interrupt, start_time):
+    def _step3_check_workers(self, pinterval, max_workers, backend):
+        if max_workers != 1 and pinterval:
+            name = {'thread': '多线程', 'process': '多进程', 'hybrid': '多线程读取+多进程',
+                    'asyncio': '协程'}.get(backend, backend)
+            if backend == 'asyncio':
+                n = max_workers or 100
+            else:
+                n = max_workers or (os.cpu_count() if backend != 'thread' else min(32, (os.cpu_count() or 1) + 4))
+            self.xllog.info(f'{name}执行，当前迭代所用并行数：{n}')
+
+    def _step4_iter(self, i, pinterval, progress=None):
+        """ 每完成一个条目才更新进度，pinterval的输出能反应实时情况
+
+        :param progress: (本次已完成数, 本次要处理的总数, 开始时间)，用来计算速度和预计剩余时间
+        """
+        if not pinterval:
+            return
+        # 断点续跑时编号不连续，所以是看有没有跨过新的pinterval区间
+        bucket = i // pinterval if (i or pinterval == 1) else 0
+        if bucket <= self._last_bucket:
+            return
+        self._last_bucket = bucket
+
+        message = f' {self.items[i]}' if pinterval == 1 else ''
+        if progress:
+            from humanfriendly import format_timespan
+            n_done, n_total, start_time = progress
+            span = time.time() - start_time
+            if span and n_done:
+                speed = n_done / span
+                message += f'，{speed:.2f}it/s，预计剩余{format_timespan((n_total - n_done) / speed)}'
+        self.xllog.info(f'{i:{self.format_width}d}/{self.n_items}={i / self.n_items:6.2%}{message}')
+
+    def _step5_finish(self, pinterval, interrupt, start_time, n_done=None):
         from humanfriendly import format_timespan
         end_time = time.time()
         span = end_time - start_time
         if span:
-            speed = self.n_items / span
+            speed = (self.n_items if n_done is None else n_done) / span
             msg = f'总用时：{format_timespan(span)}，速度：{speed:.2f}it/s'
         else:
             msg = f'总用时：{format_timespan(span)}'
@@ -133,7 +235,9 @@ class Iterate:
             self.xllog.info(f'{self.n_items / self.n_items:6.2%} 完成迭代，{msg}')
             sys.stderr.flush()
 
-    def run(self, func, start=0, end=None, pinterval=None, max_workers=1, interrupt=True):
+    def run(self, func, start=0, end=None, pinterval=None, max_workers=1, interrupt=True, chunksize=1,
+            backend='thread', prefetch=None, prefetch_workers=None, checkpoint=None, checkpoint_interval=10,
+            context=None):
         """
         :param func: 对每个item执行的功能
         :param start: 跳过<start的数据，只处理>=start编号以上
@@ -144,6 +248,20 @@ class Iterate:
         :param max_workers: 默认线程数，默认1，即串行
         :type max_workers: int, None
         :param interrupt: 出现错误时是否中断，默认True会终止程序，否则只会输出错误日志
+        :param chunksize: 并行时每次提交的条目数，条目很多、func很快时可以调大，详见 bounded_map
+        :param backend: 并行方式，详见 parallel_map
+            'thread'，线程池
+            'process'，进程池，cpu密集的任务用这个才能用满多核，func要是模块层级定义的函数
+            'hybrid'，prefetch用线程池读数据，func用进程池计算
+            'asyncio'，func是协程函数，在事件循环里并发执行，max_workers是并发数（None时为100）
+        :param prefetch: 预读函数，设置后func的输入变成 prefetch(item)
+        :param prefetch_workers: prefetch的线程数
+        :param checkpoint: 断点记录文件，详见 IterateCheckpoint
+            会记录成功处理的条目，重新运行时跳过这些条目，出错的条目下次会重新处理
+            条目的顺序要保持不变，例如文件清单要排序；想全部重跑时删掉这个文件即可
+        :param checkpoint_interval: 每隔多少秒保存一次断点记录，结束、出错时也会保存
+        :param context: backend='asyncio'时可选的异步上下文管理器，例如 AsyncHttp 客户端，
+            会在所有任务开始前进入、结束后退出，func里可以直接使用
         :return:
         """
 
@@ -152,24 +270,44 @@ class Iterate:
         self._step1_check_number(pinterval, func)
         start, end = self._step2_check_range(start, end)
         error = False
-        executor = self._step3_executor(pinterval, max_workers)
-
-        # 2 封装的子处理部分
-        def wrap_func(func, i):
-            nonlocal error
-            item = self.items[i]
-            try:
-                func(item)
-            except Exception as e:
-                error = e
-                self.xllog.error(f'💔idx={i}运行出错：{item}\n{format_exception(e)}')
-
-        # 3 执行迭代
+        self._step3_check_workers(pinterval, max_workers, backend)
+
+        indices = range(start, end)
+        ckpt = None
+        if checkpoint:
+            ckpt = IterateCheckpoint(checkpoint, self.n_items, checkpoint_interval)
+            if len(ckpt):
+                indices = [i for i in indices if i not in ckpt]
+                self.xllog.info(f'断点续跑，跳过已完成的{end - start - len(indices)}个条目，剩余{len(indices)}个')
+
+        # 2 封装的子处理部分，异常都在worker里捕获，作为结果返回
+        tasks = ((i, self.items[i]) for i in indices)
+        if prefetch is not None:
+            prefetch = functools.partial(_iterate_prefetch, prefetch)
+        if backend == 'asyncio':
+            results = parallel_map(functools.partial(_iterate_acall, func), tasks, max_workers, backend=backend,
+                                   prefetch=prefetch, context=context)
+        else:
+            results = parallel_map(functools.partial(_iterate_call, func), tasks, max_workers, backend=backend,
+                                   prefetch=prefetch, prefetch_workers=prefetch_workers, chunksize=chunksize)
+
+        # 3 执行迭代，按顺序取回每个条目的完成情况
         start_time = time.time()
-        for i in range(start, end):
-            self._step4_iter(i, pinterval, executor)
-            executor.submit(wrap_func, func, i)
-            if interrupt and error:
-                raise error
-        executor.shutdown()  # 必须等executor结束，error才是准确的
-        self._step5_finish(pinterval, interrupt and error, start_time)
+        self._last_bucket = -1 if pinterval == 1 else 0
+        n_done = 0
+        try:
+            for i, e in results:
+                n_done += 1
+                if e:
+                    error, msg = e
+                    self.xllog.error(f'💔idx={i}运行出错：{self.items[i]}\n{msg}')
+                elif ckpt is not None:
+                    ckpt.add(i)
+                self._step4_iter(i, pinterval, (n_done, len(indices), start_time))
+                if interrupt and error:
+                    raise error
+        finally:
+            results.close()  # 中断时及时取消还没执行的任务
+            if ckpt is not None:
+                ckpt.save()
+        self._step5_finish(pinterval, interrupt and error, start_time, n_done)
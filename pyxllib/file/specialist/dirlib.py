@@ -7,6 +7,8 @@
 
 import collections
 import filecmp
+import fnmatch
+import functools
 import os
 import pathlib
 import random
@@ -29,6 +31,10 @@ ____dir = """
 """
 
 
+def _star_call(func, args):
+    return func(*args)
+
+
 class Dir(PathBase):
     r"""类似NestEnv思想的文件夹处理类
 
@@ -238,12 +244,15 @@ class Dir(PathBase):
                      ignore_backup=False, ignore_special=False,
                      min_size=None, max_size=None,
                      min_ctime=None, max_ctime=None, min_mtime=None, max_mtime=None):
-        """ TODO 这系列的功能可以优化加速，在没有复杂规则的情况下，可以尽量用源生的py检索方式实现 """
-        subs = filesmatch(patter, root=str(self), type_='file',
-                          ignore_backup=ignore_backup, ignore_special=ignore_special,
-                          min_size=min_size, max_size=max_size,
-                          min_ctime=min_ctime, max_ctime=max_ctime,
-                          min_mtime=min_mtime, max_mtime=max_mtime)
+        """ 检索文件，返回File的迭代器
+
+        :param nsort: 自然排序需要先获得所有结果，设为False时边检索边返回，适合文件非常多的目录
+        """
+        subs = ifilesmatch(patter, root=str(self), type_='file',
+                           ignore_backup=ignore_backup, ignore_special=ignore_special,
+                           min_size=min_size, max_size=max_size,
+                           min_ctime=min_ctime, max_ctime=max_ctime,
+                           min_mtime=min_mtime, max_mtime=max_mtime)
         if nsort:
             subs = natural_sort(subs)
         for x in subs:
@@ -253,11 +262,11 @@ class Dir(PathBase):
                     ignore_backup=False, ignore_special=False,
                     min_size=None, max_size=None,
                     min_ctime=None, max_ctime=None, min_mtime=None, max_mtime=None):
-        subs = filesmatch(patter, root=str(self), type_='dir',
-                          ignore_backup=ignore_backup, ignore_special=ignore_special,
-                          min_size=min_size, max_size=max_size,
-                          min_ctime=min_ctime, max_ctime=max_ctime,
-                          min_mtime=min_mtime, max_mtime=max_mtime)
+        subs = ifilesmatch(patter, root=str(self), type_='dir',
+                           ignore_backup=ignore_backup, ignore_special=ignore_special,
+                           min_size=min_size, max_size=max_size,
+                           min_ctime=min_ctime, max_ctime=max_ctime,
+                           min_mtime=min_mtime, max_mtime=max_mtime)
         if nsort:
             subs = natural_sort(subs)
         for x in subs:
@@ -267,17 +276,18 @@ class Dir(PathBase):
                      ignore_backup=False, ignore_special=False,
                      min_size=None, max_size=None,
                      min_ctime=None, max_ctime=None, min_mtime=None, max_mtime=None):
-        subs = filesmatch(patter, root=str(self),
-                          ignore_backup=ignore_backup, ignore_special=ignore_special,
-                          min_size=min_size, max_size=max_size,
-                          min_ctime=min_ctime, max_ctime=max_ctime,
-                          min_mtime=min_mtime, max_mtime=max_mtime)
+        subs = ifilesmatch(patter, root=str(self),
+                           ignore_backup=ignore_backup, ignore_special=ignore_special,
+                           min_size=min_size, max_size=max_size,
+                           min_ctime=min_ctime, max_ctime=max_ctime,
+                           min_mtime=min_mtime, max_mtime=max_mtime)
         if nsort:
             subs = natural_sort(subs)
         for x in subs:
             yield self._path / x
 
-    def procpaths(self, func, start=None, end=None, ref_dir=None, pinterval=None, max_workers=1, interrupt=True):
+    def procpaths(self, func, start=None, end=None, ref_dir=None, pinterval=None, max_workers=1, interrupt=True,
+                  **kwargs):
         """ 对选中的文件迭代处理
 
         :param func: 对每个文件进行处理的自定义接口函数
@@ -286,6 +296,9 @@ class Dir(PathBase):
                 TODO 以后可以返回字典结构，用不同的key表示不同的功能，可以控制些高级功能
         :param ref_dir: 使用该参数时，则每次会给func传递两个路径参数
             第一个是原始的file，第二个是ref_dir目录下对应路径的file
+        :param kwargs: 并行相关的参数，详见 Iterate.run
+            backend: 'thread'、'process'、'hybrid'，cpu密集的处理可以用进程池
+            chunksize、prefetch、prefetch_workers
 
         TODO 增设可以bfs还是dfs的功能？
 
@@ -305,9 +318,7 @@ class Dir(PathBase):
             paths1 = self.subpaths()
             paths2 = [(ref_dir / self.subs[i]) for i in range(len(self.subs))]
 
-            def wrap_func(data):
-                func(*data)
-
+            wrap_func = functools.partial(_star_call, func)  # 进程池要求能pickle，不能用局部函数
             data = zip(paths1, paths2)
 
         else:
@@ -315,7 +326,7 @@ class Dir(PathBase):
             wrap_func = func
 
         Iterate(data).run(wrap_func, start=start, end=end, pinterval=pinterval,
-                          max_workers=max_workers, interrupt=interrupt)
+                          max_workers=max_workers, interrupt=interrupt, **kwargs)
 
     def select_invert(self, patter='**/*', nsort=True, **kwargs):
         """ 反选，在"全集"中，选中当前状态下没有被选中的那些文件
@@ -406,6 +417,79 @@ def filescmp(f1, f2, shallow=True):
     return cmp
 
 
+_SPECIAL_NAMES = ('.git', '$RECYCLE.BIN')  # ignore_special要跳过的目录
+
+
+def _to_timestamp(t):
+    """ 把各种格式的时间转成跟 os.stat 的 st_mtime 可比较的时间戳
+
+    跟 Datetime(st_mtime) 比较的结果一致，都是按本地时间算的
+    """
+    from pyxllib.debug.specialist.datetime import Datetime
+    return Datetime(t).naive.timestamp()
+
+
+def _is_backup_name(name):
+    """ 同 File.backup_time，但直接分析文件名，不用构造File对象 """
+    stem = os.path.splitext(name)[0]
+    return len(stem) >= 14 and re.match(r'\d{6}-\d{6}', stem[-13:]) is not None
+
+
+def _path_judge(type_=None, ignore_backup=False, ignore_special=False,
+                min_size=None, max_size=None,
+                min_ctime=None, max_ctime=None,
+                min_mtime=None, max_mtime=None):
+    """ 把filesfilter的筛选条件预处理好，返回判断函数 judge(path, entry=None)
+
+    时间条件会先统一转成时间戳，每个文件只需要比较数值
+    有entry（os.DirEntry）时，复用其缓存的文件类型、stat信息
+
+    :return: 没有任何筛选条件时返回None
+    """
+    times = [None if t is None else _to_timestamp(t) for t in (min_ctime, max_ctime, min_mtime, max_mtime)]
+    min_ctime, max_ctime, min_mtime, max_mtime = times
+    check_size = min_size is not None or max_size is not None
+    check_stat = check_size or any(t is not None for t in times)
+    if not (type_ or ignore_backup or ignore_special or check_stat):
+        return None
+
+    def judge(f, entry=None):
+        # 1 类型
+        if type_ == 'file' and not (entry.is_file() if entry else os.path.isfile(f)):
+            return False
+        elif type_ == 'dir' and not (entry.is_dir() if entry else os.path.isdir(f)):
+            return False
+
+        # 2 大小、时间
+        if check_stat:
+            try:
+                st = entry.stat() if entry else os.stat(f)
+            except OSError:
+                return False
+            if check_size:
+                # 目录的大小是递归算出的总大小，同 Dir.size
+                size = Dir(f, check=False).size if os.path.isdir(f) else st.st_size
+                if min_size is not None and size < min_size: return False
+                if max_size is not None and size > max_size: return False
+            if min_ctime is not None and st.st_ctime < min_ctime: return False
+            if max_ctime is not None and st.st_ctime > max_ctime: return False
+            if min_mtime is not None and st.st_mtime < min_mtime: return False
+            if max_mtime is not None and st.st_mtime > max_mtime: return False
+
+        # 3 特殊目录，有entry的是scandir检索出来的，已经在目录层面跳过了
+        if ignore_special and entry is None:
+            parts = pathlib.Path(f).parts
+            if any(x in parts for x in _SPECIAL_NAMES):
+                return False
+
+        if ignore_backup and _is_backup_name(os.path.basename(f)):
+            return False
+
+        return True
+
+    return judge
+
+
 def filesfilter(files, *, root=os.curdir, type_=None,
                 ignore_backup=False, ignore_special=False,
                 min_size=None, max_size=None,
@@ -427,46 +511,129 @@ def filesfilter(files, *, root=os.curdir, type_=None,
     :param max_mtime: ~
     :return:
     """
-    from pyxllib.debug.specialist.datetime import Datetime
+    judge = _path_judge(type_, ignore_backup, ignore_special, min_size, max_size,
+                        min_ctime, max_ctime, min_mtime, max_mtime)
+    if judge is None:
+        return list(files)
+    root = os.path.abspath(root)
+    return [f for f in files if judge(os.path.join(root, f))]
 
-    def judge(f):
-        if root: f = os.path.join(root, f)
-        if type_ == 'file' and not os.path.isfile(f):
-            return False
-        elif type_ == 'dir' and not os.path.isdir(f):
-            return False
 
-        # 尽量避免调用 os.stat，判断是否有自定义大小、时间规则，没有可以跳过这部分
-        check_arg = first_nonnone([min_size, max_size, min_ctime, max_ctime, min_mtime, max_mtime])
-        if check_arg is not None:
-            msg = os.stat(f)
-            if first_nonnone([min_size, max_size]) is not None:
-                size = File(f).size
-                if min_size is not None and size < min_size: return False
-                if max_size is not None and size > max_size: return False
+def _scandir(path, skip_names=()):
+    """ 列出目录下的DirEntry，跳过skip_names里的名称，无法访问的目录返回[] """
+    try:
+        with os.scandir(path) as it:
+            return [e for e in it if e.name not in skip_names]
+    except OSError:
+        return []
 
-            if min_ctime or max_ctime:
-                file_ctime = msg.st_ctime
-                if min_ctime and Datetime(file_ctime) < min_ctime: return False
-                if max_ctime and Datetime(file_ctime) > max_ctime: return False
 
-            if min_mtime or max_mtime:
-                file_mtime = msg.st_mtime
-                if min_mtime and Datetime(file_mtime) < min_mtime: return False
-                if max_mtime and Datetime(file_mtime) > max_mtime: return False
+def _entry_is_dir(entry, follow_symlinks=True):
+    try:
+        return entry.is_dir(follow_symlinks=follow_symlinks)
+    except OSError:
+        return False
 
-        if ignore_special:
-            parts = File(f).parts
-            if '.git' in parts or '$RECYCLE.BIN' in parts:
-                return False
 
-        if ignore_backup and File(f).backup_time:
-            return False
+def _glob_entries(entries, prefix, matchers, skip_names):
+    """ 在已经列出的entries上继续匹配matchers，返回 (相对路径, DirEntry)
 
-        return True
+    跟pathlib.Path.glob规则相同：'**'匹配任意层子目录（不进入符号链接的目录），
+    '**'在末尾时只匹配目录，且也能匹配0层，即前一段匹配到的目录自身，每个目录只用os.scandir列出一次
+    """
+    matcher, rest = matchers[0], matchers[1:]
+    only_stars = rest and not any(rest)  # 后面只剩'**'，匹配到的目录自身也算结果
+    if matcher is None:  # '**'
+        if rest:
+            yield from _glob_entries(entries, prefix, rest, skip_names)
+        for e in entries:
+            if _entry_is_dir(e) and not e.is_symlink():
+                if not rest:
+                    yield prefix + e.name, e
+                yield from _glob_entries(_scandir(e.path, skip_names), prefix + e.name + '/', matchers, skip_names)
+    else:
+        for e in entries:
+            if matcher(e.name):
+                if not rest:
+                    yield prefix + e.name, e
+                elif _entry_is_dir(e):
+                    if only_stars:
+                        yield prefix + e.name, e
+                    yield from _glob_entries(_scandir(e.path, skip_names), prefix + e.name + '/', rest, skip_names)
+
+
+def iglob_entries(dirname, patter, *, skip_names=()):
+    r""" 基于os.scandir的glob，返回 (相对dirname的路径, os.DirEntry) 的迭代器
 
+    DirEntry带有scandir时缓存的文件类型信息，后续筛选可以少调用很多次os.stat
+
+    >> list(iglob_entries('.', '**/*.png'))
+    [('1.png', <DirEntry '1.png'>), ('a/2.png', <DirEntry '2.png'>)]
+
+    :param patter: 用'/'分隔的glob模式，支持 *、?、[seq]、**
+    :param skip_names: 名称在其中的文件、目录都直接跳过，也不会进入这些目录检索
+    """
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    parts = [x for x in patter.split('/') if x and x != '.']
+    if not parts:
+        return
+    matchers = [None if x == '**' else re.compile(fnmatch.translate(x), flags).match for x in parts]
+    items = _glob_entries(_scandir(dirname, skip_names), '', matchers, skip_names)
+    if matchers.count(None) > 1:  # 有多个'**'时同一个路径可能匹配多次
+        items = {k: e for k, e in items}.items()
+    yield from items
+
+
+def ifilesmatch(patter, *, root=os.curdir, **kwargs):
+    """ filesmatch的迭代器版本，边检索边返回结果，参数详见filesmatch """
     root = os.path.abspath(root)
-    return list(filter(judge, files))
+    judge = _path_judge(**kwargs)
+    skip_names = _SPECIAL_NAMES if kwargs.get('ignore_special') else ()
+
+    # 1 普通文本匹配  （没有通配符，单文件查找）
+    if isinstance(patter, str) and strfind(patter, ('*', '?', '<', '>')) == -1:
+        p = str(pathlib.Path(os.path.join(root, patter)).resolve())
+        if os.path.exists(p) and (judge is None or judge(p)):
+            if p.startswith(root + os.sep): p = p[len(root) + 1:]
+            yield p.replace('\\', '/')
+    # 2 glob通配符匹配
+    elif isinstance(patter, str):
+        patter = patter.replace('\\', '/')
+        t = patter[:strfind(patter, ('*', '?', '<', '>'))].rfind('/')
+        # 计算出这批文件实际所在的目录dirname
+        if t == -1:  # 模式里没有套子文件夹
+            dirname, basename = root, patter
+        else:  # 模式里有套子文件夹
+            dirname, basename = os.path.abspath(os.path.join(root, patter[:t])), patter[t + 1:]
+        if skip_names and any(x in pathlib.Path(dirname).parts for x in skip_names):
+            return
+        basename = basename.replace('<', '[').replace('>', ']')
+
+        # 返回的是相对root的路径，dirname不在root下的则返回绝对路径
+        if dirname == root:
+            prefix = ''
+        elif dirname.startswith(root + os.sep):
+            prefix = dirname[len(root) + 1:].replace('\\', '/') + '/'
+        else:
+            prefix = dirname.replace('\\', '/') + '/'
+        # 'a/**'这类'**'前面有目录的，跟pathlib一样也要匹配目录a自身
+        if prefix and all(x == '**' for x in basename.split('/') if x) and os.path.isdir(dirname) \
+                and (judge is None or judge(dirname)):
+            yield prefix[:-1]
+        for x, entry in iglob_entries(dirname, basename, skip_names=skip_names):
+            if judge is None or judge(entry.path, entry):
+                yield prefix + x
+    # 3 正则匹配 （只要有match成员函数就行，不一定非要正则对象）
+    elif hasattr(patter, 'match'):
+        for x, entry in iglob_entries(root, '**/*', skip_names=skip_names):
+            if patter.match(x if os.sep == '/' else x.replace('/', os.sep)) and (judge is None or judge(entry.path, entry)):
+                yield x
+    # 4 list等迭代对象
+    elif isinstance(patter, (list, tuple, set)):
+        for p in patter:
+            yield from ifilesmatch(p, root=root, **kwargs)
+    else:
+        raise TypeError
 
 
 def filesmatch(patter, *, root=os.curdir, **kwargs) -> list:
@@ -485,6 +652,8 @@ def filesmatch(patter, *, root=os.curdir, **kwargs) -> list:
             对每一个元素，递归调用filesmatch
     其他参数都是文件筛选功能，详见filesfilter中介绍
     :return: 匹配到的所有存在的文件、文件夹，返回“相对路径”
+        检索是用os.scandir实现的（见 iglob_entries），在遍历目录时就完成筛选，不会对结果排序
+        数据量很大时，可以用 ifilesmatch 迭代获取
 
     TODO patter大小写问题？会导致匹配缺失的bug吗？
 
@@ -511,6 +680,13 @@ def filesmatch(patter, *, root=os.curdir, **kwargs) -> list:
     ['1.png']
     >> filesmatch('[0-9]/<0-9>.txt')  # 用<0-9>表示[0-9]模式
     ['[0-9]\\3.txt']
+    >>> d = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(d, 'a/b/c'))
+    >>> sorted(filesmatch('a/**', root=d))  # 跟pathlib一样，'**'也能匹配0层，即目录a自身
+    ['a', 'a/b', 'a/b/c']
+    >>> sorted(filesmatch('a/*/**', root=d))
+    ['a/b', 'a/b/c']
+    >>> shutil.rmtree(d)
 
     3、正则模式
     >> filesmatch(re.compile(r'\d\[\.png$'))
@@ -522,51 +698,7 @@ def filesmatch(patter, *, root=os.curdir, **kwargs) -> list:
     >> filesmatch('**/*', type_='file', max_size=0)  # 筛选空文件
     ['b/a', '[0-9]/3.txt']
     """
-    from pathlib import Path
-    root = os.path.abspath(root)
-
-    # 0 规则匹配
-    # patter = str(patter)  # 200916周三14:59，这样会处理不了正则，要关掉
-    glob_chars_pos = strfind(patter, ('*', '?', '<', '>')) if isinstance(patter, str) else -1
-
-    # 1 普通文本匹配  （没有通配符，单文件查找）
-    if isinstance(patter, str) and glob_chars_pos == -1:
-        path = Path(os.path.join(root, patter))
-        if path:  # 文件存在
-            p = str(path.resolve())
-            if p.startswith(root): p = p[len(root) + 1:]
-            res = [p]
-        else:  # 文件不存在
-            res = []
-    # 2 glob通配符匹配
-    elif isinstance(patter, str) and glob_chars_pos != -1:
-        patter = patter.replace('\\', '/')
-        t = patter[:glob_chars_pos].rfind('/')
-        # 计算出这批文件实际所在的目录dirname
-        if t == -1:  # 模式里没有套子文件夹
-            dirname, basename = root, patter
-        else:  # 模式里有套子文件夹
-            dirname, basename = os.path.abspath(os.path.join(root, patter[:t])), patter[t + 1:]
-        basename = basename.replace('<', '[').replace('>', ']')
-        files = map(str, Path(dirname).glob(basename))
-
-        n = len(root) + 1
-        res = [(x[n:] if x.startswith(root) else x) for x in files]
-    # 3 正则匹配 （只要有match成员函数就行，不一定非要正则对象）
-    elif hasattr(patter, 'match'):
-        files = filesmatch('**/*', root=root)
-        res = list(filter(lambda x: patter.match(x), files))
-    # 4 list等迭代对象
-    elif isinstance(patter, (list, tuple, set)):
-        res = []
-        for p in patter: res += filesmatch(p, root=root)
-    else:
-        raise TypeError
-
-    # 2 filetype的筛选
-    res = filesfilter(res, root=root, **kwargs)
-
-    return [x.replace('\\', '/') for x in res]
+    return list(ifilesmatch(patter, root=root, **kwargs))
 
 
 def filesdel(path, **kwargs):
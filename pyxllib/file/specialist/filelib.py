@@ -6,9 +6,14 @@
 
 
 from typing import Callable, Any
+import codecs
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import io
 import json
+import mmap
 import os
 import pathlib
 import pickle
@@ -16,6 +21,7 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import ujson
 
 import chardet
@@ -165,15 +171,34 @@ def get_encoding_old(bstr):
 
 
 def get_encoding(bstr, *, maxn=100):
+    """ 分析二进制数据的编码
+
+    1、没有大于127的字节，是utf8
+    2、有utf8的BOM，是utf-8-sig；能按utf8严格解码的，是utf8
+    3、以上都不是，才用chardet分析，并统一成常见的编码名
+
+    前两步都是C实现的操作，绝大部分utf8文件都不会用到chardet
+
+    >>> get_encoding(b'abc'), get_encoding('中文'.encode('utf8')), get_encoding('中文'.encode('utf-8-sig'))
+    ('utf8', 'utf8', 'utf-8-sig')
+    """
     # 1 从第一个大于127的字节开始判断
-    for start_idx in range(len(bstr)):
-        if bstr[start_idx] > 127:
-            break
-    else:  # 没有>127的字节
+    m = re.search(rb'[\x80-\xff]', bstr)
+    if not m:  # 没有>127的字节
+        return 'utf8'
+    start_idx = m.start()
+
+    # 2 utf8的快速判断
+    if bstr[:3] == codecs.BOM_UTF8:
+        return 'utf-8-sig'
+    try:
+        codecs.decode(bstr, 'utf8')
         return 'utf8'
+    except UnicodeDecodeError:
+        pass
 
-    # 只要截取部分子节就能大概分析出了
-    enc = chardet.detect(bstr[start_idx:start_idx + maxn])['encoding']
+    # 3 只要截取部分子节就能大概分析出了
+    enc = chardet.detect(bytes(bstr[start_idx:start_idx + maxn]))['encoding']
 
     # 2 转换为常见编码名
     if enc in ('utf-8', 'ascii', 'ISO-8859-1', 'Windows-1252', 'Windows-1254', 'ISO-8859-9', 'IBM866'):
@@ -182,12 +207,123 @@ def get_encoding(bstr, *, maxn=100):
         return 'utf-8-sig'
     elif enc in ('GB2312', 'GBK'):
         return 'gbk'
+    elif enc in ('GB18030',):  # 新版chardet对gbk文本会识别为GB18030，它是gbk的超集
+        return 'gb18030'
     elif enc in ('UTF-16',):
         return 'utf16'
     else:
         raise ValueError(f"{enc}: Can't get file encoding")
 
 
+_ENCODING_CACHE = collections.OrderedDict()  # {(path, mtime_ns, size): encoding}
+_ENCODING_CACHE_LOCK = threading.Lock()
+
+
+def get_file_encoding(file, bstr=None, *, maxsize=65536):
+    """ 带缓存的文件编码识别
+
+    以 (路径, 修改时间, 文件大小) 为键缓存 get_encoding 的结果，重复读取没有变动的文件时不用再分析编码
+
+    :param bstr: 已经读取到的文件内容，没有的话会读取文件
+    :param maxsize: 最多缓存的文件数，超出后淘汰最久没用到的
+    """
+    file = os.path.abspath(str(file))
+    st = os.stat(file)
+    key = (file, st.st_mtime_ns, st.st_size)
+    with _ENCODING_CACHE_LOCK:
+        if key in _ENCODING_CACHE:
+            _ENCODING_CACHE.move_to_end(key)
+            return _ENCODING_CACHE[key]
+
+    if bstr is None:
+        with open(file, 'rb') as f:
+            bstr = f.read()
+    encoding = get_encoding(bstr)
+
+    with _ENCODING_CACHE_LOCK:
+        _ENCODING_CACHE[key] = encoding
+        while len(_ENCODING_CACHE) > maxsize:
+            _ENCODING_CACHE.popitem(last=False)
+    return encoding
+
+
+____write = """
+文件写入的底层功能
+"""
+
+
+@contextlib.contextmanager
+def atomic_open(file, mode='wb', *, buffering=-1, encoding=None, errors=None):
+    """ 原子写入文件
+
+    先写到同目录下的临时文件，全部写完并fsync落盘后再用 os.replace 替换目标文件，
+    中途出错、程序崩溃甚至断电，都不会留下只写了一半的目标文件
+
+    >>> with atomic_open(os.path.join(tempfile.gettempdir(), 'a.txt'), 'w', encoding='utf8') as f:
+    ...     _ = f.write('abc')
+
+    :param mode: 'wb'或'w'
+    :param buffering: 缓冲区大小，同open的buffering参数
+    """
+    file = str(file)
+    # 临时文件名带随机后缀，之前崩溃残留的临时文件不会影响后续写入；用'x'模式创建，权限跟普通open一样遵循umask
+    tmp = f'{file}.{os.getpid()}.{os.urandom(4).hex()}.tmp'
+    f = None
+    try:
+        f = open(tmp, mode.replace('w', 'x'), buffering=buffering, encoding=encoding, errors=errors)
+        with f:
+            yield f
+            # 数据确实写到磁盘后才能替换，否则断电后可能得到一个空的目标文件
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.isfile(file):  # 保留原文件的权限
+            shutil.copymode(file, tmp)
+        os.replace(tmp, file)
+    except BaseException:
+        if f is not None and os.path.exists(tmp):  # 只清理这次调用自己创建的临时文件
+            os.remove(tmp)
+        raise
+
+
+def _write_text(f, s, encoding, errors='strict'):
+    """ 往二进制文件对象f写入文本 """
+    w = io.TextIOWrapper(f, encoding=encoding, errors=errors)
+    w.write(s)
+    w.flush()
+    w.detach()  # 不能让w关闭f
+
+
+def _pkl_writer(f, ob, encoding, **kwargs):
+    """ 默认用protocol 5，numpy等数组对象的数据会直接写入文件，不用先复制成bytes """
+    DictTool.ior(kwargs, {'protocol': pickle.HIGHEST_PROTOCOL})
+    pickle.dump(ob, f, **kwargs)
+
+
+def _json_writer(f, ob, encoding, *, engine='ujson', **kwargs):
+    """
+    :param engine: 序列化使用的库
+        ujson: 默认值，kwargs同ujson.dump，ensure_ascii默认改成了False
+        orjson: 速度更快，直接生成utf8的bytes，支持numpy数组，但只支持 indent=None或2
+    """
+    if engine == 'orjson':
+        import orjson
+
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        bstr = orjson.dumps(ob, option=option)
+        if encoding and codecs.lookup(encoding).name != 'utf-8':
+            bstr = bstr.decode('utf8').encode(encoding)
+        f.write(bstr)
+    else:
+        DictTool.ior(kwargs, {'ensure_ascii': False})
+        _write_text(f, ujson.dumps(ob, **kwargs), encoding)
+
+
+def _yaml_writer(f, ob, encoding, **kwargs):
+    _write_text(f, yaml.dump(ob, **kwargs), encoding)
+
+
 ____file = """
 路径、文件、目录相关操作功能
 
@@ -539,6 +675,10 @@ class File(PathBase):
     """
     __slots__ = ('_path',)
 
+    # write使用的序列化接口，{mode: func(f, ob, encoding, **kwargs)}，f是二进制文件对象
+    # 可以注册新的格式，例如 File.WRITERS['.npy'] = lambda f, ob, encoding: np.save(f, ob)
+    WRITERS = {'.pkl': _pkl_writer, '.json': _json_writer, '.yaml': _yaml_writer}
+
     # 一、基础功能
 
     def __init__(self, path, root=None, *, suffix=None, check=True):
@@ -707,6 +847,11 @@ class File(PathBase):
             默认None，则在需要使用encoding参数的场合，会使用self.encoding自动判断编码
         :param mode: 读取模式（例如 '.json'），默认从扩展名识别，也可以强制指定
             'b': 特殊标记，表示按二进制读取文件内容
+            以下是大文件适用的模式，不会把整个文件读入内存
+            'mmap': 只读的内存映射，见 File.mmap
+            'lines': 逐行文本的迭代器，见 File.iter_lines
+            'chunks': 分块文本的迭代器，见 File.iter_chunks
+            'jsonl': 逐行解析json的迭代器，见 File.iter_jsonl
         :return:
         """
         if self:  # 如果存在这样的文件，那就读取文件内容
@@ -717,6 +862,14 @@ class File(PathBase):
             if mode == 'bytes':
                 with open(name, 'rb') as f:
                     return f.read()
+            elif mode == 'mmap':
+                return self.mmap()
+            elif mode == 'lines':
+                return self.iter_lines(encoding=encoding)
+            elif mode == 'chunks':
+                return self.iter_chunks(encoding=encoding)
+            elif mode == 'jsonl':
+                return self.iter_jsonl(encoding=encoding)
             elif mode == '.pkl':  # pickle库
                 with open(name, 'rb') as f:
                     return pickle.load(f)
@@ -724,7 +877,7 @@ class File(PathBase):
                 # 先读成字符串，再解析，会比rb鲁棒性更强，能自动过滤掉开头可能非正文特殊标记的字节
                 with open(name, 'rb') as f:
                     bstr = f.read()
-                    if not encoding: encoding = get_encoding(bstr)
+                    if not encoding: encoding = get_file_encoding(name, bstr)
                 try:
                     return ujson.loads(bstr.decode(encoding=encoding))
                 except ValueError:  # ujson会有些不太标准的情况处理不了
@@ -740,7 +893,7 @@ class File(PathBase):
                 with open(name, 'rb') as f:
                     bstr = f.read()
                 if not encoding:
-                    encoding = get_encoding(bstr)
+                    encoding = get_file_encoding(name, bstr)
                     if not encoding:
                         raise ValueError(f'{self} 自动识别编码失败，请手动指定文件编码')
                 s = bstr.decode(encoding=encoding, errors='ignore')
@@ -749,7 +902,113 @@ class File(PathBase):
         else:  # 非文件对象
             raise FileNotFoundError(f'{self} 文件不存在，无法读取。')
 
-    def write(self, ob, *, encoding='utf8', if_exists=None, mode=None, **kwargs):
+    def mmap(self):
+        """ 以只读的内存映射方式打开文件
+
+        返回的mmap对象支持切片、re、np.frombuffer、memoryview等操作，数据按需从磁盘载入，不会复制整个文件
+        mmap不需要显式关闭，在所有引用它的对象都释放后会自动关闭
+
+        :return: mmap对象，空文件无法映射，返回 b''
+        """
+        if not self:
+            raise FileNotFoundError(f'{self} 文件不存在，无法读取。')
+        with open(str(self), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def iter_chunks(self, chunksize=1 << 20, *, encoding=None, binary=False):
+        r""" 分块读取文件
+
+        文本是增量解码的，多字节字符、\r\n被截断在两块之间也能正确处理，
+        所有块拼接起来跟 read() 的结果相同
+
+        >>> f = File('a.txt', tempfile.gettempdir()).write(b'abc\n' * 4 + '中文'.encode('gbk'))
+        >>> ''.join(f.iter_chunks(4))
+        'abc\nabc\nabc\nabc\n中文'
+        >>> f.delete()
+
+        :param chunksize: 每次读取的字节数
+        :param encoding: 文件编码，默认用第1块的内容分析
+            前面的块都是ascii字符时，遇到解码不了的块会用这块的内容重新分析编码；
+            否则说明分析错了，为了不悄悄丢失数据，直接抛出UnicodeDecodeError，这时需要显式指定encoding
+        :param binary: 按二进制返回每块的bytes
+        :return: generator
+        """
+        if not self:
+            raise FileNotFoundError(f'{self} 文件不存在，无法读取。')
+        with open(str(self), 'rb') as f:
+            bstr = f.read(chunksize)
+            if binary:
+                while bstr:
+                    yield bstr
+                    bstr = f.read(chunksize)
+                return
+
+            # 1 编码分析，截到最后一个换行符，避免多字节字符被截断影响判断
+            detect = not encoding
+            if detect:
+                encoding = get_encoding(bstr[:bstr.rfind(b'\n') + 1] or bstr)
+            decoder = codecs.getincrementaldecoder(encoding)()
+
+            # 2 逐块解码，末尾的\r留到下一块，跟下一块开头的\n一起转成\n
+            tail, all_ascii = '', True
+            while bstr:
+                try:
+                    s = decoder.decode(bstr)
+                except UnicodeDecodeError:
+                    if not (detect and all_ascii):
+                        raise
+                    # 之前的内容都是ascii，按新编码解码也是一样的，只需要换掉后面的解码器
+                    encoding = get_encoding(bstr[:bstr.rfind(b'\n') + 1] or bstr)
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                    s = decoder.decode(bstr)
+                all_ascii = all_ascii and bstr.isascii()
+                s, tail = tail + s, ''
+                if s.endswith('\r'):
+                    s, tail = s[:-1], '\r'
+                if '\r' in s: s = s.replace('\r\n', '\n')
+                if s: yield s
+                bstr = f.read(chunksize)
+            s = tail + decoder.decode(b'', final=True)
+            if s: yield s
+
+    def iter_lines(self, *, encoding=None, keepends=False, chunksize=1 << 20):
+        r""" 逐行读取文本文件
+
+        跟 read().split('\n') 的切分方式相同，\r\n会统一成\n，但只有最后一行为空时不返回该空行
+
+        >>> f = File('a.txt', tempfile.gettempdir()).write('ab\r\n中文\n\ncd'.encode('utf8'))
+        >>> list(f.iter_lines())
+        ['ab', '中文', '', 'cd']
+        >>> f.delete()
+
+        :param keepends: 是否保留每行末尾的\n
+        :return: generator
+        """
+        pending = ''
+        for s in self.iter_chunks(chunksize, encoding=encoding):
+            lines = (pending + s).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n' if keepends else line
+        if pending:
+            yield pending
+
+    def iter_jsonl(self, *, encoding=None):
+        """ 逐行解析 JSON Lines 格式的文件，跳过空行
+
+        :return: generator
+        """
+        for line in self.iter_lines(encoding=encoding):
+            if not line.strip():
+                continue
+            try:
+                yield ujson.loads(line)
+            except ValueError:  # ujson会有些不太标准的情况处理不了
+                yield json.loads(line)
+
+    def write(self, ob, *, encoding='utf8', if_exists=None, mode=None, atomic=True, buffering=-1, **kwargs):
         """ 保存为文件
 
         :param ob: 写入的内容
@@ -760,12 +1019,18 @@ class File(PathBase):
             当然，其实有些格式是用不到编码信息的~~例如pkl文件
         :param if_exists: 如果文件已存在，要进行的操作
         :param mode: 写入模式（例如 '.json'），默认从扩展名识别，也可以强制指定
+            各模式的序列化接口见 File.WRITERS
+        :param atomic: 先写临时文件再替换，写入中途出错不会破坏原文件，详见 atomic_open
+        :param buffering: 写入的缓冲区大小，同open的buffering参数，大文件可以设大一些减少系统调用
         :param kwargs:
             写入json格式的时候
                 ensure_ascii: json.dump默认是True，但是我这里默认值改成了False
                     改成False可以支持在json直接显示中文明文
                 indent: json.dump是None，我这里默认值遵循json.dump
                     我原来是2，让文件结构更清晰、更加易读
+                engine: 默认ujson，可以改用更快的orjson，详见 _json_writer
+            写入pkl格式的时候
+                protocol: 默认用最高的版本5
         :return: 返回写入的文件名，这个主要是在写临时文件时有用
         """
 
@@ -777,27 +1042,22 @@ class File(PathBase):
         #         # return self.encoding or 'utf8'
         #     return encoding
 
+        if atomic and if_exists == 'replace':
+            if_exists = None  # 原子写入本身就是替换，不用先删除原文件
         if self.exist_preprcs(if_exists):
             self.ensure_parent()
             name, suffix = str(self), self.suffix
             if not mode: mode = suffix
             mode = mode.lower()
-            if mode == '.pkl':
-                with open(name, 'wb') as f:
-                    pickle.dump(ob, f)
-            elif mode == '.json':
-                with open(name, 'w', encoding=encoding) as f:
-                    DictTool.ior(kwargs, {'ensure_ascii': False})
-                    ujson.dump(ob, f, **kwargs)
-            elif mode == '.yaml':
-                with open(name, 'w', encoding=encoding) as f:
-                    yaml.dump(ob, f)
-            elif isinstance(ob, bytes):
-                with open(name, 'wb') as f:
+            writer = self.WRITERS.get(mode)
+            opener = atomic_open if atomic else open
+            with opener(name, 'wb', buffering=buffering) as f:
+                if writer:
+                    writer(f, ob, encoding, **kwargs)
+                elif isinstance(ob, bytes):
                     f.write(ob)
-            else:  # 其他类型认为是文本类型
-                with open(name, 'w', errors='ignore', encoding=encoding) as f:
-                    f.write(str(ob))
+                else:  # 其他类型认为是文本类型
+                    _write_text(f, str(ob), encoding, errors='ignore')
 
         return self
 
@@ -815,6 +1075,58 @@ class File(PathBase):
         shutil.unpack_archive(p, str(dst_dir))
 
 
+class BackgroundWriter:
+    """ 在后台线程写文件，让数据的序列化、磁盘io跟主线程的计算重叠进行
+
+    >>> with BackgroundWriter() as writer:
+    ...     _ = writer.write(os.path.join(tempfile.gettempdir(), 'a.json'), {'a': 1})
+
+    队列满了后submit会阻塞，避免计算比写入快太多，待写的数据堆满内存
+    任务里的异常会在 close（或退出with）时抛出
+    """
+
+    def __init__(self, max_workers=1, maxsize=64):
+        """
+        :param max_workers: 写入的线程数
+        :param maxsize: 最多积压的未完成任务数
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.semaphore = threading.BoundedSemaphore(maxsize)
+        self.errors = []
+
+    def _done(self, future):
+        self.semaphore.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def submit(self, func, *args, **kwargs):
+        """ 提交任意的写入函数 func(*args, **kwargs) """
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def write(self, file, ob, **kwargs):
+        """ 参数同 File.write """
+        return self.submit(lambda: File(file).write(ob, **kwargs))
+
+    def close(self):
+        """ 等待所有任务完成 """
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def demo_file():
     """ File类的综合测试"""
     temp = tempfile.gettempdir()
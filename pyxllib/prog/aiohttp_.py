@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Author : 陈坤泽
+# @Email  : 877362867@qq.com
+# @Date   : 2026/10/17 10:30
+
+""" 基于aiohttp的批量网络请求工具
+
+requests一次只能等一个请求，多线程也开不了太多；这里用协程，一个线程里就能同时挂起成百上千个请求，
+配合连接池复用、失败重试、按域名限速，适合批量下载、批量调接口。
+
+一般用法：
+    fetch_urls(urls)  # 同步接口，直接拿到所有结果
+    Iterate(items).run(afunc, max_workers=200, backend='asyncio', context=client)  # 自定义协程处理
+"""
+
+import asyncio
+import collections
+import functools
+import subprocess
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    subprocess.run(['pip3', 'install', 'aiohttp'])
+    import aiohttp
+
+from pyxllib.prog.pupil import async_map
+
+
+class _RateLimiter:
+    """ 按域名限速，同一个域名相邻两次请求至少间隔 1/rate 秒 """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = collections.defaultdict(float)
+
+    async def wait(self, host):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        t = max(now, self.next_time[host])
+        # 先占好自己的时间片再sleep，并发调用时也能排开
+        self.next_time[host] = t + self.interval
+        if t > now:
+            await asyncio.sleep(t - now)
+
+
+class AsyncHttp:
+    """ aiohttp.ClientSession 的封装，增加并发限制、失败重试、限速
+
+    >> async with AsyncHttp(limit_per_host=20) as client:
+    ..     status, data = await client.get('https://www.baidu.com')
+    """
+
+    def __init__(self, concurrency=100, limit_per_host=10, retries=3, backoff=0.5, rate=None, timeout=30,
+                 retry_statuses=(429, 500, 502, 503, 504), retry_methods=('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')):
+        """
+        :param concurrency: 连接池总连接数
+        :param limit_per_host: 每个域名最多同时打开的连接数，避免把对方服务器打挂
+        :param retries: 连接出错、超时、返回retry_statuses里的状态码时，最多重试的次数
+        :param backoff: 重试的等待时间，第k次重试等待 backoff * 2^(k-1) 秒
+            服务器返回了Retry-After时以服务器的为准
+        :param rate: 每个域名每秒最多发起的请求数，默认不限
+        :param timeout: 单次请求的总超时秒数
+        :param retry_methods: 默认只重试幂等的请求方法
+            POST等请求可能服务器已经处理了只是响应没回来，重试会重复提交，比如webhook发出重复的消息
+            确实需要重试的，可以加到这里，或者在 request 时传入 retry=True
+        """
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = _RateLimiter(rate) if rate else None
+        self.timeout = timeout
+        self.retry_statuses = set(retry_statuses)
+        self.retry_methods = {x.upper() for x in retry_methods}
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.limit_per_host)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+        self.session = None
+
+    def _retry_wait(self, k, resp=None):
+        """ 第k次重试前要等待的秒数 """
+        if resp is not None:
+            t = resp.headers.get('Retry-After', '')
+            if t.isdigit():
+                return int(t)
+        return self.backoff * 2 ** (k - 1)
+
+    async def request(self, method, url, *, read='bytes', raise_for_status=True, retry=None, **kwargs):
+        """ 发送请求，失败时自动重试
+
+        :param read: 返回数据的读取方式
+            'bytes'，二进制内容
+            'json'，解析成json
+            'text'，文本
+            None，不读内容，例如HEAD请求
+        :param raise_for_status: 最终状态码>=400时是否抛出 aiohttp.ClientResponseError
+        :param retry: 失败时是否重试，默认只有method在retry_methods里才重试
+        :param kwargs: 其他参数见 aiohttp.ClientSession.request
+        :return: (status, data)
+        """
+        if self.session is None:
+            raise RuntimeError('请在 async with AsyncHttp() as client 里使用')
+
+        host = urlparse(url).netloc
+        if retry is None:
+            retry = method.upper() in self.retry_methods
+        retries = self.retries if retry else 0
+        k = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.wait(host)
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    if resp.status in self.retry_statuses and k < retries:
+                        k += 1
+                        wait = self._retry_wait(k, resp)
+                    else:
+                        if raise_for_status:
+                            resp.raise_for_status()
+                        if read == 'bytes':
+                            data = await resp.read()
+                        elif read == 'json':
+                            data = await resp.json(content_type=None)
+                        elif read == 'text':
+                            data = await resp.text()
+                        else:
+                            data = None
+                        return resp.status, data
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if k >= retries:
+                    raise
+                k += 1
+                wait = self._retry_wait(k)
+            await asyncio.sleep(wait)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def get_json(self, url, **kwargs):
+        return (await self.request('GET', url, read='json', **kwargs))[1]
+
+    async def post_json(self, url, data, *, read='json', **kwargs):
+        return await self.request('POST', url, json=data, read=read, **kwargs)
+
+    async def head(self, url, **kwargs):
+        return await self.request('HEAD', url, read=None, **kwargs)
+
+
+____async = """
+filelib、download里同步网络函数对应的协程版
+"""
+
+
+async def async_is_url_connect(client, url, timeout=5):
+    """ is_url_connect 的协程版，只要能连上就算，不管状态码 """
+    try:
+        await client.request('HEAD', url, read=None, raise_for_status=False,
+                             timeout=aiohttp.ClientTimeout(total=timeout))
+        return True
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        return False
+
+
+async def async_get_etag(client, url):
+    """ get_etag 对url的协程版 """
+    from pyxllib.file.specialist import get_etag
+
+    _, content = await client.get(url)
+    return get_etag(content)
+
+
+async def async_download_file(client, url, fn=None, *, encoding=None, if_exists=None, ext=None, temp=False):
+    """ download_file 的协程版，写文件放到线程池里，不阻塞事件循环
+
+    :param client: AsyncHttp
+    :return: 保存的文件路径
+    """
+    from pyxllib.file.specialist import File, Dir
+
+    _, content = await client.get(url)
+    if not fn: fn = url.split('/')[-1]
+    root = Dir.TEMP if temp else None
+    write = functools.partial(File(fn, root, suffix=ext).write, content, encoding=encoding, if_exists=if_exists)
+    fn = await asyncio.get_running_loop().run_in_executor(None, write)
+    return fn.to_str()
+
+
+____batch = """
+同步接口的批量处理
+"""
+
+
+def fetch_urls(urls, *, read='bytes', concurrency=100, ordered=True, **kwargs):
+    """ 并发GET一批url
+
+    :param read: 详见 AsyncHttp.request
+    :param concurrency: 同时进行的请求数
+    :param kwargs: AsyncHttp的初始化参数，例如 limit_per_host、retries、rate
+    :return: generator，按urls顺序（ordered=False时按完成顺序）返回每个url的内容
+        某个url最终失败时会抛出异常
+    """
+    client = AsyncHttp(concurrency=concurrency, **kwargs)
+
+    async def fetch(url):
+        return (await client.get(url, read=read))[1]
+
+    return async_map(fetch, urls, concurrency, ordered=ordered, context=client)
+
+
+def download_files(urls, files=None, *, concurrency=100, if_exists=None, temp=False, **kwargs):
+    """ download_file 的批量版
+
+    :param urls: 要下载的url清单
+    :param files: 对应的保存位置，默认从url提取文件名
+    :param kwargs: AsyncHttp的初始化参数
+    :return: list，保存的文件路径
+    """
+    client = AsyncHttp(concurrency=concurrency, **kwargs)
+    if files is None:
+        files = [None] * len(urls)
+
+    async def download(x):
+        url, fn = x
+        return await async_download_file(client, url, fn, if_exists=if_exists, temp=temp)
+
+    return list(async_map(download, zip(urls, files), concurrency, context=client))
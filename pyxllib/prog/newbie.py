@@ -4,6 +4,16 @@
 # @Email  : 877362867@qq.com
 # @Date   : 2021/06/06 10:51
 
+import atexit
+import collections
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+import time
+
 from pyxllib.excel.newbie import int2excel_col_name
 
 
@@ -70,7 +80,224 @@ def document(func):
     return wrapper
 
 
-class RunOnlyOnce:
+def make_hashable(x):
+    """ 把参数结构化地转成可哈希的key，用于缓存等场景
+
+    list、dict、set等容器递归转换，dict与键值对的顺序无关；
+    numpy数组按dtype、shape和内容摘要生成指纹；其他不可哈希的对象用pickle后的内容摘要
+    跟 lru_cache(typed=True) 一样区分类型，1、1.0、True 虽然相等，但是不同的key
+
+    >>> make_hashable([1, {'b': 2, 'a': [3]}]) == make_hashable([1, {'a': [3], 'b': 2}])
+    True
+    >>> make_hashable([1, 2]) == make_hashable((1, 2))
+    False
+    >>> len({make_hashable(1), make_hashable(1.0), make_hashable(True)})
+    3
+    """
+    if type(x) in (str, bytes, int, type(None)):  # 最常见的类型直接作为key
+        return x
+    elif isinstance(x, (str, bytes, int, float)):  # bool、float及各种子类都带上类型名
+        return typename(x), x
+    elif isinstance(x, (tuple, list)):  # 容器都带上类型名，避免 [1, 2] 与 ('list', (1, 2)) 这类冲突
+        return typename(x), tuple(map(make_hashable, x))
+    elif isinstance(x, dict):
+        return typename(x), frozenset((make_hashable(k), make_hashable(v)) for k, v in x.items())
+    elif isinstance(x, (set, frozenset)):
+        return typename(x), frozenset(map(make_hashable, x))
+    elif type(x).__module__ == 'numpy' and hasattr(x, 'tobytes'):  # 不需要导入numpy就能识别
+        if x.dtype.hasobject:
+            return 'ndarray', make_hashable(x.tolist())
+        return 'ndarray', x.dtype.str, x.shape, hashlib.blake2b(x.tobytes(), digest_size=16).digest()
+
+    try:
+        hash(x)
+        return typename(x), x
+    except TypeError:
+        pass
+    # 定义了__eq__但没定义__hash__的类也会走到这里，每次调用都要pickle一遍，这类参数建议用key参数自定义
+    try:
+        return typename(x), hashlib.blake2b(pickle.dumps(x, protocol=4), digest_size=16).digest()
+    except Exception:
+        raise TypeError(f'无法为{typename(x)}类型的参数生成缓存key，请用key参数自定义') from None
+
+
+class Memoize:
+    """ 函数结果缓存，相同参数再次调用时直接返回之前的结果
+
+    相比 functools.lru_cache：
+        1、参数不要求可哈希，list、dict、numpy数组等也能作为参数，详见 make_hashable
+        2、支持ttl过期时间，适合缓存配置文件等会变的内容
+        3、支持保存到磁盘，程序重启后还能用
+        4、同一个key正在计算时，其他线程会等待结果，不会重复执行（例如重复加载模型）
+
+    >>> @memoize(maxsize=2)
+    ... def f(x, y=1):
+    ...     return x + y
+    >>> f(1), f(1, y=1), f(x=1), f(2), f(3), f(1)
+    (2, 2, 2, 3, 4, 2)
+    >>> f.cache_info()
+    CacheInfo(hits=2, misses=4, maxsize=2, currsize=2)
+    """
+
+    CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+    def __init__(self, func, *, maxsize=None, ttl=None, key=None, distinct_args=True, file=None):
+        """
+        :param func: 封装的函数
+        :param maxsize: 最多缓存的结果数，超出时淘汰最久没用到的结果，默认不限
+        :param ttl: 结果的有效秒数，过期后下次调用会重新执行，默认一直有效
+        :param key: 自定义key的函数，key(*args, **kwargs)要返回可哈希的值
+            默认会把参数绑定到函数签名上再结构化转换，f(1)、f(x=1)、使用默认值的f()都算同一个key
+        :param distinct_args: 设为False，则不管何种参数形式，都只保存第一次运行的结果
+        :param file: 缓存持久化的文件，初始化时读取，程序退出或调用save时写入
+            结果要能pickle，不适合缓存模型这类大对象
+        """
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.distinct_args = distinct_args
+        self.file = file
+        self.hits = self.misses = 0
+        # key -> (结果, 过期时间)，按最近使用的顺序排列
+        self.results = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        try:
+            self._signature = inspect.signature(func)
+        except (TypeError, ValueError):
+            self._signature = None
+        # 只有普通参数的函数，只传位置参数时可以直接补默认值，不用每次都bind，快很多
+        self._defaults = None
+        if self._signature:
+            params = list(self._signature.parameters.values())
+            if all(p.kind == p.POSITIONAL_OR_KEYWORD for p in params):
+                self._defaults = tuple(p.default for p in params)
+                self._min_args = sum(p.default is p.empty for p in params)
+        functools.update_wrapper(self, func)
+
+        if file:
+            self.load()
+            atexit.register(self.save)
+
+    def __get__(self, obj, objtype=None):
+        """ 支持装饰类的成员方法，实例也会作为key的一部分
+
+        注意缓存会一直引用着实例，实例不会被回收，直到对应的结果被淘汰或者 cache_clear；
+        实例不可哈希时（例如定义了__eq__但没定义__hash__），每次调用都要pickle实例来生成key。
+        实例很多或者很大时，建议设置maxsize，
+            或者用key参数只取实例上真正影响结果的字段，例如 key=lambda self, x: (self.name, x)
+        """
+        if obj is None:
+            return self
+        return functools.partial(self, obj)
+
+    def make_key(self, args, kwargs):
+        if not self.distinct_args:
+            return None
+        if self.key:
+            return self.key(*args, **kwargs)
+        if not kwargs and self._defaults is not None and self._min_args <= len(args) <= len(self._defaults):
+            args += self._defaults[len(args):]
+        elif self._signature:
+            try:
+                ba = self._signature.bind(*args, **kwargs)
+                ba.apply_defaults()
+                args, kwargs = ba.args, ba.kwargs
+            except TypeError:  # 参数不匹配，交给func自己报错
+                pass
+        if kwargs:
+            return make_hashable(args), make_hashable(kwargs)
+        return make_hashable(args)
+
+    def _get(self, key):
+        """ 返回 (是否命中, 结果)，要在锁里调用 """
+        if key in self.results:
+            value, expire = self.results[key]
+            if expire is None or expire > time.time():
+                self.results.move_to_end(key)
+                return True, value
+            del self.results[key]
+        return False, None
+
+    def _set(self, key, value):
+        expire = time.time() + self.ttl if self.ttl else None
+        self.results[key] = (value, expire)
+        self.results.move_to_end(key)
+        while self.maxsize is not None and len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+    def __call__(self, *args, **kwargs):
+        key = self.make_key(args, kwargs)
+
+        # 1 已有结果直接返回
+        with self._lock:
+            hit, value = self._get(key)
+            if hit:
+                self.hits += 1
+                return value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # 2 同一个key只让一个线程计算，其他线程等它算完再取结果
+        with key_lock:
+            with self._lock:
+                hit, value = self._get(key)
+                if hit:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+            try:
+                value = self.func(*args, **kwargs)
+                with self._lock:
+                    self._set(key, value)
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+        return value
+
+    def cache_info(self):
+        with self._lock:
+            return self.CacheInfo(self.hits, self.misses, self.maxsize, len(self.results))
+
+    def reset(self):
+        """ 清空缓存，下一次调用时会重新执行 """
+        with self._lock:
+            self.results.clear()
+            self.hits = self.misses = 0
+
+    cache_clear = reset
+
+    def load(self):
+        if not os.path.isfile(self.file):
+            return
+        with open(self.file, 'rb') as f:
+            results = pickle.load(f)
+        with self._lock:
+            now = time.time()
+            for k, (v, expire) in results.items():
+                if expire is None or expire > now:
+                    self._set(k, v)
+
+    def save(self):
+        """ 原子写入，中途出错不会损坏原有的缓存文件 """
+        from pyxllib.file.specialist import atomic_open
+
+        if not self.file:
+            return
+        with self._lock:
+            data = pickle.dumps(dict(self.results), protocol=pickle.HIGHEST_PROTOCOL)
+        with atomic_open(self.file, 'wb') as f:
+            f.write(data)
+
+
+def memoize(func=None, **kwargs):
+    """ Memoize的装饰器写法，可以直接 @memoize，也可以带参数 @memoize(maxsize=128, ttl=60) """
+    if func is None:
+        return functools.partial(Memoize, **kwargs)
+    return Memoize(func, **kwargs)
+
+
+class RunOnlyOnce(Memoize):
     """ 被装饰的函数，不同的参数输入形式，只会被执行一次，
 
     重复执行时会从内存直接调用上次相同参数调用下的运行的结果
@@ -80,6 +307,8 @@ class RunOnlyOnce:
 
     使用好该装饰器，可能让一些动态规划dp、搜索问题变得更简洁，
     以及一些配置文件操作，可以做到只读一遍
+
+    现在是不限容量、不过期的 Memoize，需要淘汰旧结果时请用 memoize(maxsize=..., ttl=...)
     """
 
     def __init__(self, func, distinct_args=True):
@@ -88,22 +317,7 @@ class RunOnlyOnce:
         :param distinct_args: 默认不同输入参数形式，都会保存一个结果
             设为False，则不管何种参数形式，函数就真的只会保存第一次运行的结果
         """
-        self.func = func
-        self.distinct_args = distinct_args
-        self.results = {}
-
-    def __call__(self, *args, **kwargs):
-        tag = f'{args}{kwargs}' if self.distinct_args else ''
-        # TODO 思考更严谨，考虑了值类型的tag标记
-        #   目前的tag规则，是必要不充分条件。还可以使用id，则是充分不必要条件
-        #   能找到充要条件来做是最好的，不行的话，也应该用更严谨的充分条件来做
-        # TODO kwargs的顺序应该是没影响的，要去掉顺序干扰
-        if tag not in self.results:
-            self.results[tag] = self.func(*args, **kwargs)
-        return self.results[tag]
-
-    def reset(self):
-        self.results = {}
+        super().__init__(func, distinct_args=distinct_args)
 
 
 def len_in_dim2(arr):
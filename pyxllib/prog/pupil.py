@@ -8,13 +8,20 @@
 """ 封装一些代码开发中常用的功能，工程组件 """
 
 from urllib.parse import urlparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import io
+import itertools
 import json
 import math
 import os
+import pickle
 import queue
 import socket
 import sys
+import threading
 import time
 
 
@@ -103,6 +110,210 @@ class EmptyPoolExecutor:
         pass
 
 
+def _run_chunk(func, chunk):
+    """ bounded_map 每个任务执行的内容，要定义在模块层级，进程池才能pickle """
+    return [func(x) for x in chunk]
+
+
+def auto_chunksize(n, max_workers=None):
+    """ 进程池的chunksize经验值：每个进程大约分到4批任务
+
+    >>> auto_chunksize(1000, 5)
+    50
+
+    :param n: 任务总数
+    :param max_workers: 进程数，默认是cpu数量
+    """
+    return max(1, n // (4 * (max_workers or os.cpu_count() or 1)))
+
+
+def bounded_map(func, iterable, max_workers=None, *, window=None, ordered=True, chunksize=1,
+                executor_class=concurrent.futures.ThreadPoolExecutor):
+    """ 并行版的map，但是同时提交的任务数有上限
+
+    executor.map会一次性把所有任务都提交进队列，这里最多只有window批任务在执行或排队，
+    有任务完成才提交新任务，不会忙等，也不会把整个iterable读进内存
+
+    >>> list(bounded_map(lambda x: x * x, range(5), 2))
+    [0, 1, 4, 9, 16]
+
+    :param max_workers: 并行数，1表示直接在当前线程串行执行
+    :param window: 最多同时提交的任务批数，默认是并行数的2倍
+    :param ordered: 按输入顺序返回结果，否则按完成顺序返回
+    :param chunksize: 每chunksize个元素打包成一个任务提交，元素很多、func很快时可以减少调度开销
+    :param executor_class: 也可以用 ProcessPoolExecutor，此时func要能被pickle
+    :return: generator，每完成一个元素就返回其结果，func的异常会在取到对应结果时抛出
+    """
+    if max_workers == 1:
+        for x in iterable:
+            yield func(x)
+        return
+
+    if issubclass(executor_class, concurrent.futures.ProcessPoolExecutor):
+        # 提前检查，否则要等到提交任务时才会报出不好理解的pickle错误
+        try:
+            pickle.dumps(func)
+        except Exception as e:
+            raise TypeError(f'进程池要求func能被pickle，不能是lambda、局部函数等：{func}') from e
+
+    it = iter(iterable)
+    chunks = iter(lambda: list(itertools.islice(it, chunksize)), [])
+    if window is None:
+        window = 2 * (max_workers or min(32, (os.cpu_count() or 1) + 4))
+    pending = collections.deque() if ordered else set()
+
+    def pop_done():
+        """ 取出最早提交（ordered）或者已经完成的一批任务结果 """
+        nonlocal pending
+        if ordered:
+            yield from pending.popleft().result()
+        else:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+    with executor_class(max_workers) as executor:
+        try:
+            # 1 窗口满了就先取出完成的结果，再提交新任务
+            for chunk in chunks:
+                if len(pending) >= window:
+                    yield from pop_done()
+                future = executor.submit(_run_chunk, func, chunk)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+
+            # 2 取出剩余结果
+            while pending:
+                yield from pop_done()
+        finally:  # 出错或者中途停止迭代时，取消还没开始执行的任务
+            for future in pending:
+                future.cancel()
+
+
+def async_map(func, iterable, concurrency=100, *, ordered=True, context=None):
+    """ 协程版的 bounded_map，在后台线程的事件循环里并发执行协程函数func
+
+    适合大量网络请求等io任务，并发数可以开到几百上千，不用每个任务占一个线程
+
+    >>> async def f(x):
+    ...     await asyncio.sleep(0.01 * (5 - x))
+    ...     return x * x
+    >>> list(async_map(f, range(5), 3))
+    [0, 1, 4, 9, 16]
+
+    :param func: 协程函数，func(x)返回awaitable对象
+    :param concurrency: 最多同时运行的协程数，已完成但还没被取走的结果也算在内
+    :param ordered: 按输入顺序返回结果，否则按完成顺序返回
+    :param context: 可选的异步上下文管理器（例如 AsyncHttp 客户端），会在事件循环里进入，所有任务结束后退出
+    :return: generator，func的异常会在取到对应结果时抛出
+    """
+    results = queue.Queue()
+    finished = object()
+    ready = threading.Event()
+    state = {}
+
+    async def main():
+        state['loop'], state['task'] = asyncio.get_running_loop(), asyncio.current_task()
+        state['sem'] = sem = asyncio.Semaphore(concurrency)
+        ready.set()
+        buffer, next_idx, tasks = {}, 0, set()
+
+        async def run(i, x):
+            nonlocal next_idx
+            try:
+                r = True, await func(x)
+            except Exception as e:
+                r = False, e
+            if ordered:  # 按顺序输出，先完成的暂存起来
+                buffer[i] = r
+                while next_idx in buffer:
+                    results.put(buffer.pop(next_idx))
+                    next_idx += 1
+            else:
+                results.put(r)
+
+        try:
+            async with (context if context is not None else contextlib.AsyncExitStack()):
+                # 信号量在结果被取走时才释放，控制执行中、待取走的任务总数
+                for i, x in enumerate(iterable):
+                    await sem.acquire()
+                    task = asyncio.ensure_future(run(i, x))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                while tasks:
+                    await asyncio.wait(list(tasks))
+        except Exception as e:  # iterable、context出错
+            results.put((False, e))
+        finally:
+            for task in tasks:
+                task.cancel()
+            results.put(finished)
+
+    def run_loop():
+        try:
+            asyncio.run(main())
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run_loop, daemon=True)
+    thread.start()
+    ready.wait()
+    loop = state['loop']
+    try:
+        while True:
+            r = results.get()
+            if r is finished:
+                break
+            with contextlib.suppress(RuntimeError):  # 所有任务都已结束时，事件循环可能已经关闭
+                loop.call_soon_threadsafe(state['sem'].release)
+            ok, v = r
+            if not ok:
+                raise v
+            yield v
+    finally:  # 出错或中途停止迭代时，取消事件循环里剩余的任务
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(state['task'].cancel)
+        thread.join()
+
+
+POOL_EXECUTORS = {'thread': concurrent.futures.ThreadPoolExecutor,
+                  'process': concurrent.futures.ProcessPoolExecutor}
+
+
+def parallel_map(func, iterable, max_workers=None, *, backend='thread', prefetch=None, prefetch_workers=None,
+                 **kwargs):
+    """ 支持多种并行方式的 bounded_map
+
+    :param backend:
+        'thread'，线程池，适合io密集的任务
+        'process'，进程池，适合cpu密集的任务，func、元素、返回值都要能被pickle
+        'hybrid'，混合模式，prefetch在线程池里读数据，func在进程池里计算，必须要有prefetch
+        'asyncio'，func是协程函数，用 async_map 并发执行，max_workers是并发数，默认100
+    :param prefetch: 在线程池中预先对每个元素执行的函数（一般是读文件等io操作），其结果再传给func
+    :param prefetch_workers: prefetch使用的线程数
+    :param kwargs: 其他参数见 bounded_map，chunksize只作用于func
+        asyncio模式只支持 ordered、context 参数
+    :return: generator
+    """
+    if backend == 'asyncio':
+        if prefetch is not None:
+            raise ValueError("backend='asyncio'不支持prefetch，请直接在协程里读取数据")
+        kwargs.pop('chunksize', None)
+        return async_map(func, iterable, max_workers or 100, **kwargs)
+    if backend == 'hybrid':
+        if prefetch is None:
+            raise ValueError("backend='hybrid'需要设置prefetch读取数据")
+        backend = 'process'
+    if backend not in POOL_EXECUTORS:
+        raise ValueError(f'不支持的backend：{backend}')
+    if prefetch is not None:
+        # 预读是有序、有窗口上限的，不会一下子把所有数据都读进内存
+        iterable = bounded_map(prefetch, iterable, prefetch_workers)
+    return bounded_map(func, iterable, max_workers, executor_class=POOL_EXECUTORS[backend], **kwargs)
+
+
 def xlwait(func, condition=bool, *, limit=None, interval=1):
     """ 不断重复执行func，直到得到满足condition条件的期望值
 
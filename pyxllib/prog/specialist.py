@@ -4,21 +4,26 @@
 # @Email  : 877362867@qq.com
 # @Date   : 2021/06/06 11:16
 
-import concurrent.futures
 import os
 import re
 import subprocess
 
 from tqdm import tqdm
 
+from pyxllib.prog.pupil import parallel_map
 
-def mtqdm(func, iterable, *args, max_workers=1, **kwargs):
+
+def mtqdm(func, iterable, *args, max_workers=1, chunksize=1, backend='thread', prefetch=None, **kwargs):
     """ 对tqdm的封装，增加了多线程的支持
 
     这里名称前缀多出的m有multi的意思
 
     :param max_workers: 默认是单线程，改成None会自动变为多线程
         或者可以自己指定线程数
+    :param chunksize: 并行时每次提交的元素数，详见 bounded_map
+    :param backend: 'thread'、'process'、'hybrid'、'asyncio'，详见 parallel_map
+        'asyncio'时func是协程函数，max_workers是并发数
+    :param prefetch: 在线程池里预先读取数据的函数，设置后func的输入变成 prefetch(x)
     :param smoothing: tqdm官方默认值是0.3
         这里关掉指数移动平均，直接计算整体平均速度
         因为对我个人来说，大部分时候需要严谨地分析性能，得到整体平均速度，而不是预估当前速度
@@ -32,31 +37,19 @@ def mtqdm(func, iterable, *args, max_workers=1, **kwargs):
     kwargs['smoothing'] = kwargs.get('smoothing', 0)
     kwargs['mininterval'] = kwargs.get('mininterval', 1)
 
-    if max_workers == 1:
+    if max_workers == 1 and prefetch is None and backend != 'asyncio':
         # 1 如果只用一个线程，则不使用concurrent.futures.ThreadPoolExecutor，能加速
         for x in tqdm(iterable, *args, **kwargs):
             func(x)
     else:
-        # 2 默认的多线程运行机制，出错是不会暂停的；这里对原函数功能进行封装，增加报错功能
-        error = False
-
-        def wrap_func(x):
-            nonlocal error
-            try:
-                func(x)
-            except Exception as e:
-                error = e
-
-        # 3 多线程和进度条功能的结合
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
-        for x in tqdm(iterable, *args, **kwargs):
-            while executor._work_queue.qsize():
-                pass
-            executor.submit(wrap_func, x)
-            if error:
-                raise error
-
-        executor.shutdown()
+        # 2 并行运行，进度条按完成的任务数更新；func出错时会取消剩余任务并抛出异常
+        if 'total' not in kwargs and hasattr(iterable, '__len__'):
+            kwargs['total'] = len(iterable)
+        results = parallel_map(func, iterable, max_workers, backend=backend, prefetch=prefetch,
+                               ordered=False, chunksize=chunksize)
+        with tqdm(None, *args, **kwargs) as pbar:
+            for _ in results:
+                pbar.update()
 
 
 def distribute_package(root, version=None, repository=None, *, upload=True):
@@ -30,6 +30,21 @@ class WeixinRobot:
         except requests.exceptions.ConnectionError:  # 没网发送失败的时候也不报错
             pass
 
+    async def apush_text(self, client, s):
+        """ push_text 的协程版，批量推送时可以共用一个连接池
+
+        :param client: pyxllib.prog.aiohttp_.AsyncHttp
+        """
+        import aiohttp
+
+        msgtype = 'text'
+        t = {"content": s} if isinstance(s, str) else s
+        data = {"msgtype": msgtype, msgtype: t}
+        try:
+            await client.request('POST', self.url, json=data, read=None, headers={"Content-Type": "text/plain"})
+        except aiohttp.ClientConnectionError:
+            pass
+
 
 class DingtalkRobot:
     """ 钉钉 自定义webhook机器人
@@ -67,6 +82,25 @@ class DingtalkRobot:
         data = {"msgtype": msgtype, msgtype: d}
         self.push_data(data)
 
+    async def apush_data(self, client, data):
+        """ push_data 的协程版
+
+        :param client: pyxllib.prog.aiohttp_.AsyncHttp
+        """
+        import aiohttp
+
+        try:
+            await client.request('POST', self.url, json=data, read=None, headers=self.headers)
+        except aiohttp.ClientConnectionError:
+            pass
+
+    async def apush_text(self, client, content):
+        msgtype = 'text'
+        d = {}
+        if content: d['content'] = content
+        data = {"msgtype": msgtype, msgtype: d}
+        await self.apush_data(client, data)
+
     def push_link(self, text='', title='', pic_url='', message_url=''):
         msgtype = 'link'
         d = {}
@@ -20,6 +20,7 @@ opencv-python
 xlai = """
 visdom
 xlcocotools
+ijson
 """
 # fvcore
 